@@ -35,10 +35,3 @@ CREATE TABLE Message (
     FOREIGN KEY (EventId) REFERENCES Event (Id)
     ON DELETE CASCADE
 );
-
-CREATE EVENT event_CleanHistory_Event
-ON SCHEDULE EVERY 1 MONTH
-COMMENT 'Delete records older than 3 years'
-DO
-  DELETE FROM Event 
-  WHERE Created < DATE_SUB(CURRENT_TIMESTAMP, INTERVAL 3 YEAR);
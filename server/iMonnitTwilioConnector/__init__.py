@@ -2,17 +2,99 @@
 # By: Ethan Jansen
 # App factory and entrypoint
 
+import atexit
 from flask import Flask
-from time import sleep
-import sys
+import os
+import threading
 from . import settings  # this also tests all environment variables and configures logging
+from .callbackBuffer import StatusCallbackBuffer
+from .coalesce import AlertCoalescer
 from .db import DbConnector
+from .dedup import EventDeduplicator
+from .health import prober
+from .outbox import SmsOutbox
+from .retention import RetentionManager
+from .retry import RetryPolicy
+from .routing import RecipientRouter
 from .twilioClient import TwilioSMSClient
 
 
-# instantiate twilio client and db connector
-smsClient = TwilioSMSClient()
+# local Twilio API emulator (testing), instead of Twilio
+twilioEmulator = None
+if settings.TwilioConfig.Emulator:
+    from .twilioEmulator import TwilioEmulator
+    twilioEmulator = TwilioEmulator(callbackBaseUrl=settings.TwilioConfig.EmulatorCallbackUrl)
+    twilioEmulator.start()
+
+# instantiate twilio client, db connector, recipient router, retry policy, sms outbox, status callback buffer, event
+# deduplicator, alert coalescer, and history retention
+smsClient = TwilioSMSClient(apiBaseUrl=twilioEmulator.url if twilioEmulator else settings.TwilioConfig.ApiBaseUrl)
 dbConn = DbConnector()
+router = RecipientRouter()
+retryPolicy = RetryPolicy()
+smsOutbox = SmsOutbox(smsClient, dbConn, retryPolicy)
+callbackBuffer = StatusCallbackBuffer(dbConn)
+deduplicator = EventDeduplicator(dbConn)
+coalescer = AlertCoalescer(smsOutbox.notify)
+retention = RetentionManager(dbConn)
+
+
+def startServices(logger):
+    """Starts dependency health checks, then brings up the rest in the background. Returns without waiting for the
+    database, so the server listens (and answers /healthz and /readyz) at once. Shared by flask and asgi apps."""
+    # cached dependency health -- Twilio only gates readiness when webhooks send SMS themselves (no outbox)
+    prober.addProbe("db", dbConn.ping, settings.ImonnitTwilioConnectorConfig.HealthDbInterval)
+    prober.addProbe("twilio", smsClient.ping, settings.ImonnitTwilioConnectorConfig.HealthTwilioInterval,
+                    required=settings.ImonnitTwilioConnectorConfig.OutboxWorkers <= 0)
+    prober.start()
+    atexit.register(prober.stop)
+
+    threading.Thread(target=_startServices, args=(logger,), name="startup", daemon=True).start()
+
+
+def _exit(logger, message, code):
+    """Exits from the startup thread (sys.exit would only end the thread), after writing out queued logs."""
+    logger.critical(message)
+    settings.logPipeline.stop()
+    os._exit(code)
+
+
+def _startServices(logger):
+    # wait for database -- allow delayed start, the prober logs when it comes up
+    if not prober.waitFor("db", 0):
+        logger.warning("Database not ready! Waiting...")
+        prober.waitFor("db")
+
+    # bring database schema up to date
+    if settings.DbConfig.AutoMigrate:
+        from .migrations import SchemaMigrator
+        if not SchemaMigrator(dbConn).migrate():
+            _exit(logger, "Unable to migrate database schema! Exiting...", 3)
+
+    # compile recipient routes
+    if not router.load(dbConn):
+        _exit(logger, "Unable to load recipient routes! Exiting...", 4)
+
+    # start sending queued messages and retries
+    smsOutbox.start()
+    atexit.register(smsOutbox.stop, 5)
+
+    # start writing buffered status callbacks
+    callbackBuffer.start()
+
+    # start sending digests of suppressed repeat alerts
+    coalescer.start()
+
+    # start expiring old history
+    retention.start()
+
+    # backlogs are read when metrics are scraped
+    from . import metrics
+    metrics.outboxPending.callback = dbConn.countOutboxMessages
+    metrics.callbackBufferDepth.callback = lambda: callbackBuffer.pendingCount
+
+    prober.started = True
+    logger.info("Startup complete, ready once required dependencies are reachable.")
 
 
 def create_app():
@@ -20,20 +102,18 @@ def create_app():
     app = Flask(__package__, instance_relative_config=True, static_folder=None)
     app.config.from_mapping(SECRET_KEY=settings.ImonnitTwilioConnectorConfig.ServerSecret)
 
-    # test database connection -- allow delayed start
-    dbFailedCount = 0
-    while not dbConn.testConnection():
-        if dbFailedCount > 5:
-            app.logger.critical("Unable to connect to database! Exiting...")
-            sys.exit(2)
-        dbFailedCount += 1
-        app.logger.warning("Database not ready! Waiting...")
-        sleep(3)
+    startServices(app.logger)
 
     app.logger.info("Starting server.")
 
     # register blueprints
+    from . import metrics
+    from .api import apiBp
+    from .health import healthBp
     from .webhook import webhookBp
     app.register_blueprint(webhookBp)
+    app.register_blueprint(apiBp)
+    app.register_blueprint(metrics.metricsBp)
+    app.register_blueprint(healthBp)
 
     return app
@@ -0,0 +1,259 @@
+# api.py
+# By: Ethan Jansen
+# Read API for Event and Message history. Requires Basic Authorization.
+# events: GET /api/events?since=&until=&rule=&deviceID=&networkID=&accountID=&limit=&before=
+# messages: GET /api/messages?since=&until=&status=&eventId=&rule=&deviceID=&networkID=&accountID=&limit=&before=
+# Pages are newest first. Each page's "next" is the before= value of the following page (keyset pagination), null on
+# the last page. Only ApiConcurrency reads use db connections at once, so dashboards never starve webhooks of the pool.
+# export: GET /api/export?format=ndjson|csv&since=&until=&rule=&deviceID=&networkID=&accountID=
+# Streams all matching history, oldest first (see export.py), gzip compressed if accepted. Only ExportConcurrency
+# exports run at once, each holding one db connection until it finishes.
+
+from datetime import datetime
+from flask import Blueprint, request
+from json import dumps as jsonDumps
+import logging
+import threading
+from typing import Callable, Dict, Iterator, Tuple
+from . import dbConn, export
+from .auth import login_required
+from .dataTypes import jsonValue
+from .db import DbConnector
+from .settings import ImonnitTwilioConnectorConfig
+
+
+# create blueprint
+bpName = "api"
+apiBp = Blueprint(bpName, __name__, url_prefix="/"+bpName)
+logger = logging.getLogger(__name__)
+
+defaultLimit = 100
+maxLimit = 1000
+_reads = threading.BoundedSemaphore(max(ImonnitTwilioConnectorConfig.ApiConcurrency, 1))
+_exports = threading.BoundedSemaphore(max(ImonnitTwilioConnectorConfig.ExportConcurrency, 1))
+_jsonHeaders = {"Content-Type": "application/json"}
+
+# query parameter: type
+_filterTypes = {"before": int,
+                "since": datetime.fromisoformat,
+                "until": datetime.fromisoformat,
+                "rule": str,
+                "status": str,
+                "eventId": int,
+                "deviceID": int,
+                "networkID": int,
+                "accountID": int}
+
+
+# Routes
+@apiBp.get("/events")
+@login_required
+def events():
+    return handleEvents(request.args.to_dict())
+
+
+@apiBp.get("/messages")
+@login_required
+def messages():
+    return handleMessages(request.args.to_dict())
+
+
+@apiBp.get("/export")
+@login_required
+def exportHistory():
+    return handleExport(request.args.to_dict(), request.headers.get("Accept-Encoding", ""))
+
+
+# Handlers -- shared by flask routes and the asgi app. Return (body, status[, headers]), body is str or a generator of
+# bytes chunks (streamed).
+def handleEvents(args: Dict[str, str]) -> Tuple:
+    return _page(args, DbConnector.eventFilters, DbConnector.eventColumns, dbConn.getEvents, "events")
+
+
+def handleMessages(args: Dict[str, str]) -> Tuple:
+    return _page(args, DbConnector.messageFilters, DbConnector.messageColumns, dbConn.getMessages, "messages")
+
+
+def handleExport(args: Dict[str, str], acceptEncoding: str = "") -> Tuple:
+    return _export(args, acceptEncoding, dbConn.streamHistory)
+
+
+def _export(args: Dict[str, str], acceptEncoding: str, streamHistory: Callable) -> Tuple:
+    args = dict(args)
+    format = args.pop("format", "ndjson")
+    if format not in export.formats:
+        return (f"Bad Request: format must be one of {', '.join(export.formats)}", 400)
+    try:
+        filters, _ = parseArgs(args, DbConnector.exportFilters)
+    except ValueError as e:
+        return (f"Bad Request: {e}", 400)
+
+    compress = "gzip" in acceptEncoding.lower()
+    if not _exports.acquire(timeout=ImonnitTwilioConnectorConfig.ApiTimeout):
+        return ("Too many history exports, try again later", 503, {"Retry-After": "10"})
+    try:
+        batches = streamHistory(filters, ImonnitTwilioConnectorConfig.ExportBatchSize)
+    except Exception as e:
+        _exports.release()
+        logger.error(f"Error exporting history: {e}")
+        return ("Unable to export history from db", 500)  # InternalServerError
+
+    headers = {"Content-Type": export.formats[format],
+               "Content-Disposition": f"attachment; filename=history.{format}"}
+    if compress:
+        headers["Content-Encoding"] = "gzip"
+    return (ExportStream(batches, format, compress), 200, headers)
+
+
+class ExportStream:
+    """Output chunks of one export. Holds an export slot and its db history stream until exhausted or closed.
+    close() is called by the server once the response ends (or the client goes away), and when the stream is
+    garbage collected, so an abandoned response still releases both."""
+    def __init__(self, batches: Iterator, format: str, compress: bool):
+        self._batches = batches
+        self._chunks = export.encode(batches, format, compress)
+        self._closed = False
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self
+
+    def __next__(self) -> bytes:
+        try:
+            return next(self._chunks)
+        except StopIteration:
+            self.close()
+            raise
+        except Exception as e:
+            logger.error(f"Error exporting history, response truncated: {e}")
+            self.close()
+            raise  # aborts the response, so the client cannot mistake it for a complete export
+
+    def close(self) -> None:
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            self._chunks.close()
+            self._batches.close()
+        finally:
+            _exports.release()
+
+    def __del__(self):
+        self.close()
+
+
+def parseArgs(args: Dict[str, str], filterNames) -> Tuple[Dict, int]:
+    """Returns (filters, limit) of query args. Raises ValueError on unknown or invalid args."""
+    filters = {}
+    for name, value in args.items():
+        if name == "limit":
+            continue
+        if name not in filterNames:
+            raise ValueError(f"Unknown filter: {name}")
+        if value != "":
+            filters[name] = _filterTypes[name](value)
+
+    limit = int(args.get("limit", defaultLimit))
+    if not 1 <= limit <= maxLimit:
+        raise ValueError(f"limit must be 1-{maxLimit}")
+    return (filters, limit)
+
+
+def _page(args: Dict[str, str], filterNames, columns, read: Callable, name: str) -> Tuple:
+    try:
+        filters, limit = parseArgs(args, filterNames)
+    except ValueError as e:
+        return (f"Bad Request: {e}", 400)
+
+    if not _reads.acquire(timeout=ImonnitTwilioConnectorConfig.ApiTimeout):
+        return ("Too many history reads, try again later", 503, {"Retry-After": "1"})
+    try:
+        rows = read(filters, limit + 1)  # one extra row tells if there is a next page
+    finally:
+        _reads.release()
+    if rows is None:
+        return (f"Unable to read {name} from db", 500)  # InternalServerError
+
+    keys = [key for _, key in columns]
+    page = [{key: jsonValue(value) for key, value in zip(keys, row)} for row in rows[:limit]]
+    nextCursor = page[-1]["id"] if len(rows) > limit else None
+    return (jsonDumps({name: page, "next": nextCursor}), 200, _jsonHeaders)
+
+
+if __name__ == "__main__":
+    # testing - no db required
+    filters, limit = parseArgs({"rule": "Battery low", "since": "2025-03-28T14:25", "before": "100", "deviceID": ""},
+                               DbConnector.eventFilters)
+    assert filters == {"rule": "Battery low", "since": datetime(2025, 3, 28, 14, 25), "before": 100}
+    assert limit == defaultLimit
+
+    for badArgs in ({"status": "delivered"},  # messages only
+                    {"deviceID": "abc"},
+                    {"limit": "0"},
+                    {"limit": str(maxLimit + 1)}):
+        exceptionThrown = False
+        try:
+            parseArgs(badArgs, DbConnector.eventFilters)
+        except ValueError:
+            exceptionThrown = True
+        assert exceptionThrown
+
+    # pages end with null next
+    class _TestDb:
+        @staticmethod
+        def getEvents(filters, limit):
+            return [(id, "rule") + (None,) * 15 + (datetime(2025, 3, 28, 14, 25),)
+                    for id in range(filters.get("before", 6) - 1, 0, -1)][:limit]
+
+    body, status, _ = _page({"limit": "3"}, DbConnector.eventFilters, DbConnector.eventColumns, _TestDb.getEvents, "events")
+    assert status == 200 and '"next": 3' in body and '"created": "2025-03-28T14:25:00"' in body
+    body, status, _ = _page({"limit": "3", "before": "3"}, DbConnector.eventFilters, DbConnector.eventColumns,
+                            _TestDb.getEvents, "events")
+    assert status == 200 and '"next": null' in body
+
+    # invalid exports rejected before reading history
+    assert handleExport({"format": "xml"})[1] == 400
+    assert handleExport({"before": "100"})[1] == 400  # exports are not paged
+
+    # aborted exports (client went away), closed or abandoned, return their export slot and db stream
+    class _TestHistory:
+        def __init__(self, fail=False):
+            self.fail = fail
+            self.closed = False
+
+        def streamHistory(self, filters, batchSize):
+            if self.fail:
+                raise TimeoutError("No db connection available")
+            return self
+
+        def __iter__(self):
+            return self
+
+        def __next__(self):
+            return [(1,) + (None,) * (len(export.csvHeader) - 1)] * 1000  # endless history
+
+        def close(self):
+            self.closed = True
+
+    def freeExports():
+        slots = [_exports.acquire(blocking=False) for _ in range(max(ImonnitTwilioConnectorConfig.ExportConcurrency, 1))]
+        for _ in range(sum(slots)):
+            _exports.release()
+        return sum(slots)
+
+    exportSlots = freeExports()
+    TestHistory = _TestHistory()
+    stream, status, _ = _export({"format": "csv"}, "", TestHistory.streamHistory)
+    assert status == 200 and next(stream).startswith(b"event.id,") and freeExports() == exportSlots - 1
+    stream.close()
+    assert TestHistory.closed and freeExports() == exportSlots
+    stream.close()  # closed once
+    assert freeExports() == exportSlots
+
+    TestHistory = _TestHistory()
+    stream, status, _ = _export({"format": "csv"}, "", TestHistory.streamHistory)
+    next(stream)
+    del stream
+    assert TestHistory.closed and freeExports() == exportSlots
+
+    assert _export({}, "", _TestHistory(fail=True).streamHistory)[1] == 500 and freeExports() == exportSlots
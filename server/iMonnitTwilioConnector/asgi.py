@@ -0,0 +1,224 @@
+# asgi.py
+# By: Ethan Jansen
+# ASGI app, an alternative to flask + waitress. Serves the same routes with the same Basic Authorization.
+# Run with: uvicorn iMonnitTwilioConnector.asgi:app
+# Webhooks run on the event loop: Twilio is called with the async Twilio client, db calls wait for a pooled connection
+# without holding a thread (see webhook.handleImonnitAsync), so thousands of webhooks can be in flight at once.
+# History API reads run on a thread pool of AsgiThreads, streamed responses (history export) hold a thread only while
+# reading their next chunk.
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from json import loads as jsonLoads
+import logging
+from time import perf_counter
+from urllib.parse import parse_qsl
+from . import smsClient, startServices
+from .api import handleEvents, handleExport, handleMessages
+from .auth import checkAuthHeader, twilioSignature, unauthorizedResponse
+from .health import handleHealthz, handleReadyz
+from .metrics import registry, requestCount, requestSeconds, requestsInFlight
+from .settings import ImonnitTwilioConnectorConfig
+from .webhook import handleImonnitAsync, handleTwilioAsync
+
+
+logger = logging.getLogger(__name__)
+
+
+class AsgiApp:
+    maxBodySize = 1024 * 1024  # bytes
+
+    def __init__(self, threads: int = ImonnitTwilioConnectorConfig.AsgiThreads):
+        self._executor = ThreadPoolExecutor(max_workers=max(threads, 1), thread_name_prefix="asgi")
+
+        # path: (endpoint, method, handler, authorization) -- endpoint names match flask for metrics
+        # authorization: "basic", "twilio" (X-Twilio-Signature, otherwise basic), or None (health probes)
+        self._routes = {"/webhook/imonnit": ("webhook.imonnit", "POST", self._imonnit, "basic"),
+                        "/webhook/twilio": ("webhook.twilio", "POST", self._twilio, "twilio"),
+                        "/api/events": ("api.events", "GET", self._events, "basic"),
+                        "/api/messages": ("api.messages", "GET", self._messages, "basic"),
+                        "/api/export": ("api.exportHistory", "GET", self._export, "basic"),
+                        "/metrics": ("metrics.metrics", "GET", self._metrics, "basic"),
+                        "/healthz": ("health.healthz", "GET", self._healthz, None),
+                        "/readyz": ("health.readyz", "GET", self._readyz, None)}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                startServices(logger)  # returns at once, the rest starts in the background (see /readyz)
+                logger.info("Starting asgi server.")
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self._executor.shutdown(wait=True)
+                await smsClient.closeAsync()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send) -> None:
+        route = self._routes.get(scope["path"])
+        if route is None:
+            await self._respond(send, ("Not Found", 404))
+            return
+
+        endpoint, method, handler, authorization = route
+        start = perf_counter()
+        requestsInFlight.inc()
+        try:
+            headers = {name.decode("latin-1").lower(): value.decode("latin-1") for name, value in scope["headers"]}
+            signature = headers.get("x-twilio-signature") if authorization == "twilio" and twilioSignature.enabled else None
+            if scope["method"] != method:
+                response = ("Method Not Allowed", 405, {"Allow": method})
+            elif authorization is None:
+                response = await handler(headers, b"", scope.get("query_string", b""))
+            elif signature is None and not checkAuthHeader(headers.get("authorization")):
+                logger.warning("Unauthorized Basic Auth")
+                response = unauthorizedResponse
+            else:
+                body = await AsgiApp._readBody(receive)
+                if body is None:
+                    response = ("Request Entity Too Large", 413)
+                elif (signature is not None and not twilioSignature.validate(signature, AsgiApp._parseForm(body))
+                      and not checkAuthHeader(headers.get("authorization"))):
+                    logger.warning("Unauthorized Basic Auth")  # as flask: an invalid signature falls back to basic
+                    response = unauthorizedResponse
+                else:
+                    response = await handler(headers, body, scope.get("query_string", b""))
+        except Exception as e:
+            logger.error(f"Unexpected error handling {scope['path']}: {e}")
+            response = ("Internal Server Error", 500)
+        finally:
+            requestsInFlight.dec()
+
+        await self._respond(send, response)
+        requestCount.inc(labels=(endpoint, response[1]))
+        requestSeconds.observe(perf_counter() - start, (endpoint,))
+
+    @classmethod
+    async def _readBody(cls, receive) -> bytes | None:
+        """Returns request body, None if larger than maxBodySize."""
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > cls.maxBodySize:
+                return None
+            if not message.get("more_body", False):
+                return body
+
+    async def _respond(self, send, response: tuple) -> None:
+        body, status = response[0], response[1]
+        headers = [(name.lower().encode("latin-1"), value.encode("latin-1")) for name, value in
+                   (response[2].items() if len(response) > 2 else ())]
+        if not any(name == b"content-type" for name, _ in headers):
+            headers.append((b"content-type", b"text/html; charset=utf-8"))
+        if isinstance(body, str):
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            await send({"type": "http.response.body", "body": body.encode()})
+            return
+
+        # streamed: iterator of bytes chunks, read on the thread pool, always closed (releases its db connection),
+        # even if the client is gone before the response starts
+        loop = asyncio.get_running_loop()
+        try:
+            await send({"type": "http.response.start", "status": status, "headers": headers})
+            while (chunk := await loop.run_in_executor(self._executor, next, body, None)) is not None:
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b""})
+        finally:
+            await loop.run_in_executor(self._executor, body.close)
+
+    async def _offload(self, handler, data) -> tuple:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, handler, data)
+
+    async def _imonnit(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        # iMonnit uses json
+        if headers.get("content-type", "").split(";")[0].strip() != "application/json":
+            return ("Unsupported Media Type", 415)
+        try:
+            data = jsonLoads(body)
+        except ValueError:
+            return ("Bad Request", 400)
+        return await handleImonnitAsync(data)
+
+    @staticmethod
+    def _parseForm(body: bytes) -> list:
+        return parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True)
+
+    async def _twilio(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        # Twilio uses x-www-form-urlencoded, first value of repeated keys (as flask's request.form.to_dict())
+        data = {}
+        for key, value in AsgiApp._parseForm(body):
+            data.setdefault(key, value)
+        return await handleTwilioAsync(data)
+
+    async def _events(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        return await self._offload(handleEvents, AsgiApp._parseQuery(query))
+
+    async def _messages(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        return await self._offload(handleMessages, AsgiApp._parseQuery(query))
+
+    async def _export(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        args = AsgiApp._parseQuery(query)
+        return await self._offload(lambda args: handleExport(args, headers.get("accept-encoding", "")), args)
+
+    @staticmethod
+    def _parseQuery(query: bytes) -> dict:
+        # first value of repeated keys (as flask's request.args.to_dict())
+        args = {}
+        for key, value in parse_qsl(query.decode("latin-1"), keep_blank_values=True):
+            args.setdefault(key, value)
+        return args
+
+    async def _healthz(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        return handleHealthz()  # cached status, no blocking calls
+
+    async def _readyz(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        return handleReadyz()
+
+    async def _metrics(self, headers: dict, body: bytes, query: bytes) -> tuple:
+        return (registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+app = AsgiApp()
+
+
+if __name__ == "__main__":
+    # testing - no db or Twilio required
+    from base64 import b64encode
+
+    async def request(method, path, authorization=None, body=b""):
+        headers = [(b"authorization", authorization.encode())] if authorization else []
+        scope = {"type": "http", "method": method, "path": path, "headers": headers}
+        messages = []
+
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        await app(scope, receive, send)
+        return messages[0]["status"], messages[1]["body"]
+
+    credentials = f"{ImonnitTwilioConnectorConfig.WebhookUser}:{ImonnitTwilioConnectorConfig.WebhookPassword}"
+    goodAuth = "Basic " + b64encode(credentials.encode()).decode()
+    badAuth = "Basic " + b64encode(b"nobody:nothing").decode()
+
+    assert asyncio.run(request("POST", "/nothing"))[0] == 404
+    assert asyncio.run(request("GET", "/webhook/imonnit", goodAuth))[0] == 405
+    assert asyncio.run(request("POST", "/webhook/imonnit"))[0] == 401
+    assert asyncio.run(request("POST", "/webhook/imonnit", badAuth))[0] == 401
+    assert asyncio.run(request("POST", "/webhook/imonnit", goodAuth, b"{}"))[0] == 415  # no json content type
+    assert asyncio.run(request("POST", "/webhook/twilio", goodAuth, b"x" * (AsgiApp.maxBodySize + 1)))[0] == 413
+    assert asyncio.run(request("GET", "/api/events"))[0] == 401
+    assert asyncio.run(request("GET", "/api/export"))[0] == 401
+    assert asyncio.run(request("GET", "/readyz"))[0] == 503  # services not started
+    status, body = asyncio.run(request("GET", "/metrics", goodAuth))
+    assert status == 200 and b"requests_total" in body
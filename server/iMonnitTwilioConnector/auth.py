@@ -2,11 +2,17 @@
 # By: Ethan Jansen
 # Basic HTTP Authentication wrapper for flask.
 # Password are not currently hashed (their from env vars anyway)
+# Twilio status callbacks may instead be authenticated by their X-Twilio-Signature (HMAC-SHA1 with the auth token).
 
+from base64 import b64encode
 from flask import request
 from functools import wraps
+import hmac
+from hashlib import sha1
 import logging
-from .settings import ImonnitTwilioConnectorConfig
+from typing import Iterable, Tuple
+from werkzeug.datastructures import Authorization
+from .settings import ImonnitTwilioConnectorConfig, TwilioConfig
 
 
 logger = logging.getLogger(__name__)
@@ -20,6 +26,44 @@ def checkAuth(username, password):
     return userCheck and passCheck
 
 
+# Authentication check of a raw Authorization header (asgi app has no flask request)
+def checkAuthHeader(header):
+    auth = Authorization.from_header(header)
+    return bool(auth and auth.type == "basic" and checkAuth(auth.username, auth.password))
+
+
+unauthorizedResponse = ("Unauthorized", 401, {"WWW-Authenticate": 'Basic realm="Login Required"'})
+
+
+class TwilioSignatureValidator:
+    """Validates X-Twilio-Signature of requests to url. The HMAC key schedule is computed once and copied per request."""
+
+    def __init__(self, authToken: str | None, url: str):
+        self.url = url  # public url given to Twilio, as signed by Twilio
+        self._hmac = hmac.new(authToken.encode(), digestmod=sha1) if authToken else None
+
+    @property
+    def enabled(self) -> bool:
+        return self._hmac is not None
+
+    def sign(self, params: Iterable[Tuple[str, str]], url: str | None = None) -> str:
+        """Returns Twilio's signature of url (defaults to self.url) with POST params: url followed by sorted key+value pairs."""
+        mac = self._hmac.copy()
+        mac.update((url or self.url).encode())
+        for key, value in sorted(params):
+            mac.update(f"{key}{value}".encode())
+        return b64encode(mac.digest()).decode()
+
+    def validate(self, signature: str | None, params: Iterable[Tuple[str, str]]) -> bool:
+        if not self.enabled or not signature:
+            return False
+        return hmac.compare_digest(self.sign(params).encode(), signature.encode())
+
+
+twilioSignature = TwilioSignatureValidator(TwilioConfig.AuthToken,
+                                           f"https://{ImonnitTwilioConnectorConfig.Hostname}/webhook/twilio")
+
+
 # Authentication wrapper
 def login_required(f):
     @wraps(f)
@@ -27,7 +71,34 @@ def login_required(f):
         auth = request.authorization
         if not (auth and checkAuth(auth.username, auth.password)):
             logger.warning("Unauthorized Basic Auth")
-            return ("Unauthorized", 401, {"WWW-Authenticate": 'Basic realm="Login Required"'})
+            return unauthorizedResponse
 
         return f(*args, **kwargs)
     return decorated_function
+
+
+# Authentication wrapper for Twilio webhooks: valid X-Twilio-Signature, otherwise Basic Authorization
+def twilio_auth_required(f):
+    basic = login_required(f)
+
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if twilioSignature.validate(request.headers.get("X-Twilio-Signature"), request.form.items(multi=True)):
+            return f(*args, **kwargs)
+        return basic(*args, **kwargs)
+    return decorated_function
+
+
+if __name__ == "__main__":
+    # testing - signature of an example Twilio request
+    TestValidator = TwilioSignatureValidator("12345", "https://mycompany.com/myapp.php?foo=1&bar=2")
+    params = {"CallSid": "CA1234567890ABCDE",
+              "Caller": "+12349013030",
+              "Digits": "1234",
+              "From": "+12349013030",
+              "To": "+18005551212"}
+    assert TestValidator.sign(params.items()) == "0/KCTR6DLpKmkAf8muzZqo1nDgQ="
+    assert TestValidator.validate("0/KCTR6DLpKmkAf8muzZqo1nDgQ=", params.items())
+    assert not TestValidator.validate("0/KCTR6DLpKmkAf8muzZqo1nDgQ=", (params | {"Digits": "0"}).items())
+    assert not TestValidator.validate(None, params.items())
+    assert not TwilioSignatureValidator(None, TestValidator.url).validate("0/KCTR6DLpKmkAf8muzZqo1nDgQ=", params.items())
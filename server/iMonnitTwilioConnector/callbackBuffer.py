@@ -0,0 +1,177 @@
+# callbackBuffer.py
+# By: Ethan Jansen
+# Twilio status callback buffer.
+# Callbacks are acknowledged immediately and their Message updates are written to db in batches.
+# Updates for the same MessageSid within a batch collapse to the newest state.
+
+import atexit
+import logging
+import threading
+from time import monotonic
+from typing import Callable
+from .dataTypes import Message
+from .db import DbConnector
+from .settings import ImonnitTwilioConnectorConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class StatusCallbackBuffer:
+    # Twilio message status progression, also enforced by db across batches (see DbConnector._updateMessageSQL)
+    _statusRank = DbConnector.statusRank
+
+    def __init__(self,
+                 dbConn: DbConnector,
+                 batchSize: int = ImonnitTwilioConnectorConfig.CallbackBatchSize,
+                 flushInterval: float = ImonnitTwilioConnectorConfig.CallbackFlushInterval,
+                 grace: float = ImonnitTwilioConnectorConfig.CallbackGrace,
+                 clock: Callable[[], float] = monotonic):
+        self._dbConn = dbConn
+        self.batchSize = max(batchSize, 0)
+        self.flushInterval = flushInterval
+        self.grace = grace  # seconds to wait for a MessageSid to appear in db (outbox may not have stored it yet)
+        self._clock = clock
+
+        self._pending = {}  # messageId: (Message, clock time first received)
+        self._lock = threading.Lock()
+        self._flushNow = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    # callbacks are written by the webhook if disabled
+    @property
+    def enabled(self) -> bool:
+        return self.batchSize > 0
+
+    @property
+    def pendingCount(self) -> int:
+        return len(self._pending)
+
+    def start(self) -> None:
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="callback-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Buffering Twilio status callbacks: batches of {self.batchSize}, every {self.flushInterval} seconds.")
+
+    def stop(self, timeout: float | None = 5) -> None:
+        """Stops flush thread, then flushes anything still buffered."""
+        self._stopping.set()
+        self._flushNow.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.flush()
+
+    @classmethod
+    def _merge(cls, older: Message, newer: Message) -> Message:
+        """Returns newest state of two updates for the same message. Fields missing from the newest state are kept."""
+        if cls._statusRank.get(newer.status, 0) < cls._statusRank.get(older.status, 0):
+            older, newer = newer, older
+
+        merged = newer.model_copy()
+        for field in ("sentDT", "deliveredDT", "errorCode", "errorMessage"):
+            if getattr(merged, field) is None:
+                setattr(merged, field, getattr(older, field))
+        if older.updated and (merged.updated is None or older.updated > merged.updated):
+            merged.updated = older.updated
+        return merged
+
+    def add(self, message: Message) -> None:
+        """Buffers status update for message.messageId. Flushes early once batchSize messages are buffered."""
+        self._add(message, self._clock())
+        if len(self._pending) >= self.batchSize:
+            self._flushNow.set()
+
+    def _add(self, message: Message, received: float) -> None:
+        with self._lock:
+            existing = self._pending.get(message.messageId)
+            if existing:
+                message = StatusCallbackBuffer._merge(existing[0], message)
+                received = min(received, existing[1])
+            self._pending[message.messageId] = (message, received)
+
+    def flush(self) -> None:
+        """Writes all buffered updates to db. Unmatched and failed updates are retried by the following flushes, until
+        grace seconds after their first callback, however often batches fill up."""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+
+        unmatched = self._dbConn.updateMessages([message for message, _ in batch.values()])
+        if unmatched is None:
+            unmatched = set(batch)  # db error, retry all
+
+        now = self._clock()
+        for messageId in unmatched:
+            message, received = batch[messageId]
+            if now - received < self.grace:
+                self._add(message, received)
+            else:
+                logger.error(f"Dropping status update for Message {messageId}, not in db after {self.grace} seconds")
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._flushNow.wait(self.flushInterval)
+            self._flushNow.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"Unexpected error flushing status callbacks: {e}")
+
+
+if __name__ == "__main__":
+    # testing - no db required
+    from datetime import datetime
+
+    sid = "SM0123456789abcdefghijklmnopqrstuv"
+    queued = Message(messageId=sid, recipient="+11234567890", status="queued", updated=datetime(2025, 3, 28, 14, 25, 0))
+    sent = Message(messageId=sid, recipient="+11234567890", status="sent",
+                   sentDT=datetime(2025, 3, 28, 14, 25, 1), updated=datetime(2025, 3, 28, 14, 25, 1))
+    delivered = Message(messageId=sid, recipient="+11234567890", status="delivered",
+                        deliveredDT="2503281426", updated=datetime(2025, 3, 28, 14, 26, 0))
+
+    # in order: newest status wins, earlier fields kept
+    merged = StatusCallbackBuffer._merge(StatusCallbackBuffer._merge(queued, sent), delivered)
+    assert merged.status == "delivered"
+    assert merged.sentDT == datetime(2025, 3, 28, 14, 25, 1)
+    assert merged.deliveredDT == datetime(2025, 3, 28, 14, 26)
+
+    # out of order: never go back to an earlier status
+    merged = StatusCallbackBuffer._merge(delivered, sent)
+    assert merged.status == "delivered"
+    assert merged.sentDT == datetime(2025, 3, 28, 14, 25, 1)
+    assert merged.updated == datetime(2025, 3, 28, 14, 26, 0)
+
+    # batching: one update per MessageSid, unmatched updates retried for grace seconds (not flushes), then dropped
+    class _TestDb:
+        def __init__(self):
+            self.batches = []
+
+        def updateMessages(self, messages):
+            self.batches.append(messages)
+            return {m.messageId for m in messages if m.messageId != sid}
+
+    TestDb = _TestDb()
+    now = [0.0]
+    TestBuffer = StatusCallbackBuffer(TestDb, batchSize=10, flushInterval=60, grace=5, clock=lambda: now[0])
+    other = Message(messageId="SMother0123456789abcdefghijklmnopq", recipient="+11234567890", status="sent")
+    for msg in (queued, sent, delivered, other):
+        TestBuffer.add(msg)
+    assert TestBuffer.pendingCount == 2
+    TestBuffer.flush()
+    assert len(TestDb.batches[0]) == 2
+    assert TestBuffer.pendingCount == 1  # other retried
+    for _ in range(10):
+        TestBuffer.flush()  # early flushes of full batches
+    assert TestBuffer.pendingCount == 1
+    now[0] = 4
+    TestBuffer.add(other.model_copy(update={"status": "delivered"}))  # later callback keeps first received time
+    now[0] = 5
+    TestBuffer.flush()
+    assert TestBuffer.pendingCount == 0  # other dropped
@@ -0,0 +1,223 @@
+# coalesce.py
+# By: Ethan Jansen
+# Alert storm coalescing.
+# The first alert for a rule/network/device key is sent immediately. Repeats within the window are suppressed (still
+# stored in db), and summarized by one digest SMS when the window ends. Digests go to the routed recipients of the
+# window's alerts.
+
+import atexit
+import logging
+import threading
+from time import monotonic
+from typing import Callable, Iterable, Tuple
+from .dataTypes import Event
+from .logPipeline import audit
+from .settings import ImonnitTwilioConnectorConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class _Window:
+    def __init__(self, rule: str, end: float, first: Event | None = None, recipients: Iterable[str] = ()):
+        self.rule = rule
+        self.end = end
+        self.first = first  # event sent immediately, None until one is (or if it could not be stored)
+        self.suppressed = []  # suppressed events
+        self.recipients = dict.fromkeys(recipients)  # routed recipients of the window's events, in order
+
+
+class AlertCoalescer:
+    # key granularity: repeats of a rule from the same device, any device in a network, or anywhere
+    keyModes = ("device", "network", "rule")
+    digestDeviceLimit = 5  # devices listed by name in a digest
+
+    def __init__(self,
+                 notify: Callable[[str, Tuple[str, ...]], None],
+                 window: float = ImonnitTwilioConnectorConfig.CoalesceWindow,
+                 keyMode: str = ImonnitTwilioConnectorConfig.CoalesceKey,
+                 clock: Callable[[], float] = monotonic):
+        if keyMode not in AlertCoalescer.keyModes:
+            raise ValueError(f"Coalesce key must be one of {', '.join(AlertCoalescer.keyModes)}")
+
+        self._notify = notify
+        self.window = max(window, 0)
+        self.keyMode = keyMode
+        self._clock = clock
+
+        self._windows = {}  # key: _Window
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0
+
+    def _key(self, event: Event) -> Tuple:
+        if self.keyMode == "rule":
+            return (event.rule,)
+        if self.keyMode == "network":
+            return (event.rule, event.networkID)
+        return (event.rule, event.networkID, event.deviceID)
+
+    def start(self) -> None:
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="coalesce-digest", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Coalescing repeated alerts by {self.keyMode} within {self.window} seconds.")
+
+    def stop(self, timeout: float | None = 5) -> None:
+        """Stops digest thread, then sends digests of all windows with suppressed alerts."""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        self.tick(force=True)
+
+    def admit(self, event: Event, recipients: Iterable[str] = ()) -> bool:
+        """Returns True if event should be sent now, False if it is suppressed until the next digest.
+        recipients: event's routed recipients, the window's digest is sent to all of them."""
+        if not self.enabled:
+            return True
+
+        key = self._key(event)
+        now = self._clock()
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or window.end <= now:
+                if window is not None and window.suppressed:
+                    # window ended between digest ticks, digest is still due
+                    return True
+                self._windows[key] = _Window(event.rule, now + self.window, event, recipients)
+                return True
+            window.recipients.update(dict.fromkeys(recipients))
+            if window.first is None:
+                window.first = event
+                return True
+
+            window.suppressed.append(event)
+            logger.info(f"Suppressed repeat of rule \"{event.rule}\" ({len(window.suppressed)} in window)", extra=audit)
+            return False
+
+    def cancel(self, event: Event) -> None:
+        """Undoes admit(event) for an event that could not be stored (iMonnit will retry it). The retry is admitted the
+        same way: sent immediately if event was, never counted twice in a digest if it was suppressed."""
+        if not self.enabled:
+            return
+
+        key = self._key(event)
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None:
+                return
+            if window.first is event:
+                window.first = None
+                if not window.suppressed:
+                    del self._windows[key]
+            else:
+                window.suppressed = [suppressed for suppressed in window.suppressed if suppressed is not event]
+
+    @classmethod
+    def digestBody(cls, rule: str, suppressed: list, window: float) -> str:
+        devices = []
+        for event in suppressed:
+            device = f"{event.name} ({event.deviceID})" if event.name else f"Device {event.deviceID}"
+            if device not in devices:
+                devices.append(device)
+
+        deviceString = ", ".join(devices[:cls.digestDeviceLimit])
+        if len(devices) > cls.digestDeviceLimit:
+            deviceString += f", +{len(devices) - cls.digestDeviceLimit} more"
+
+        return f"""{rule}: {len(suppressed)} more alert(s) suppressed in the last {round(window)} seconds
+Devices: {deviceString}"""
+
+    def tick(self, force: bool = False) -> int:
+        """Sends digests of ended windows (all windows if force). A window with a digest is followed by a new window.
+        Returns number of digests sent."""
+        now = self._clock()
+        digests = []
+        with self._lock:
+            for key, window in list(self._windows.items()):
+                if window.end > now and not force:
+                    continue
+                if window.suppressed:
+                    digests.append((AlertCoalescer.digestBody(window.rule, window.suppressed, self.window),
+                                    tuple(window.recipients)))
+                    self._windows[key] = _Window(window.rule, now + self.window, window.first, window.recipients)
+                else:
+                    del self._windows[key]
+
+        for body, recipients in digests:
+            try:
+                self._notify(body, recipients)
+            except Exception as e:
+                logger.error(f"Unable to send alert digest: {e}")
+        return len(digests)
+
+    def _run(self) -> None:
+        while not self._stopping.wait(min(self.window, 1)):
+            self.tick()
+
+
+if __name__ == "__main__":
+    # testing - no twilio required
+    now = [0.0]
+    sentDigests = []
+    digestRecipients = []
+
+    def notify(body, recipients):
+        sentDigests.append(body)
+        digestRecipients.append(recipients)
+
+    TestCoalescer = AlertCoalescer(notify, window=60, keyMode="network", clock=lambda: now[0])
+
+    def storm(deviceID):
+        return Event(rule="Gateway offline", deviceID=deviceID, name=f"Gateway {deviceID}", networkID="1")
+
+    # first alert sent, repeats from the same network suppressed, other networks unaffected
+    assert TestCoalescer.admit(storm("1"), ("+11234567891",))
+    assert not TestCoalescer.admit(storm("2"), ("+11234567891",))
+    assert not TestCoalescer.admit(storm("3"), ("+11234567892",))  # device routed elsewhere
+    assert TestCoalescer.admit(Event(rule="Gateway offline", deviceID="4", networkID="2"))
+
+    # digest when window ends, storm continues in a new window
+    now[0] = 61
+    assert TestCoalescer.tick() == 1
+    assert sentDigests[0] == "Gateway offline: 2 more alert(s) suppressed in the last 60 seconds\nDevices: Gateway 2 (2), Gateway 3 (3)"
+    assert digestRecipients[0] == ("+11234567891", "+11234567892")  # routed recipients, not the defaults
+    assert not TestCoalescer.admit(storm("5"))
+
+    # quiet window ends without digest, next alert sent immediately
+    now[0] = 122
+    assert TestCoalescer.tick() == 1
+    now[0] = 183
+    assert TestCoalescer.tick() == 0
+    assert TestCoalescer.admit(storm("1"))
+
+    # pending digests sent on stop
+    assert not TestCoalescer.admit(storm("2"))
+    TestCoalescer.stop()
+    assert sentDigests[-1].startswith("Gateway offline: 1 more alert(s)")
+
+    # events that could not be stored are admitted the same way when iMonnit retries them
+    now[0] = 1000
+    first = storm("1")
+    assert TestCoalescer.admit(first)
+    TestCoalescer.cancel(first)
+    assert TestCoalescer.admit(storm("1"))  # retry of the first alert, still sent immediately
+    repeat = storm("2")
+    assert not TestCoalescer.admit(repeat)
+    TestCoalescer.cancel(repeat)
+    assert not TestCoalescer.admit(storm("2"))
+    now[0] = 1061
+    TestCoalescer.tick()
+    assert sentDigests[-1].startswith("Gateway offline: 1 more alert(s)")
+
+    # disabled
+    assert AlertCoalescer(notify, window=0).admit(storm("1"))
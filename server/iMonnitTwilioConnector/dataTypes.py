@@ -2,34 +2,103 @@
 # By: Ethan Jansen
 # data class with pydantic validation for webhooks
 
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from hashlib import sha256
 from pydantic import BaseModel, BeforeValidator, computed_field, Field, ValidationError
-from typing import List, Tuple, TypeAlias
+import re
+from time import localtime
+from typing import Iterable, List, Tuple, TypeAlias
 from typing_extensions import Annotated
 
 
+_epoch = datetime(1970, 1, 1)
+
+
 def _emptyStrToNone(s: str | None) -> None:
     if s is None or (isinstance(s, str) and s.strip() == ""):
         return None
     raise ValueError("Value is not empty")
 
 
+# E.164 recipients, at least 11 digits (Message.recipient length), optionally with a Twilio channel prefix
+_e164 = re.compile(r"^(whatsapp:)?\+[1-9]\d{10,14}$")
+_phoneSeparators = re.compile(r"[\s().-]")
+
+
+def toE164(number: str) -> str:
+    """Normalizes a phone number to E.164 ("+1 (123) 456-7890" to "+11234567890"). Raises ValueError if invalid."""
+    normalized = _phoneSeparators.sub("", number)
+    if normalized.startswith("00"):
+        normalized = "+" + normalized[2:]
+    if not _e164.match(normalized):
+        raise ValueError(f"Invalid E.164 phone number: \"{number}\"")
+    return normalized
+
+
+def toE164Tuple(numbers: Iterable[str]) -> Tuple[str, ...]:
+    """Normalizes phone numbers to E.164, without duplicates, in order. Raises ValueError if any are invalid."""
+    return tuple(dict.fromkeys(toE164(number) for number in numbers))
+
+
+def jsonValue(value):
+    """Returns value as json serializable: dates and datetimes (db columns) as ISO strings."""
+    return value.isoformat() if isinstance(value, (date, datetime)) else value
+
+
 # Tries all formatStrings in iterator order, returns results of the first not to raise ValueError
+# Aware datetimes are converted to naive local time. Fast path: the last matching format is tried first, and recently
+# seen strings are memoized.
 class _customDTValidator:
+    cacheSize = 1024  # memoized strings per validator
+    _offsetBucket = 900  # seconds. Local UTC offsets only change on 15 minute boundaries (DST transitions)
+
     def __init__(self, formatStrings: List[str]):
         self.formatStrings = formatStrings
+        self._lastFormat = formatStrings[0] if formatStrings else None
+        self._parseCached = lru_cache(maxsize=_customDTValidator.cacheSize)(self._parse)
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def _localOffset(bucket: int) -> timedelta:
+        """Returns local UTC offset for the 15 minute bucket of UTC time starting at bucket * _offsetBucket."""
+        return timedelta(seconds=localtime(bucket * _customDTValidator._offsetBucket).tm_gmtoff)
+
+    @classmethod
+    def toLocal(cls, dt: datetime) -> datetime:
+        """Converts aware dt to naive local time (as dt.astimezone().replace(tzinfo=None)). Naive dt is returned as is."""
+        offset = dt.utcoffset()
+        if offset is None:
+            return dt
+        utc = dt.replace(tzinfo=None) - offset
+        bucket = int((utc - _epoch).total_seconds() // cls._offsetBucket)
+        return utc + cls._localOffset(bucket)
+
+    def _parse(self, dt: str) -> datetime:
+        lastFormat = self._lastFormat
+        if lastFormat is not None:
+            try:
+                return _customDTValidator.toLocal(datetime.strptime(dt, lastFormat))
+            except ValueError:
+                pass
+
+        for formatString in self.formatStrings:
+            if formatString == lastFormat:
+                continue
+            try:
+                parsed = datetime.strptime(dt, formatString)
+            except ValueError:
+                continue
+            self._lastFormat = formatString
+            return _customDTValidator.toLocal(parsed)
+        raise ValueError("Unable to parse dt string")
 
     def validate(self, dt: str | datetime) -> datetime:
         # validate after _emptyStrToNone. dt cannot be None or ""
         if isinstance(dt, datetime):
             return dt
         elif isinstance(dt, str):
-            for formatString in self.formatStrings:
-                try:
-                    return datetime.strptime(dt, formatString).astimezone().replace(tzinfo=None)
-                except ValueError:
-                    pass
-            raise ValueError("Unable to parse dt string")
+            return self._parseCached(dt)
         raise TypeError("dt is not string or datetime")
 
 
@@ -72,6 +141,8 @@ class Message(BaseModel):  # this may not match keys of callback
     deliveredDT: NullableFancyDTMessageDelivered = None
     errorCode: NullableInt = None
     errorMessage: NullableStr = None
+    attempts: int = 0  # Twilio send attempts
+    nextAttempt: NullableDT = None  # when status is "retrying"
 
     created: NullableDT = None
     updated: NullableDT = None
@@ -83,7 +154,9 @@ class Message(BaseModel):  # this may not match keys of callback
                                    datetime | None,
                                    datetime | None,
                                    int | None,
-                                   str | None]:
+                                   str | None,
+                                   int,
+                                   datetime | None]:
         return (self.eventId,
                 self.messageId,
                 self.recipient,
@@ -91,7 +164,9 @@ class Message(BaseModel):  # this may not match keys of callback
                 self.sentDT,
                 self.deliveredDT,
                 self.errorCode,
-                self.errorMessage)
+                self.errorMessage,
+                self.attempts,
+                self.nextAttempt)
 
     def toSqlUpdate(self) -> Tuple[str | None,
                                    datetime | None,
@@ -111,6 +186,26 @@ class Message(BaseModel):  # this may not match keys of callback
                 self.updated,
                 self.messageId)
 
+    def toSqlUpdateById(self) -> Tuple[str | None,
+                                       str | None,
+                                       int | None,
+                                       str | None,
+                                       int,
+                                       datetime | None,
+                                       datetime | None,
+                                       int]:
+        if self.id is None:
+            raise ValueError("Cannot update SQL Message with null id")
+
+        return (self.messageId,
+                self.status,
+                self.errorCode,
+                self.errorMessage,
+                self.attempts,
+                self.nextAttempt,
+                self.updated,
+                self.id)
+
 
 class Event(BaseModel):
     id: NullableUnsignedInt = None
@@ -168,6 +263,18 @@ Acknowledge: {self.acknowledgeURL}"""
     def messageCount(self) -> int:
         return len(self.messages)
 
+    @property
+    def fingerprint(self) -> str | None:
+        """Identifies iMonnit retries of the same event. None if the event has no trigger or reading time to tell repeats apart."""
+        if self.triggeredDT is None and self.readingDT is None:
+            return None
+
+        key = "|".join((self.rule.strip().casefold(),
+                        str(self.deviceID),
+                        self.triggeredDT.isoformat() if self.triggeredDT else "",
+                        self.readingDT.isoformat() if self.readingDT else ""))
+        return sha256(key.encode()).hexdigest()
+
     def setAllEventId(self, id: int | str) -> None:
         """Updates Event.id and Message.eventId for all messages"""
         if isinstance(id, str):
@@ -216,7 +323,9 @@ Acknowledge: {self.acknowledgeURL}"""
                                                 datetime | None,
                                                 datetime | None,
                                                 int | None,
-                                                str | None]]:
+                                                str | None,
+                                                int,
+                                                datetime | None]]:
         returnList = []
         for msg in self.messages:
             returnList.append(msg.toSqlImport())
@@ -445,6 +554,8 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
         "deliveredDT": None,
         "errorCode": None,
         "errorMessage": None,
+        "attempts": 0,
+        "nextAttempt": None,
         "created": None,
         "updated": None
         }
@@ -458,6 +569,8 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
         "deliveredDT": None,
         "errorCode": 429,
         "errorMessage": "Error sending SMS...",
+        "attempts": 0,
+        "nextAttempt": None,
         "created": None,
         "updated": None
         }
@@ -471,6 +584,8 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
         "deliveredDT": datetime(2025, 3, 28, 14, 26),
         "errorCode": None,
         "errorMessage": None,
+        "attempts": 0,
+        "nextAttempt": None,
         "created": None,
         "updated": testEventDT
         }
@@ -497,6 +612,8 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
                           None,
                           None,
                           None,
+                          None,
+                          0,
                           None),
                          (1,
                           None,
@@ -505,7 +622,9 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
                           None,
                           None,
                           429,
-                          "Error sending SMS..."),
+                          "Error sending SMS...",
+                          0,
+                          None),
                          (1,
                           "SM0123456789abcdefghijklmnopqrstuv",
                           "+11234567892",
@@ -513,6 +632,8 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
                           datetime(2025, 3, 28, 14, 25),
                           datetime(2025, 3, 28, 14, 26),
                           None,
+                          None,
+                          0,
                           None)]
     testOutputMsg3UpdateSql = ("delivered",
                                datetime(2025, 3, 28, 14, 25),
@@ -567,3 +688,60 @@ Acknowledge: https://staging.imonnit.com/Ack/1234"""
     except ValueError:
         exceptionThrown = True
     assert exceptionThrown
+
+    # event: fingerprint identifies retries of the same event
+    assert TestEvent.fingerprint == Event(**testInputEvent).fingerprint
+    assert len(TestEvent.fingerprint) == 64
+    assert TestEvent.fingerprint != Event(**(testInputEvent | {"time": "14:22"})).fingerprint
+    assert TestEvent.fingerprint != Event(**(testInputEvent | {"deviceID": "56780"})).fingerprint
+    assert Event(rule="rule").fingerprint is None
+
+    # message: sql update by id (outbox send result)
+    OutboxMsg = Message(id=7,
+                        recipient="+11234567890",
+                        messageId="SM0123456789abcdefghijklmnopqrstuv",
+                        status="queued",
+                        updated=testEventDT)
+    assert OutboxMsg.toSqlUpdateById() == ("SM0123456789abcdefghijklmnopqrstuv", "queued", None, None, 0, None, testEventDT, 7)
+
+    exceptionThrown = False
+    try:
+        TestEvent.messages[0].toSqlUpdateById()
+    except ValueError:
+        exceptionThrown = True
+    assert exceptionThrown
+
+    # dt validator: matches legacy strptime().astimezone() conversion, with memoized results and last format first
+    from datetime import timezone
+    TestValidator = _customDTValidator(["%m/%d/%Y %I:%M %p", "%Y-%m-%d %H:%M", "%a, %d %b %Y %H:%M:%S %z"])
+    for dtString, formatString in (("03/28/2025 2:25 PM", "%m/%d/%Y %I:%M %p"),
+                                   ("2025-03-28 14:25", "%Y-%m-%d %H:%M"),
+                                   ("Fri, 28 Mar 2025 06:25:00 -0800", "%a, %d %b %Y %H:%M:%S %z"),
+                                   ("Sun, 09 Mar 2025 10:30:00 +0000", "%a, %d %b %Y %H:%M:%S %z"),
+                                   ("Sun, 02 Nov 2025 06:30:00 +0000", "%a, %d %b %Y %H:%M:%S %z")):
+        parsed = datetime.strptime(dtString, formatString)
+        expected = parsed.astimezone().replace(tzinfo=None) if parsed.tzinfo else parsed
+        assert TestValidator.validate(dtString) == expected
+        assert TestValidator.validate(dtString) == expected  # memoized
+        assert TestValidator._lastFormat == formatString
+    aware = datetime(2025, 7, 1, 12, 0, tzinfo=timezone.utc)
+    assert _customDTValidator.toLocal(aware) == aware.astimezone().replace(tzinfo=None)
+
+    exceptionThrown = False
+    try:
+        TestValidator.validate("28.03.2025")
+    except ValueError:
+        exceptionThrown = True
+    assert exceptionThrown
+
+    # recipients: normalized to E.164 once, duplicates removed
+    assert toE164("+1 (123) 456-7890") == "+11234567890"
+    assert toE164("0044 20 7946 0958") == "+442079460958"
+    assert toE164Tuple(["+11234567890", "+1 123 456 7890", "whatsapp:+11234567891"]) == ("+11234567890", "whatsapp:+11234567891")
+    for invalid in ("1234567890", "+1aaabbbcccc", "+01234567890", "+1234"):
+        exceptionThrown = False
+        try:
+            toE164(invalid)
+        except ValueError:
+            exceptionThrown = True
+        assert exceptionThrown
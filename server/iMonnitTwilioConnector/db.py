@@ -1,161 +1,585 @@
 # db.py
 # By: Ethan Jansen
-# MariaDB Connector
+# MariaDB Connector. Thread-safe: each call checks out its own connection from a shared pool.
 
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, ExitStack
+from datetime import datetime, timedelta
 import logging
 import mariadb
+import threading
 from .dataTypes import Event, Message
+from .logPipeline import audit
+from .metrics import dbSeconds, timed
 from .settings import DbConfig
 # testing
-from datetime import datetime
 import sys
 
 
 class DbConnector:
     _insertEventSQL = "INSERT INTO Event (Rule, Subject, DeviceId, Device, Reading, TriggeredDT, ReadingDT, " \
                     "OriginalReadingDT, AcknowledgeUrl, MessageNumber, ParentAccount, NetworkId, Network, AccountId, " \
-                    "AccountNumber, CompanyName) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
+                    "AccountNumber, CompanyName, Fingerprint) VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)"
 
-    _insertMessageSQL = "INSERT INTO Message (EventId, MessageId, Recipient, Status, SentDT, DeliveredDT, " \
-                        "ErrorCode, ErrorMessage) VALUES (?,?,?,?,?,?,?,?)"
+    # Locking read: holds the Fingerprint index range until commit, so a concurrent insert of the same fingerprint
+    # waits (or deadlocks and is rolled back) even where Fingerprint is not unique (partitioned Event, see retention)
+    _lockFingerprintSQL = "SELECT Id FROM Event WHERE Fingerprint=? LIMIT 1 FOR UPDATE"
+
+    _getEventByFingerprintSQL = "SELECT e.Id, m.Id, m.Recipient, m.MessageId, m.Status FROM Event e " \
+                                "LEFT JOIN Message m ON m.EventId=e.Id WHERE e.Fingerprint=? ORDER BY e.Id, m.Id"
+
+    _addMessageNumberSQL = "UPDATE Event SET MessageNumber=MessageNumber+? WHERE Id=?"
 
+    _insertMessageSQL = "INSERT INTO Message (EventId, MessageId, Recipient, Status, SentDT, DeliveredDT, " \
+                        "ErrorCode, ErrorMessage, Attempts, NextAttempt) VALUES (?,?,?,?,?,?,?,?,?,?)"
+
+    # Twilio message status progression. Callbacks may arrive out of order, never go back to an earlier status.
+    statusRank = {"accepted": 0,
+                  "scheduled": 0,
+                  "queued": 1,
+                  "sending": 2,
+                  "sent": 3,
+                  "canceled": 4,
+                  "failed": 4,
+                  "undelivered": 4,
+                  "delivered": 4,
+                  "read": 5}
+    _statusRankSQL = "CASE {} " + " ".join("WHEN '%s' THEN %d" % item for item in statusRank.items()) + " ELSE 0 END"
+
+    # status callbacks: stored status is only replaced by a status of the same or a later rank (last param: status)
     _updateMessageSQL = "UPDATE Message SET Status=?, SentDT=?, DeliveredDT=?, ErrorCode=?, ErrorMessage=?, " \
-                        "Updated=? WHERE MessageId=? LIMIT 1"
+                        "Updated=? WHERE MessageId=? AND " + _statusRankSQL.format("Status") + " <= " + \
+                        _statusRankSQL.format("?") + " LIMIT 1"
 
     _getMessageSQL = "SELECT Id FROM Message WHERE MessageId=? LIMIT 1"
 
-    def __init__(self):
-        self.isConnected = False
-        self.hasCursor = False
-
-        self._connection = None
-        self._cursor = None
+    _getMessageIdsSQL = "SELECT DISTINCT MessageId FROM Message WHERE MessageId IN ({})"
+
+    # outbox: claim pending messages, due retries, and abandoned claims past their lease without blocking other workers.
+    # One query per status, each on its own index. Abandoned claims never got a Twilio sid: a "sending" row with a
+    # MessageId has that status from a Twilio callback, and is already sent.
+    _claimMessagesSQLs = ("SELECT Id FROM Message WHERE Status='pending' ORDER BY Id LIMIT ? FOR UPDATE SKIP LOCKED",
+                          "SELECT Id FROM Message WHERE Status='retrying' AND NextAttempt<=? ORDER BY NextAttempt "
+                          "LIMIT ? FOR UPDATE SKIP LOCKED",
+                          "SELECT Id FROM Message WHERE Status='sending' AND MessageId IS NULL AND Updated<? "
+                          "ORDER BY Updated LIMIT ? FOR UPDATE SKIP LOCKED")
+
+    _countOutboxMessagesSQL = "SELECT COUNT(*) FROM Message WHERE Status IN ('pending', 'retrying')"
+
+    _markMessageSendingSQL = "UPDATE Message SET Status='sending', Updated=? WHERE Id=?"
+
+    _requeueFailedMessagesSQL = "UPDATE Message SET Status='pending', ErrorCode=NULL, ErrorMessage=NULL, Updated=? " \
+                                "WHERE EventId=? AND Status='failed' AND MessageId IS NULL"
+
+    _getOutboxMessagesSQL = "SELECT m.Id, m.EventId, m.Recipient, m.Attempts, e.Rule, e.DeviceId, e.Device, e.Reading, " \
+                            "e.TriggeredDT, e.AcknowledgeUrl FROM Message m JOIN Event e ON e.Id=m.EventId " \
+                            "WHERE m.Id IN ({})"
+
+    _updateMessageByIdSQL = "UPDATE Message SET MessageId=?, Status=?, ErrorCode=?, ErrorMessage=?, Attempts=?, " \
+                            "NextAttempt=?, Updated=? WHERE Id=? LIMIT 1"
+
+    _getRoutesSQL = "SELECT AccountId, NetworkId, DeviceId, Rule, Recipients FROM Route ORDER BY Id"
+
+    # history pages: newest first, seeking past the last Id of the previous page (never OFFSET)
+    # (column, dataTypes field) in select order
+    eventColumns = (("Id", "id"), ("Rule", "rule"), ("Subject", "subject"), ("DeviceId", "deviceID"), ("Device", "name"),
+                    ("Reading", "reading"), ("TriggeredDT", "triggeredDT"), ("ReadingDT", "readingDT"),
+                    ("OriginalReadingDT", "originalReadingDT"), ("AcknowledgeUrl", "acknowledgeURL"),
+                    ("MessageNumber", "messageCount"), ("ParentAccount", "parentAccount"), ("NetworkId", "networkID"),
+                    ("Network", "network"), ("AccountId", "accountID"), ("AccountNumber", "accountNumber"),
+                    ("CompanyName", "companyName"), ("Created", "created"))
+    messageColumns = (("Id", "id"), ("EventId", "eventId"), ("MessageId", "messageId"), ("Recipient", "recipient"),
+                      ("Status", "status"), ("SentDT", "sentDT"), ("DeliveredDT", "deliveredDT"), ("ErrorCode", "errorCode"),
+                      ("ErrorMessage", "errorMessage"), ("Attempts", "attempts"), ("NextAttempt", "nextAttempt"),
+                      ("Created", "created"), ("Updated", "updated"))
+
+    # filter name: condition
+    eventFilters = {"before": "Id<?",
+                    "since": "Created>=?",
+                    "until": "Created<?",
+                    "rule": "Rule=?",
+                    "deviceID": "DeviceId=?",
+                    "networkID": "NetworkId=?",
+                    "accountID": "AccountId=?"}
+    messageFilters = {"before": "m.Id<?",
+                      "since": "m.Created>=?",
+                      "until": "m.Created<?",
+                      "status": "m.Status=?",
+                      "eventId": "m.EventId=?",
+                      "rule": "e.Rule=?",
+                      "deviceID": "e.DeviceId=?",
+                      "networkID": "e.NetworkId=?",
+                      "accountID": "e.AccountId=?"}
+    _messageEventFilters = ("rule", "deviceID", "networkID", "accountID")  # need a join with Event
+
+    _getEventsSQL = "SELECT " + ", ".join(column for column, _ in eventColumns) + " FROM Event{} ORDER BY Id DESC LIMIT ?"
+    _getMessagesSQL = "SELECT " + ", ".join("m." + column for column, _ in messageColumns) + " FROM Message m{} " \
+                      "ORDER BY m.Id DESC LIMIT ?"
+
+    # history export: every event (oldest first) joined with its messages, one row per message
+    exportFilters = {name: "e." + condition for name, condition in eventFilters.items() if name != "before"}
+    _exportHistorySQL = "SELECT " + ", ".join("e." + column for column, _ in eventColumns) + ", " + \
+                        ", ".join("m." + column for column, _ in messageColumns) + \
+                        " FROM Event e LEFT JOIN Message m ON m.EventId=e.Id{} ORDER BY e.Id, m.Id"
+    _setWriteTimeoutSQL = "SET SESSION net_write_timeout=?"
+    _resetWriteTimeoutSQL = "SET SESSION net_write_timeout=DEFAULT"
+
+    def __init__(self, poolSize: int = DbConfig.PoolSize, checkoutTimeout: float = DbConfig.PoolTimeout):
+        self.poolSize = min(max(poolSize, 1), 64)  # mariadb.ConnectionPool maximum
+        self.checkoutTimeout = checkoutTimeout
+
+        self._pool = None
+        self._poolLock = threading.Lock()
+        self._available = threading.BoundedSemaphore(self.poolSize)
+        self._executor = None  # runAsync threads, one per pooled connection
 
         self._logger = logging.getLogger(__name__)
 
     def __del__(self):
-        self._disconnect()
+        self.close()
+
+    @property
+    def isConnected(self) -> bool:
+        return self._pool is not None
+
+    def _createPool(self):
+        """Wrapper for mariadb.ConnectionPool(). Handles config from settings.DbConfig. Opens all pool connections."""
+        with self._poolLock:
+            if self._pool is None:
+                self._pool = mariadb.ConnectionPool(
+                        pool_name=f"{__package__}-{id(self)}",
+                        pool_size=self.poolSize,
+                        pool_reset_connection=False,  # every checkout ends with commit or rollback
+                        autocommit=False,
+                        host=DbConfig.Host,
+                        port=DbConfig.Port,
+                        user=DbConfig.User,
+                        password=DbConfig.Password,
+                        database=DbConfig.Database
+                        )
+        return self._pool
+
+    def close(self):
+        """Closes all pool connections. Pool is recreated on next use."""
+        with self._poolLock:
+            if self._pool is not None:
+                self._pool.close()
+            self._pool = None
+
+    async def runAsync(self, function, *args):
+        """Awaits function(*args), a blocking call on this connector's pool, run on a thread per pooled connection.
+        mariadb's connector has no asyncio API: asyncio callers (the asgi app) wait for a free connection on the event
+        loop instead of each holding a thread, so only poolSize threads ever wait on the db."""
+        if self._executor is None:
+            with self._poolLock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self.poolSize, thread_name_prefix="db")
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    @contextmanager
+    def connection(self):
+        """Checks out a healthy pool connection for this thread, returns it to the pool afterwards."""
+        if not self._available.acquire(timeout=self.checkoutTimeout):
+            raise TimeoutError(f"No db connection available after {self.checkoutTimeout} seconds")
+
+        connection = None
+        try:
+            connection = (self._pool or self._createPool()).get_connection()
+
+            # health check -- reconnect dropped connections (db restart, wait_timeout)
+            try:
+                connection.ping()
+            except mariadb.Error:
+                self._logger.warning("Pooled db connection lost. Reconnecting...")
+                connection.reconnect()
+
+            yield connection
+        finally:
+            if connection is not None:
+                connection.close()  # returns connection to pool
+            self._available.release()
+
+    @contextmanager
+    def transaction(self):
+        """Checks out a pool connection for one transaction. Commits on success, rolls back on exception. Yields cursor."""
+        with self.connection() as connection:
+            cursor = connection.cursor()
+            try:
+                # autocommit is off, first statement starts the transaction (no extra BEGIN round trip)
+                yield cursor
+                connection.commit()
+            except Exception:
+                connection.rollback()
+                raise
+            finally:
+                cursor.close()
+
+    @timed(dbSeconds)
+    def testConnection(self):
+        """Test ability to connect to database, logging the result. Opens all pool connections. For command line
+        tools and tests -- the server checks the database with ping(), from the health prober (see health.py).
+        Returns True on success, False otherwise."""
+        try:
+            with self.connection():
+                pass
+            self._logger.info(f"Successfully connected to database with {self.poolSize} pooled connection(s)")
+            return True
+        except Exception as e:
+            self._logger.fatal(f"Test connection: Unable to connect to db: {e}")
+            return False
+
+    def ping(self):
+        """Health check: checks out (and pings) a pooled connection, opening the pool if needed. Raises on error."""
+        with self.connection():
+            pass
+
+    @timed(dbSeconds)
+    def addEventWithMessages(self, event):
+        """Inserts event, then all of its messages in one bulk insert, in one transaction on a pooled connection.
+        Takes dataTypes.Event instance (which may hold a list of dataTypes.Message instances).
+        Returns True on success, False otherwise (including when an event with the same fingerprint is stored)."""
+        try:
+            with self.transaction() as cursor:
+                # Reject duplicate (iMonnit retry)
+                if event.fingerprint is not None:
+                    cursor.execute(DbConnector._lockFingerprintSQL, (event.fingerprint,))
+                    if cursor.fetchone() is not None:
+                        raise ValueError(f"Event with fingerprint {event.fingerprint} is already stored")
 
-    def _connect(self):
-        """Wrapper for mariadb.connect().cursor(). Handles config from settings.DbConfig. Returns cursor."""
-        self._connection = mariadb.connect(
-                host=DbConfig.Host,
-                port=DbConfig.Port,
-                user=DbConfig.User,
-                password=DbConfig.Password,
-                database=DbConfig.Database
-                )
-        self.isConnected = True
+                # Add Event
+                cursor.execute(DbConnector._insertEventSQL, event.toSqlImport() + (event.fingerprint,))
+                id = cursor.lastrowid
 
-        self._cursor = self._connection.cursor()
-        self.hasCursor = True
+                if id is None:
+                    raise ValueError("id is None after inserting Event into db")
 
-        return self._cursor
+                event.setAllEventId(id)
 
-    def _disconnect(self):
-        if self.hasCursor and self._cursor:
-            self._cursor.close()
-        if self.isConnected and self._connection:
-            self._connection.close()
+                # Add Messages -- one bulk round trip for all recipients
+                messageImports = event.toSqlImportMessages()
+                if messageImports:
+                    cursor.executemany(DbConnector._insertMessageSQL, messageImports)
 
-        self.hasCursor = False
-        self.isConnected = False
+            self._logger.info(f"Added Event to db with id {id} and {len(messageImports)} Message(s)", extra=audit)
 
-    def testConnection(self):
-        """Test ability to connect/disconnect from database."""
-        """"Returns True on success, False otherwise."""
+        except Exception as e:
+            self._logger.error(f"Error adding Event with Messages to db: {e}")
+            return False
+
+        return True
+
+    @timed(dbSeconds)
+    def addMessages(self, eventId, messages):
+        """Inserts more messages for an existing event in one transaction on a pooled connection.
+        Takes Event id and list of dataTypes.Message instances. Returns True on success, False otherwise."""
         try:
-            self._connect()
-            self._disconnect()
-            self._logger.info("Successfully connected to database")
-            return True
+            for message in messages:
+                message.eventId = eventId
+
+            with self.transaction() as cursor:
+                if messages:
+                    cursor.executemany(DbConnector._insertMessageSQL, [message.toSqlImport() for message in messages])
+                    cursor.execute(DbConnector._addMessageNumberSQL, (len(messages), eventId))
+
+            self._logger.info(f"Added {len(messages)} Message(s) to db for Event with id {eventId}", extra=audit)
+
         except Exception as e:
-            self._logger.fatal(f"Test connection: Unable to connect to db: {e}")
+            self._logger.error(f"Error adding Messages to db: {e}")
             return False
 
-    def addEventWithMessages(self, event):
-        """Connects to DB, inserts event with messages, then disconnects from DB."""
-        """Takes dataTypes.Event instance (which may hold a list of dataTypes.Message instances)."""
-        """"Returns True on success, False otherwise."""
+        return True
+
+    @timed(dbSeconds)
+    def getEventByFingerprint(self, fingerprint):
+        """Finds a stored event by dataTypes.Event.fingerprint on a pooled connection.
+        Returns (Event id, list of its dataTypes.Message instances) if found, None if not found or on error."""
         try:
-            if not self.isConnected:
-                self._connect()
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._getEventByFingerprintSQL, (fingerprint,))
+                rows = cursor.fetchall()
 
-            self._connection.begin()
+            if not rows:
+                return None
 
-            # Add Event
-            self._cursor.execute(DbConnector._insertEventSQL, event.toSqlImport())
-            id = self._cursor.lastrowid
+            # first stored event only, if duplicates were stored before the fingerprint lock
+            eventId = rows[0][0]
+            messages = [Message(id=id, eventId=eventId, recipient=recipient, messageId=messageId, status=status)
+                        for rowEventId, id, recipient, messageId, status in rows if rowEventId == eventId and id is not None]
+            return (eventId, messages)
 
-            if id is None:
-                raise ValueError("id is None after inserting Event into db")
+        except Exception as e:
+            self._logger.error(f"Error finding Event by fingerprint: {e}")
+            return None
+
+    @timed(dbSeconds)
+    def requeueFailedMessages(self, eventId):
+        """Sets failed, never created messages of an event back to pending for the outbox, on a pooled connection.
+        Returns number of requeued messages, None on error."""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._requeueFailedMessagesSQL, (datetime.now(), eventId))
+                count = cursor.rowcount
 
-            event.setAllEventId(id)
+            self._logger.info(f"Requeued {count} failed Message(s) for Event with id {eventId}", extra=audit)
 
-            # Add Messages
-            messageIds = []
-            for messageImport in event.toSqlImportMessages():
-                self._cursor.execute(DbConnector._insertMessageSQL, messageImport)
-                messageIds.append(self._cursor.lastrowid)
+        except Exception as e:
+            self._logger.error(f"Error requeueing failed messages: {e}")
+            return None
+
+        return count
+
+    @timed(dbSeconds)
+    def updateMessage(self, message):
+        """Updates one message matching message.messageId on a pooled connection, unless its stored status is later.
+        Takes dataTypes.Message instance. Returns True on success, False otherwise."""
+        try:
+            with self.transaction() as cursor:
+                # get id for logging and test for errors
+                cursor.execute(DbConnector._getMessageSQL, (message.messageId,))
+                id = cursor.fetchone()
+                if id is None:
+                    raise ValueError("No Message matches MessageId in db for update")
+                id = id[0]
 
-            self._connection.commit()
+                # Update message
+                # message.messageId is valid or the following will raise ValueError
+                cursor.execute(DbConnector._updateMessageSQL, message.toSqlUpdate() + (message.status,))
 
-            self._logger.info(f"Added Event to db with id {id}")
-            for messageId in messageIds:
-                self._logger.info(f"Added Message to db with id {messageId}")
+            self._logger.info(f"Updated Message in db with id {id}", extra=audit)
 
         except Exception as e:
-            self._connection.rollback()
-            self._logger.error(f"Error adding Event with Messages to db: {e}")
+            self._logger.error(f"Error updating message: {e}")
             return False
 
-        self._disconnect()
         return True
 
-    def updateMessage(self, message):
-        """Connects to DB, updates one message matching message.messageId, then disconnects from DB."""
-        """Takes dataTypes.Message instance. Returns True on success, False otherwise."""
+    @timed(dbSeconds)
+    def updateMessages(self, messages):
+        """Updates a batch of messages matching message.messageId in one transaction on a pooled connection.
+        Messages whose stored status is later than the update (out of order callbacks across batches) are kept.
+        Takes list of dataTypes.Message instances with unique messageIds.
+        Returns set of messageIds with no matching Message in db (not updated). Returns None on error."""
+        try:
+            with self.transaction() as cursor:
+                messageIds = [message.messageId for message in messages]
+                cursor.execute(DbConnector._getMessageIdsSQL.format(",".join("?" * len(messageIds))), tuple(messageIds))
+                found = {row[0] for row in cursor.fetchall()}
+
+                # message.messageId is valid or the following will raise ValueError
+                updates = [message.toSqlUpdate() + (message.status,) for message in messages if message.messageId in found]
+                if updates:
+                    cursor.executemany(DbConnector._updateMessageSQL, updates)
+
+            unmatched = set(messageIds) - found
+            self._logger.info(f"Updated {len(updates)} Message(s) in db, {len(unmatched)} without matching MessageId", extra=audit)
+
+        except Exception as e:
+            self._logger.error(f"Error updating messages: {e}")
+            return None
+
+        return unmatched
+
+    @timed(dbSeconds)
+    def countOutboxMessages(self):
+        """Returns number of stored messages waiting to be sent (pending or retrying), None on error."""
         try:
-            if not self.isConnected:
-                self._connect()
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._countOutboxMessagesSQL)
+                return cursor.fetchone()[0]
 
-            self._connection.begin()
+        except Exception as e:
+            self._logger.error(f"Error counting outbox messages: {e}")
+            return None
+
+    @timed(dbSeconds)
+    def claimPendingMessages(self, limit, leaseCutoff):
+        """Claims up to limit pending outbox messages on a pooled connection.
+        Retrying messages are claimed once their NextAttempt is due.
+        Messages left "sending" without a Twilio MessageId since before leaseCutoff (datetime) are reclaimed.
+        Returns list of (dataTypes.Message, body) with Message.status = "sending". Returns None on error."""
+        try:
+            claimed = []
+            with self.transaction() as cursor:
+                # lock rows, other workers skip them
+                now = datetime.now()
+                ids = []
+                for sql, params in zip(DbConnector._claimMessagesSQLs, ((), (now,), (leaseCutoff,))):
+                    if len(ids) >= limit:
+                        break
+                    cursor.execute(sql, params + (limit - len(ids),))
+                    ids += [row[0] for row in cursor.fetchall()]
+
+                if ids:
+                    cursor.executemany(DbConnector._markMessageSendingSQL, [(now, id) for id in ids])
+
+                    # rebuild message body from parent event
+                    cursor.execute(DbConnector._getOutboxMessagesSQL.format(",".join("?" * len(ids))), tuple(ids))
+                    for id, eventId, recipient, attempts, rule, deviceId, device, reading, triggeredDT, ackUrl in cursor.fetchall():
+                        event = Event(rule=rule,
+                                      deviceID=deviceId,
+                                      name=device,
+                                      reading=reading,
+                                      triggeredDT=triggeredDT,
+                                      acknowledgeURL=ackUrl)
+                        claimed.append((Message(id=id,
+                                                eventId=eventId,
+                                                recipient=recipient,
+                                                status="sending",
+                                                attempts=attempts,
+                                                updated=now),
+                                        event.messageBody))
+
+            if claimed:
+                self._logger.info(f"Claimed {len(claimed)} outbox Message(s)")
 
-            # get id for logging and test for errors
-            self._cursor.execute(DbConnector._getMessageSQL, (message.messageId,))
-            id = self._cursor.fetchone()
-            if id is None:
-                raise ValueError("No Message matches MessageId in db for update")
-            id = id[0]
+        except Exception as e:
+            self._logger.error(f"Error claiming outbox messages: {e}")
+            return None
 
-            # Update message
-            # message.messageId is valid or the following will raise ValueError
-            self._cursor.execute(DbConnector._updateMessageSQL, message.toSqlUpdate())
+        return claimed
 
-            self._connection.commit()
+    @timed(dbSeconds)
+    def updateMessageById(self, message):
+        """Updates send result of one message matching message.id on a pooled connection.
+        Takes dataTypes.Message instance. Returns True on success, False otherwise."""
+        try:
+            with self.transaction() as cursor:
+                # message.id is valid or the following will raise ValueError
+                cursor.execute(DbConnector._updateMessageByIdSQL, message.toSqlUpdateById())
 
-            self._logger.info(f"Updated Message in db with id {id}")
+            self._logger.info(f"Updated Message in db with id {message.id}", extra=audit)
 
         except Exception as e:
-            self._connection.rollback()
             self._logger.error(f"Error updating message: {e}")
             return False
 
-        self._disconnect()
         return True
 
+    @timed(dbSeconds)
+    def getRoutes(self):
+        """Reads all recipient routes on a pooled connection. NULL fields match any.
+        Returns list of (AccountId, NetworkId, DeviceId, Rule, Recipients csv), None on error."""
+        try:
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._getRoutesSQL)
+                return cursor.fetchall()
+
+        except Exception as e:
+            self._logger.error(f"Error reading routes: {e}")
+            return None
+
+    @staticmethod
+    def _where(conditions, filters):
+        """Returns (" WHERE ..." sql, params) for filters with a value, in conditions order."""
+        used = [name for name in conditions if filters.get(name) is not None]
+        if not used:
+            return ("", ())
+        return (" WHERE " + " AND ".join(conditions[name] for name in used), tuple(filters[name] for name in used))
+
+    @timed(dbSeconds)
+    def getEvents(self, filters, limit):
+        """Reads one page of events, newest first, on a pooled connection. filters: eventFilters name: value (None ignored).
+        Returns list of rows in eventColumns order, None on error."""
+        try:
+            where, params = DbConnector._where(DbConnector.eventFilters, filters)
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._getEventsSQL.format(where), params + (limit,))
+                return cursor.fetchall()
+
+        except Exception as e:
+            self._logger.error(f"Error reading events: {e}")
+            return None
+
+    @timed(dbSeconds)
+    def getMessages(self, filters, limit):
+        """Reads one page of messages, newest first, on a pooled connection. filters: messageFilters name: value (None ignored).
+        Returns list of rows in messageColumns order, None on error."""
+        try:
+            where, params = DbConnector._where(DbConnector.messageFilters, filters)
+            if any(filters.get(name) is not None for name in DbConnector._messageEventFilters):
+                where = " JOIN Event e ON e.Id=m.EventId" + where
+            with self.transaction() as cursor:
+                cursor.execute(DbConnector._getMessagesSQL.format(where), params + (limit,))
+                return cursor.fetchall()
+
+        except Exception as e:
+            self._logger.error(f"Error reading messages: {e}")
+            return None
+
+    def streamHistory(self, filters, batchSize=1000, writeTimeout=600):
+        """Runs the event and message history query on a pooled connection, with an unbuffered cursor. Rows are read
+        from the server as batches are consumed, so memory stays flat for any result size. filters: exportFilters
+        name: value. Returns HistoryStream of lists of at most batchSize rows in eventColumns + messageColumns
+        order, which holds the connection until exhausted or closed. Raises on error."""
+        where, params = DbConnector._where(DbConnector.exportFilters, filters)
+        return HistoryStream(self, DbConnector._exportHistorySQL.format(where), params, batchSize, writeTimeout)
+
+
+class HistoryStream:
+    """Iterator of history batches, see DbConnector.streamHistory. The connection is checked out and the query run
+    on creation, and returned to the pool by close(). close() may be called more than once, and is called when
+    the stream is exhausted or garbage collected, so an abandoned export never keeps its pool slot."""
+    def __init__(self, dbConn, query, params, batchSize, writeTimeout):
+        self.batchSize = batchSize
+        self._cursor = None
+        self._resources = ExitStack()
+        try:
+            connection = self._resources.enter_context(dbConn.connection())
+            self._resources.callback(HistoryStream._reset, connection)
+            self._cursor = connection.cursor(buffered=False)
+            self._resources.callback(self._cursor.close)  # discards unread rows of an abandoned export
+            # a slow export client stalls reading, not the db server writing to us
+            self._cursor.execute(DbConnector._setWriteTimeoutSQL, (writeTimeout,))
+            self._cursor.execute(query, params)
+        except BaseException:
+            self.close()
+            raise
+
+    @staticmethod
+    def _reset(connection):
+        connection.rollback()  # read only
+        cursor = connection.cursor()
+        try:
+            cursor.execute(DbConnector._resetWriteTimeoutSQL)
+        finally:
+            cursor.close()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._cursor is None:
+            raise StopIteration
+        try:
+            rows = self._cursor.fetchmany(self.batchSize)
+        except BaseException:
+            self.close()
+            raise
+        if not rows:
+            self.close()
+            raise StopIteration
+        return rows
+
+    def close(self):
+        self._cursor = None
+        self._resources.close()  # cursor, then connection state, then pool slot, once
+
+    def __del__(self):
+        self.close()
+
 
 if __name__ == "__main__":
     connector = DbConnector()
     if not connector.testConnection():
         sys.exit(2)
 
-    # test data
+    # test data -- rule is unique per test run, Event.fingerprint must be unique in db
     testEventDT = datetime(2022, 4, 28, 14, 21)
     testInputEvent = {
         "subject": "Battery below 50%!",
         "reading": "Battery: 10%",
-        "rule": "Battery below 50%",
+        "rule": f"Battery below 50% (test {datetime.now().isoformat()})",
         "date": "2022-4-28",
         "time": "14:21",
         "readingDate": "2022-4-28",
@@ -173,7 +597,7 @@ if __name__ == "__main__":
     TestEvent = Event(**testInputEvent)
 
     # event with no messages
-    assert connector.addEventWithMessages(TestEvent)
+    assert connector.addEventWithMessages(Event(**(testInputEvent | {"time": "14:20"})))
 
     TestEvent.messages.append(Message(recipient="+11234567890",
                                       messageId="SM0123456789abcdefghijklmnopqrstuv",
@@ -197,6 +621,17 @@ if __name__ == "__main__":
     # event with messages
     assert connector.addEventWithMessages(TestEvent)
 
+    # duplicate event (iMonnit retry) is rejected, and found by fingerprint
+    assert not connector.addEventWithMessages(Event(**testInputEvent))
+    eventId, storedMessages = connector.getEventByFingerprint(TestEvent.fingerprint)
+    assert eventId == TestEvent.id
+    assert [m.recipient for m in storedMessages] == ["+11234567890", "+11234567891", "+11234567892"]
+    assert connector.getEventByFingerprint("0" * 64) is None
+
+    # retry: add messages to existing event, requeue failed message for outbox
+    assert connector.addMessages(eventId, [Message(recipient="+11234567893", status="pending")])
+    assert connector.requeueFailedMessages(eventId) == 1
+
     # update message that doesn't exist
     failedReturn = connector.updateMessage(Message(recipient="+11234567890",
                                                    messageId="SM0123456789abcdefghijklm-nonexist",
@@ -211,7 +646,7 @@ if __name__ == "__main__":
                           status="queued",
                           errorCode=None,
                           errorMessage=None)
-    TestEvent2 = Event(**testInputEvent)
+    TestEvent2 = Event(**(testInputEvent | {"time": "14:22"}))
     TestEvent2.subject = "update message unique tests"
     TestEvent2.messages.append(TestMessage)
     assert connector.addEventWithMessages(TestEvent2)
@@ -226,3 +661,91 @@ if __name__ == "__main__":
     TestMessage.messageId = "SM0123456789abcdefghijklmnopqrstuv"
     TestMessage.errorMessage = "test update multiple..."
     assert connector.updateMessage(TestMessage)
+
+    # out of order callbacks in separate flushes -- a late "sent" never replaces "delivered"
+    TestMessage.messageId = "SM0123456789abcdefghijklmn-ordered"
+    TestEvent3 = Event(**(testInputEvent | {"time": "14:23"}))
+    TestEvent3.subject = "update message order tests"
+    TestEvent3.messages = [Message(recipient="+11234567890", messageId=TestMessage.messageId, status="queued")]
+    assert connector.addEventWithMessages(TestEvent3)
+    assert connector.updateMessages([Message(recipient="+11234567890", messageId=TestMessage.messageId,
+                                             status="delivered", deliveredDT=testEventDT)]) == set()
+    assert connector.updateMessages([Message(recipient="+11234567890", messageId=TestMessage.messageId,
+                                             status="sent", sentDT=testEventDT)]) == set()
+    with connector.transaction() as cursor:
+        cursor.execute("SELECT Status, DeliveredDT FROM Message WHERE MessageId=?", (TestMessage.messageId,))
+        assert cursor.fetchone() == ("delivered", testEventDT)
+
+    # concurrent use -- more threads than pooled connections
+    def addConcurrentEvent(results, i):
+        event = Event(**(testInputEvent | {"deviceID": str(i + 1)}))
+        event.subject = f"concurrent pool test {i}"
+        results[i] = connector.addEventWithMessages(event)
+
+    concurrentResults = [False] * (connector.poolSize * 3)
+    threads = [threading.Thread(target=addConcurrentEvent, args=(concurrentResults, i)) for i in range(len(concurrentResults))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert all(concurrentResults)
+
+    # concurrent duplicates (iMonnit retries racing) -- exactly one is stored, with or without a unique Fingerprint
+    def addDuplicateEvent(results, i):
+        results[i] = connector.addEventWithMessages(Event(**(testInputEvent | {"deviceID": "concurrent duplicate"})))
+
+    duplicateResults = [False] * connector.poolSize
+    threads = [threading.Thread(target=addDuplicateEvent, args=(duplicateResults, i)) for i in range(len(duplicateResults))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert duplicateResults.count(True) == 1
+
+    # history pages -- pages never overlap, and end with an empty page
+    firstPage = connector.getEvents({"rule": TestEvent.rule}, 1)
+    assert len(firstPage) == 1
+    secondPage = connector.getEvents({"rule": TestEvent.rule, "before": firstPage[0][0]}, 100)
+    assert secondPage and all(row[0] < firstPage[0][0] for row in secondPage)
+    assert connector.getEvents({"rule": TestEvent.rule, "before": secondPage[-1][0]}, 100) == []
+    assert [row[3] for row in connector.getMessages({"eventId": eventId}, 100)] == ["+11234567893", "+11234567892",
+                                                                                    "+11234567891", "+11234567890"]
+    assert all(row[4] == "pending" for row in connector.getMessages({"rule": TestEvent.rule, "status": "pending"}, 100))
+
+    # history export -- every event of the rule, each message on its own row, batched
+    exported = [row for batch in connector.streamHistory({"rule": TestEvent.rule}, batchSize=2) for row in batch]
+    eventCount = len(DbConnector.eventColumns)
+    assert [row[eventCount + 3] for row in exported if row[0] == eventId] == ["+11234567890", "+11234567891",
+                                                                              "+11234567892", "+11234567893"]
+    assert [row[0] for row in exported] == sorted(row[0] for row in exported)
+
+    # aborted export (client went away), closed or abandoned -- its pool slot is returned either way
+    def freeSlots():
+        slots = [connector._available.acquire(blocking=False) for _ in range(connector.poolSize)]
+        for _ in range(sum(slots)):
+            connector._available.release()
+        return sum(slots)
+
+    abortedExport = connector.streamHistory({"rule": TestEvent.rule}, batchSize=1)
+    assert len(next(abortedExport)) == 1 and freeSlots() == connector.poolSize - 1
+    abortedExport.close()
+    assert freeSlots() == connector.poolSize and next(abortedExport, None) is None
+    abortedExport = connector.streamHistory({"rule": TestEvent.rule}, batchSize=1)
+    next(abortedExport)
+    del abortedExport
+    assert freeSlots() == connector.poolSize
+
+    # outbox claims -- pending messages once, expired claims again, but never a message Twilio already has
+    TestEvent4 = Event(**(testInputEvent | {"deviceID": "outbox claim"}))
+    TestEvent4.messages = [Message(recipient="+11234567890", status="pending"),
+                           Message(recipient="+11234567891", messageId="SM0123456789abcdefghijklmn-claim", status="sending")]
+    assert connector.addEventWithMessages(TestEvent4)
+    claimedRecipients = [message.recipient for message, _ in connector.claimPendingMessages(1000, datetime.now() - timedelta(days=1))
+                         if message.eventId == TestEvent4.id]
+    assert claimedRecipients == ["+11234567890"]
+    assert not [message for message, _ in connector.claimPendingMessages(1000, datetime.now() - timedelta(days=1))
+                if message.eventId == TestEvent4.id]  # claimed, lease not expired
+    claimedRecipients = [message.recipient for message, _ in connector.claimPendingMessages(1000, datetime.now() + timedelta(days=1))
+                         if message.eventId == TestEvent4.id]
+    assert claimedRecipients == ["+11234567890"]  # lease expired, sent message still not reclaimed
+    assert isinstance(connector.countOutboxMessages(), int)
@@ -0,0 +1,136 @@
+# dedup.py
+# By: Ethan Jansen
+# Idempotent iMonnit ingestion.
+# iMonnit retries events it did not get a 200 for. Retries are recognized by Event.fingerprint, first in an
+# in-process LRU cache with TTL, then by DbConnector.addEventWithMessages, which checks Event.Fingerprint with a
+# locking read in db (the index is not unique once history is partitioned).
+
+from collections import OrderedDict
+import logging
+import threading
+from time import monotonic
+from typing import List
+from .dataTypes import Event, Message
+from .db import DbConnector
+from .settings import ImonnitTwilioConnectorConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class DedupEntry:
+    def __init__(self, eventId: int | None, messages: List[Message]):
+        self.eventId = eventId  # None if sent, but not stored in db
+        self.messages = messages  # messages already sent or waiting in the outbox
+
+    def unsentRecipients(self, recipients: List[str]) -> List[str]:
+        """Returns recipients without a successful (or pending) message, in recipient order."""
+        done = {message.recipient for message in self.messages}
+        return [recipient for recipient in recipients if recipient not in done]
+
+
+class EventDeduplicator:
+    def __init__(self,
+                 dbConn: DbConnector,
+                 maxSize: int = ImonnitTwilioConnectorConfig.DedupCacheSize,
+                 ttl: float = ImonnitTwilioConnectorConfig.DedupTTL):
+        self._dbConn = dbConn
+        self.maxSize = max(maxSize, 0)
+        self.ttl = ttl
+
+        self._cache = OrderedDict()  # fingerprint: (expiry, DedupEntry)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _succeeded(message: Message) -> bool:
+        # created by Twilio, or not yet sent (or retried) by the outbox
+        return message.messageId is not None or message.status in ("pending", "sending", "retrying")
+
+    def lookup(self, event: Event) -> DedupEntry | None:
+        """Returns DedupEntry if event was received before, None if it is new (or has no fingerprint)."""
+        fingerprint = event.fingerprint
+        if fingerprint is None:
+            return None
+
+        with self._lock:
+            cached = self._cache.get(fingerprint)
+            if cached is not None:
+                if cached[0] > monotonic():
+                    self._cache.move_to_end(fingerprint)
+                    return cached[1]
+                del self._cache[fingerprint]
+
+        stored = self._dbConn.getEventByFingerprint(fingerprint)
+        if stored is None:
+            return None
+
+        eventId, messages = stored
+        entry = DedupEntry(eventId, [message for message in messages if EventDeduplicator._succeeded(message)])
+        self._put(fingerprint, entry)
+        return entry
+
+    def record(self, event: Event, eventId: int | None = None, previous: DedupEntry | None = None) -> None:
+        """Remembers event's successful messages (added to previous attempts), and its db id once stored."""
+        fingerprint = event.fingerprint
+        if fingerprint is None:
+            return
+
+        messages = [message for message in event.messages if EventDeduplicator._succeeded(message)]
+        if previous is not None:
+            messages = previous.messages + messages
+            eventId = eventId or previous.eventId
+        self._put(fingerprint, DedupEntry(eventId, messages))
+
+    def _put(self, fingerprint: str, entry: DedupEntry) -> None:
+        if not self.maxSize:
+            return
+
+        with self._lock:
+            self._cache[fingerprint] = (monotonic() + self.ttl, entry)
+            self._cache.move_to_end(fingerprint)
+            while len(self._cache) > self.maxSize:
+                self._cache.popitem(last=False)
+
+
+if __name__ == "__main__":
+    # testing - no db required
+    class _TestDb:
+        def __init__(self):
+            self.stored = {}
+
+        def getEventByFingerprint(self, fingerprint):
+            return self.stored.get(fingerprint)
+
+    TestDb = _TestDb()
+    TestDedup = EventDeduplicator(TestDb, maxSize=2, ttl=60)
+    recipients = ["+11234567890", "+11234567891", "+11234567892"]
+
+    TestEvent = Event(rule="rule", deviceID="1", date="2025-03-28", time="14:25")
+    assert TestDedup.lookup(TestEvent) is None
+
+    # first attempt: one sent, one failed, db insert failed
+    TestEvent.messages = [Message(recipient=recipients[0], messageId="SM0123456789abcdefghijklmnopqrstuv", status="queued"),
+                          Message(recipient=recipients[1], status="failed", errorCode=429)]
+    TestDedup.record(TestEvent)
+    retry = TestDedup.lookup(Event(rule="rule", deviceID="1", date="2025-03-28", time="14:25"))
+    assert retry.eventId is None
+    assert retry.unsentRecipients(recipients) == recipients[1:]
+
+    # second attempt: stored in db
+    TestEvent.messages = [Message(recipient=recipients[1], messageId="SM0123456789abcdefghijklmnopqrstuw", status="queued")]
+    TestDedup.record(TestEvent, 5, previous=retry)
+    retry = TestDedup.lookup(TestEvent)
+    assert retry.eventId == 5
+    assert retry.unsentRecipients(recipients) == recipients[2:]
+
+    # lru eviction falls back to db
+    for i in range(2):
+        OtherEvent = Event(rule="other", deviceID=str(i), date="2025-03-28", time="14:25")
+        TestDedup.record(OtherEvent, i + 10)
+    assert TestDedup.lookup(TestEvent) is None
+    TestDb.stored[TestEvent.fingerprint] = (5, [Message(recipient=recipients[0], status="pending"),
+                                                Message(recipient=recipients[1], status="failed")])
+    assert TestDedup.lookup(TestEvent).unsentRecipients(recipients) == recipients[1:]
+
+    # no fingerprint, never deduplicated
+    assert TestDedup.lookup(Event(rule="rule")) is None
@@ -0,0 +1,139 @@
+# export.py
+# By: Ethan Jansen
+# Streaming export of Event and Message history, as NDJSON (one event per line, with its messages) or CSV (one message
+# per row, event columns repeated). Rows flow from an unbuffered db cursor through generators into output chunks, so
+# memory stays flat however many years are exported. Fields follow the column layout of DbConnector.eventColumns and
+# DbConnector.messageColumns (Event.toSqlImport and Message.toSqlImport, between Id and Created).
+# Served at /api/export, or run manually with: python -m iMonnitTwilioConnector.export --help
+
+import csv
+from datetime import datetime
+from io import StringIO
+from itertools import groupby
+from json import dumps as jsonDumps
+from typing import Iterable, Iterator, List
+import zlib
+from .dataTypes import jsonValue
+from .db import DbConnector
+
+
+formats = {"ndjson": "application/x-ndjson", "csv": "text/csv; charset=utf-8"}
+chunkSize = 64 * 1024  # bytes of output per yielded chunk (before compression)
+
+_eventKeys = [key for _, key in DbConnector.eventColumns]
+_messageKeys = [key for _, key in DbConnector.messageColumns]
+csvHeader = ["event." + key for key in _eventKeys] + ["message." + key for key in _messageKeys]
+
+
+def _rows(batches: Iterable[List[tuple]]) -> Iterator[tuple]:
+    for batch in batches:
+        yield from batch
+
+
+def ndjsonLines(batches: Iterable[List[tuple]]) -> Iterator[str]:
+    """Yields one json line per event: its eventColumns fields, plus "messages" (empty list if it has none)."""
+    eventCount = len(_eventKeys)
+    for _, rows in groupby(_rows(batches), key=lambda row: row[0]):
+        messages = []
+        for row in rows:
+            if row[eventCount] is not None:  # LEFT JOIN: event without messages
+                messages.append({key: jsonValue(value) for key, value in zip(_messageKeys, row[eventCount:])})
+        event = {key: jsonValue(value) for key, value in zip(_eventKeys, row)}
+        event["messages"] = messages
+        yield jsonDumps(event) + "\n"
+
+
+def csvLines(batches: Iterable[List[tuple]]) -> Iterator[str]:
+    """Yields the csvHeader line, then one line per message (or event without messages)."""
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(csvHeader)
+    for batch in batches:
+        writer.writerows(["" if value is None else jsonValue(value) for value in row] for row in batch)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()  # header of an empty export
+
+
+def chunks(lines: Iterable[str], size: int = chunkSize) -> Iterator[bytes]:
+    """Joins lines into utf-8 chunks of about size bytes."""
+    pending, pendingSize = [], 0
+    for line in lines:
+        pending.append(line)
+        pendingSize += len(line)
+        if pendingSize >= size:
+            yield "".join(pending).encode()
+            pending, pendingSize = [], 0
+    if pending:
+        yield "".join(pending).encode()
+
+
+def gzipped(data: Iterable[bytes]) -> Iterator[bytes]:
+    """Compresses a stream of chunks into one gzip stream."""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31: gzip header and trailer
+    for chunk in data:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def encode(batches: Iterable[List[tuple]], format: str = "ndjson", compress: bool = False) -> Iterator[bytes]:
+    """Returns a generator of output chunks of history batches (from DbConnector.streamHistory)."""
+    lines = ndjsonLines(batches) if format == "ndjson" else csvLines(batches)
+    output = chunks(lines)
+    return gzipped(output) if compress else output
+
+
+if __name__ == "__main__":
+    import argparse
+    import gzip
+    import sys
+
+    # testing - no db required
+    eventCount = len(_eventKeys)
+    created = datetime(2025, 3, 28, 14, 25)
+
+    def testRow(eventId, messageId=None, recipient=None):
+        event = (eventId, "rule") + (None,) * (eventCount - 3) + (created,)
+        if messageId is None:
+            return event + (None,) * len(_messageKeys)
+        return event + (messageId, eventId, None, recipient, "delivered") + (None,) * (len(_messageKeys) - 5)
+
+    testBatches = [[testRow(1, 1, "+11234567890"), testRow(1, 2, "+11234567891")], [testRow(2)], [testRow(3, 3, "+11234567890")]]
+    lines = list(ndjsonLines(testBatches))
+    assert len(lines) == 3
+    assert '"recipient": "+11234567891"' in lines[0] and '"messages": []' in lines[1]
+    assert '"created": "2025-03-28T14:25:00"' in lines[2]
+
+    text = b"".join(encode(testBatches, "csv")).decode()
+    assert text.splitlines()[0].startswith("event.id,event.rule,")
+    assert len(text.splitlines()) == 5
+    assert b"".join(encode([], "csv")).decode().splitlines() == [",".join(csvHeader)]
+
+    # compressed output decompresses to the same stream, chunks bounded by size
+    assert gzip.decompress(b"".join(encode(testBatches, "ndjson", compress=True))) == "".join(lines).encode()
+    assert [len(chunk) for chunk in chunks(["a" * 3] * 5, size=6)] == [6, 6, 3]
+
+    parser = argparse.ArgumentParser(prog="python -m iMonnitTwilioConnector.export",
+                                     description="Export Event and Message history, oldest first.")
+    parser.add_argument("--format", choices=formats, default="ndjson")
+    parser.add_argument("--gzip", action="store_true", help="gzip compress output")
+    parser.add_argument("--output", help="output file, stdout if unset")
+    for name in DbConnector.exportFilters:
+        parser.add_argument(f"--{name}", help="ISO datetime of Created" if name in ("since", "until") else None)
+    args = parser.parse_args()
+
+    filters = {name: getattr(args, name) for name in DbConnector.exportFilters}
+    for name in ("since", "until"):
+        if filters[name] is not None:
+            filters[name] = datetime.fromisoformat(filters[name])
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for chunk in encode(DbConnector(poolSize=1).streamHistory(filters), args.format, args.gzip):
+            output.write(chunk)
+    finally:
+        if args.output:
+            output.close()
@@ -0,0 +1,188 @@
+# health.py
+# By: Ethan Jansen
+# Liveness and readiness probes. No authorization, responses only hold statuses and timestamps.
+# liveness: GET /healthz -- 200 while the process and its dependency prober are running
+# readiness: GET /readyz -- 200 once startup is complete and every required dependency is reachable, 503 otherwise
+# A background prober checks each dependency (db, Twilio) on its own interval and caches the result, so probe requests
+# are dictionary reads and never open connections of their own.
+
+from datetime import datetime
+from flask import Blueprint
+from json import dumps as jsonDumps
+import logging
+import threading
+from time import monotonic
+from typing import Callable, Dict, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+class DependencyStatus:
+    def __init__(self, check: Callable[[], object], interval: float, required: bool):
+        self.check = check  # raises (or returns False) when the dependency is unreachable
+        self.interval = interval  # seconds between checks
+        self.required = required  # required for readiness
+        self.ok = False
+        self.checked = None  # datetime of the last check
+        self.changed = None  # datetime ok last changed
+        self.nextCheck = 0.0  # clock time
+        self.up = threading.Event()  # set while ok
+
+
+class HealthProber:
+    def __init__(self, clock: Callable[[], float] = monotonic):
+        self._clock = clock
+        self._dependencies: Dict[str, DependencyStatus] = {}
+        self._lock = threading.Lock()
+
+        self.started = False  # startup (migrations, routes, background workers) complete
+        self._lastLoop = None  # clock time of the prober's last loop
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def addProbe(self, name: str, check: Callable[[], object], interval: float, required: bool = True) -> None:
+        self._dependencies[name] = DependencyStatus(check, max(interval, 1), required)
+
+    def start(self) -> None:
+        if self._thread and self._thread.is_alive():
+            return
+
+        self._stopping.clear()
+        self._lastLoop = self._clock()
+        self._thread = threading.Thread(target=self._run, name="healthProber", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float | None = 5) -> None:
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self.probe()
+            now = self._clock()
+            self._lastLoop = now
+            wait = min((dependency.nextCheck for dependency in self._dependencies.values()), default=now + 5) - now
+            self._stopping.wait(max(wait, 0.1))
+
+    def probe(self) -> None:
+        """Checks every dependency that is due."""
+        for name, dependency in self._dependencies.items():
+            if dependency.nextCheck > self._clock():
+                continue
+            try:
+                ok = dependency.check() is not False
+            except Exception as e:
+                ok = False
+                if dependency.ok or dependency.checked is None:
+                    logger.error(f"Health check: {name} is unreachable: {e}")
+
+            now = datetime.now()
+            with self._lock:
+                if ok != dependency.ok or dependency.checked is None:
+                    dependency.changed = now
+                    if ok:
+                        logger.info(f"Health check: {name} is reachable")
+                dependency.ok = ok
+                dependency.checked = now
+                dependency.nextCheck = self._clock() + dependency.interval
+            if ok:
+                dependency.up.set()
+            else:
+                dependency.up.clear()
+
+    def waitFor(self, name: str, timeout: float | None = None) -> bool:
+        """Blocks until dependency name is reachable. Returns False on timeout."""
+        return self._dependencies[name].up.wait(timeout)
+
+    @property
+    def alive(self) -> bool:
+        """True while the prober runs and is not stuck in a check (3 intervals of its slowest dependency)."""
+        if self._thread is None or not self._thread.is_alive():
+            return False
+        limit = 3 * max((dependency.interval for dependency in self._dependencies.values()), default=5)
+        return self._clock() - self._lastLoop < limit
+
+    @property
+    def ready(self) -> bool:
+        return self.started and all(dependency.ok for dependency in self._dependencies.values() if dependency.required)
+
+    def status(self) -> Dict:
+        with self._lock:
+            dependencies = {name: {"ok": dependency.ok,
+                                   "required": dependency.required,
+                                   "checked": dependency.checked.isoformat() if dependency.checked else None,
+                                   "since": dependency.changed.isoformat() if dependency.changed else None}
+                            for name, dependency in self._dependencies.items()}
+        return {"started": self.started, "dependencies": dependencies}
+
+
+# dependencies are added at startup, see startServices
+prober = HealthProber()
+
+
+# create blueprint
+healthBp = Blueprint("health", __name__)
+_jsonHeaders = {"Content-Type": "application/json"}
+
+
+# Routes
+@healthBp.get("/healthz")
+def healthz():
+    return handleHealthz()
+
+
+@healthBp.get("/readyz")
+def readyz():
+    return handleReadyz()
+
+
+# Handlers -- shared by flask routes and the asgi app. Return (body, status, headers).
+def handleHealthz() -> Tuple:
+    alive = prober.alive
+    return (jsonDumps({"status": "alive" if alive else "prober stopped"}), 200 if alive else 503, _jsonHeaders)
+
+
+def handleReadyz() -> Tuple:
+    ready = prober.ready
+    return (jsonDumps({"status": "ready" if ready else "not ready"} | prober.status()), 200 if ready else 503,
+            _jsonHeaders)
+
+
+if __name__ == "__main__":
+    # testing - no db or Twilio required
+    now = [0.0]
+    dbUp = [False]
+
+    def checkDb():
+        if not dbUp[0]:
+            raise ConnectionError("db down")
+
+    TestProber = HealthProber(clock=lambda: now[0])
+    TestProber.addProbe("db", checkDb, interval=5)
+    TestProber.addProbe("twilio", lambda: True, interval=60, required=False)
+
+    TestProber.probe()
+    assert not TestProber.ready and not TestProber.waitFor("db", 0)
+    assert TestProber.status()["dependencies"]["twilio"]["ok"]
+
+    # db comes up: checked on its own interval, ready once started
+    dbUp[0] = True
+    TestProber.probe()
+    assert not TestProber.status()["dependencies"]["db"]["ok"]  # not due yet
+    now[0] = 5
+    TestProber.probe()
+    assert TestProber.waitFor("db", 0) and not TestProber.ready
+    TestProber.started = True
+    assert TestProber.ready
+
+    # optional dependency down: still ready
+    TestProber._dependencies["twilio"].check = lambda: False
+    now[0] = 60
+    TestProber.probe()
+    assert not TestProber.status()["dependencies"]["twilio"]["ok"] and TestProber.ready
+
+    # not running
+    assert not TestProber.alive
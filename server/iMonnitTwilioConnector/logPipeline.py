@@ -0,0 +1,158 @@
+# logPipeline.py
+# By: Ethan Jansen
+# Non-blocking logging. Request threads only put records on a queue (QueueHandler). One listener thread formats them
+# (text or json lines) and writes them out, so slow log output never delays webhooks.
+# Repeated messages from one call site (e.g. a 401 or db insert line per request during a callback storm) are rate
+# limited before they are queued: after burst records in an interval the rest are dropped, then summarized with one
+# "Suppressed N similar message(s)" record per call site. Errors and audit records (logged with extra=audit: what
+# happened to each event and message) are never rate limited.
+
+import atexit
+from datetime import datetime, timezone
+from json import dumps as jsonDumps
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import queue
+import threading
+from typing import Dict, Tuple
+
+
+audit = {"audit": True}  # extra= of per-event and per-message records, passed by RateLimitFilter
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one json object per line: time, level, logger, thread, message, and exception if any."""
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname,
+                 "logger": record.name,
+                 "thread": record.threadName,
+                 "message": record.getMessage()}
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return jsonDumps(entry, default=str)
+
+
+class RateLimitFilter(logging.Filter):
+    """Passes at most burst records per call site (logger, level, file, line) until the next summarize(). Errors and
+    audit records always pass."""
+    def __init__(self, burst: int = 10):
+        super().__init__()
+        self.burst = burst  # 0 passes everything
+        self._counts: Dict[Tuple, list] = {}  # call site: [records seen, last suppressed record]
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.burst <= 0 or record.levelno >= logging.ERROR or getattr(record, "audit", False) \
+                or getattr(record, "suppressedSummary", False):
+            return True
+
+        key = (record.name, record.levelno, record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key)
+            if count is None:
+                count = self._counts[key] = [0, None]
+            count[0] += 1
+            if count[0] <= self.burst:
+                return True
+            count[1] = record
+            return False
+
+    def summarize(self, interval: float) -> list:
+        """Starts a new interval. Returns one summary record per call site that had records suppressed."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+
+        summaries = []
+        for seen, last in counts.values():
+            if last is None:
+                continue
+            summary = logging.LogRecord(last.name, last.levelno, last.pathname, last.lineno,
+                                        "Suppressed %d similar message(s) in %g seconds, last: %s",
+                                        (seen - self.burst, interval, last.getMessage()), None)
+            summary.suppressedSummary = True
+            summaries.append(summary)
+        return summaries
+
+
+class LogPipeline:
+    def __init__(self,
+                 handler: logging.Handler,
+                 burst: int = 10,
+                 interval: float = 60):
+        self.interval = interval  # seconds per rate limit interval
+        self.rateLimit = RateLimitFilter(burst)
+
+        self._queue = queue.SimpleQueue()
+        self.queueHandler = QueueHandler(self._queue)
+        self.queueHandler.addFilter(self.rateLimit)
+        self._listener = QueueListener(self._queue, handler, respect_handler_level=True)
+
+        self._stopping = threading.Event()
+        self._thread = None
+        self._listening = False
+
+    def start(self) -> None:
+        if self._listening:
+            return
+
+        self._stopping.clear()
+        self._listener.start()
+        self._listening = True
+        if self.rateLimit.burst > 0:
+            self._thread = threading.Thread(target=self._run, name="logRateLimit", daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """Logs remaining summaries, then writes out all queued records."""
+        self._stopping.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        if self._listening:
+            self._listener.stop()
+            self._listening = False
+
+    def _run(self) -> None:
+        while True:
+            stopping = self._stopping.wait(self.interval)
+            for summary in self.rateLimit.summarize(self.interval):
+                self.queueHandler.handle(summary)
+            if stopping:
+                return
+
+
+if __name__ == "__main__":
+    # testing - no flask required
+    import io
+    from json import loads as jsonLoads
+
+    stream = io.StringIO()
+    output = logging.StreamHandler(stream)
+    output.setFormatter(JsonFormatter())
+    TestPipeline = LogPipeline(output, burst=2, interval=3600)
+    TestLogger = logging.getLogger("logPipelineTest")
+    TestLogger.propagate = False
+    TestLogger.addHandler(TestPipeline.queueHandler)
+    TestLogger.setLevel(logging.INFO)
+    TestPipeline.start()
+
+    for i in range(5):
+        TestLogger.warning(f"Unauthorized {i}")  # one call site
+    TestLogger.info("Other call site")
+    for i in range(5):
+        TestLogger.error(f"Db error {i}")  # errors are never dropped
+        TestLogger.info(f"Added Event {i}", extra=audit)  # nor audit records
+    TestPipeline.stop()  # summarizes, then flushes
+
+    lines = [jsonLoads(line) for line in stream.getvalue().splitlines()]
+    assert [line["message"] for line in lines[:3]] == ["Unauthorized 0", "Unauthorized 1", "Other call site"]
+    assert [line["message"] for line in lines[3:13:2]] == [f"Db error {i}" for i in range(5)]
+    assert [line["message"] for line in lines[4:13:2]] == [f"Added Event {i}" for i in range(5)]
+    assert lines[13]["message"] == "Suppressed 3 similar message(s) in 3600 seconds, last: Unauthorized 4"
+    assert lines[13]["level"] == "WARNING" and lines[13]["logger"] == "logPipelineTest"
+    assert len(lines) == 14
+
+    # next interval starts over
+    assert RateLimitFilter(burst=1).summarize(60) == []
@@ -0,0 +1,300 @@
+# metrics.py
+# By: Ethan Jansen
+# Prometheus-style metrics. Requires Basic Authorization.
+# Updates are lock-free: each thread writes to its own shard, shards are summed only when /metrics is scraped.
+# Shards of exited threads (server thread pool churn) are folded into one retired shard, so shards never accumulate.
+
+from flask import Blueprint, g, request
+from functools import wraps
+import threading
+from time import perf_counter
+from typing import Callable, Tuple
+import weakref
+from .auth import login_required
+
+
+prefix = "imonnit_twilio_connector_"
+latencyBuckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # seconds
+
+
+def _labelString(labelNames: Tuple[str, ...], labels: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value)}"' for name, value in zip(labelNames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = ()):
+        self.name = prefix + name
+        self.help = help
+        self.labelNames = labelNames
+
+        self._local = threading.local()
+        self._shards = []  # (weak reference to thread, shard) of every live thread, appended once per thread
+        self._retired = {}  # totals of the shards of exited threads
+        self._shardsLock = threading.Lock()
+
+    def _shard(self) -> dict:
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = self._local.shard = {}
+            with self._shardsLock:
+                self._retireShards()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def _retireShards(self) -> None:
+        """Folds shards of exited threads into the retired shard. Call with _shardsLock held."""
+        live = []
+        for thread, shard in self._shards:
+            if thread() is not None and thread().is_alive():
+                live.append((thread, shard))
+            else:
+                for labels, value in shard.items():  # no longer written
+                    self._retired[labels] = self._add(self._retired.get(labels), value)
+        self._shards = live
+
+    @staticmethod
+    def _add(total, value):
+        return value if total is None else total + value
+
+    def _collectShards(self) -> list:
+        with self._shardsLock:
+            self._retireShards()
+            shards = [shard for _, shard in self._shards] + [self._retired]
+            return [list(shard.items()) for shard in shards]
+
+    def render(self) -> str:
+        return f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.type}\n" + "".join(self._samples())
+
+    def _samples(self):
+        return []
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, labels: Tuple = ()) -> None:
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def value(self, labels: Tuple = ()) -> float:
+        return sum(value for items in self._collectShards() for key, value in items if key == labels)
+
+    def _samples(self):
+        totals = {}
+        for items in self._collectShards():
+            for labels, value in items:
+                totals[labels] = totals.get(labels, 0) + value
+        for labels, value in sorted(totals.items()):
+            yield f"{self.name}{_labelString(self.labelNames, labels)} {value}\n"
+
+
+class Gauge(Counter):
+    """Sharded up/down gauge (in-flight requests), or a callback read at scrape time (queue depths)."""
+    type = "gauge"
+
+    def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = (), callback: Callable[[], float] = None):
+        super().__init__(name, help, labelNames)
+        self.callback = callback
+
+    def dec(self, amount: float = 1, labels: Tuple = ()) -> None:
+        self.inc(-amount, labels)
+
+    def _samples(self):
+        if self.callback is None:
+            yield from super()._samples()
+            return
+        try:
+            value = self.callback()
+        except Exception:
+            return  # nothing to report
+        if value is not None:
+            yield f"{self.name} {value}\n"
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, labelNames: Tuple[str, ...] = (), buckets: Tuple[float, ...] = latencyBuckets):
+        super().__init__(name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, labels: Tuple = ()) -> None:
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            series = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]  # bucket counts, +Inf count, sum
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        else:
+            series[-2] += 1
+        series[-1] += value
+
+    def time(self, labels: Tuple = ()) -> "_Timer":
+        """Context manager observing elapsed seconds."""
+        return _Timer(self, labels)
+
+    @staticmethod
+    def _add(total, series):
+        if total is None:
+            return list(series)
+        return [a + b for a, b in zip(total, series)]
+
+    def count(self, labels: Tuple = ()) -> int:
+        return sum(sum(series[:-1]) for items in self._collectShards() for key, series in items if key == labels)
+
+    def _samples(self):
+        totals = {}
+        for items in self._collectShards():
+            for labels, series in items:
+                total = totals.setdefault(labels, [0] * len(series))
+                for i, value in enumerate(list(series)):
+                    total[i] += value
+        for labels, series in sorted(totals.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                yield f"{self.name}_bucket{_labelString(self.labelNames, labels, le)} {cumulative}\n"
+            yield f"{self.name}_sum{_labelString(self.labelNames, labels)} {series[-1]}\n"
+            yield f"{self.name}_count{_labelString(self.labelNames, labels)} {cumulative}\n"
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: Tuple):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(perf_counter() - self._start, self._labels)
+        return False
+
+
+def timed(histogram: Histogram):
+    """Decorator observing each call's elapsed seconds, labeled by function name."""
+    def decorator(f):
+        labels = (f.__name__,)
+
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            with histogram.time(labels):
+                return f(*args, **kwargs)
+        return decorated_function
+    return decorator
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "".join(metric.render() for metric in self._metrics)
+
+
+# Metrics
+registry = Registry()
+
+requestSeconds = registry.register(Histogram("request_seconds", "End-to-end request time.", ("endpoint",)))
+requestCount = registry.register(Counter("requests_total", "Requests by response status.", ("endpoint", "status")))
+requestsInFlight = registry.register(Gauge("requests_in_flight", "Requests currently being handled."))
+
+validationSeconds = registry.register(Histogram("validation_seconds", "Pydantic model validation time.", ("model",)))
+validationErrors = registry.register(Counter("validation_errors_total", "Failed pydantic model validations.", ("model",)))
+
+twilioCreateSeconds = registry.register(Histogram("twilio_create_seconds", "Twilio messages.create call time.", ("status",)))
+twilioQueueSeconds = registry.register(Histogram("twilio_queue_seconds", "Time messages waited for the sender rate limit.",
+                                                 ("sender",), buckets=(0, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)))
+twilioSenderMessages = registry.register(Counter("twilio_sender_messages_total", "Twilio sends by sender and result.",
+                                                 ("sender", "result")))
+messageRetries = registry.register(Counter("message_retries_total", "Failed Twilio sends scheduled for retry.", ("error_code",)))
+
+dbSeconds = registry.register(Histogram("db_seconds", "DbConnector method time.", ("method",)))
+
+errorCodeLookups = registry.register(Counter("twilio_error_code_lookups_total", "Twilio error code lookups.", ("result",)))
+
+outboxPending = registry.register(Gauge("outbox_pending_messages", "Stored messages waiting to be sent (pending or retrying)."))
+callbackBufferDepth = registry.register(Gauge("callback_buffer_depth", "Buffered Twilio status callbacks waiting for a flush."))
+
+
+# create blueprint
+bpName = "metrics"
+metricsBp = Blueprint(bpName, __name__)
+
+
+@metricsBp.before_app_request
+def _startRequest():
+    g.metricsStart = perf_counter()
+    requestsInFlight.inc()
+
+
+@metricsBp.after_app_request
+def _countRequest(response):
+    requestCount.inc(labels=(request.endpoint, response.status_code))
+    return response
+
+
+@metricsBp.teardown_app_request
+def _endRequest(exc):
+    if "metricsStart" in g:
+        requestSeconds.observe(perf_counter() - g.metricsStart, (request.endpoint,))
+        requestsInFlight.dec()
+
+
+@metricsBp.get("/metrics")
+@login_required
+def metrics():
+    return (registry.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
+
+
+if __name__ == "__main__":
+    # testing
+    TestCounter = Counter("test_total", "Test counter.", ("kind",))
+    TestHistogram = Histogram("test_seconds", "Test histogram.", buckets=(0.1, 1))
+
+    # every thread writes its own shard, summed on collection
+    def work():
+        for _ in range(1000):
+            TestCounter.inc(labels=("a",))
+            TestHistogram.observe(0.5)
+    threads = [threading.Thread(target=work) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    TestCounter.inc(2, ("b",))
+
+    assert TestCounter.value(("a",)) == 4000
+    assert TestHistogram.count() == 4000
+    assert 'imonnit_twilio_connector_test_total{kind="b"} 2\n' in TestCounter.render()
+    rendered = TestHistogram.render()
+    assert 'imonnit_twilio_connector_test_seconds_bucket{le="0.1"} 0\n' in rendered
+    assert 'imonnit_twilio_connector_test_seconds_bucket{le="1"} 4000\n' in rendered
+    assert 'imonnit_twilio_connector_test_seconds_bucket{le="+Inf"} 4000\n' in rendered
+    assert "imonnit_twilio_connector_test_seconds_count 4000\n" in rendered
+
+    # shards of exited threads are retired, their counts kept
+    assert TestCounter._shards and all(thread() is threading.current_thread() for thread, _ in TestCounter._shards)
+    assert TestHistogram._shards == [] and TestHistogram._retired[()] == [0, 4000, 0, 2000.0]
+
+    # decorator and callback gauge
+    @timed(TestHistogram)
+    def slow():
+        return 1
+    assert slow() == 1
+    assert TestHistogram.count(("slow",)) == 1
+    assert Gauge("test_depth", "Test gauge.", callback=lambda: 3).render().endswith("imonnit_twilio_connector_test_depth 3\n")
+    assert Gauge("test_depth", "Test gauge.", callback=lambda: None).render().endswith("gauge\n")  # db error
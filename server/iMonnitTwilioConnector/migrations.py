@@ -0,0 +1,152 @@
+# migrations.py
+# By: Ethan Jansen
+# Versioned database schema migrations. Evolves databases created by db/dbInit.sql (version 0) in place.
+# Run at startup by create_app(), or manually with: python -m iMonnitTwilioConnector.migrations [--status]
+
+import logging
+from typing import List, NamedTuple
+from .db import DbConnector
+
+
+logger = logging.getLogger(__name__)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    statements: List[str]
+
+
+# Append only. Never edit or reorder a migration that has been released.
+MIGRATIONS = [
+    Migration(1, "Index Message lookups by MessageId and Status",
+              ["CREATE INDEX IF NOT EXISTS idx_Message_MessageId ON Message (MessageId)",
+               "CREATE INDEX IF NOT EXISTS idx_Message_Status ON Message (Status)"]),
+    Migration(2, "Index Event by Created and DeviceId",
+              ["CREATE INDEX IF NOT EXISTS idx_Event_Created ON Event (Created)",
+               "CREATE INDEX IF NOT EXISTS idx_Event_DeviceId ON Event (DeviceId)"]),
+    Migration(3, "Add unique Event.Fingerprint to recognize iMonnit retries",
+              ["ALTER TABLE Event ADD COLUMN IF NOT EXISTS Fingerprint CHAR(64)",
+               "CREATE UNIQUE INDEX IF NOT EXISTS uq_Event_Fingerprint ON Event (Fingerprint)"]),
+    Migration(4, "Add Message.Attempts and Message.NextAttempt for per-recipient send retries",
+              ["ALTER TABLE Message ADD COLUMN IF NOT EXISTS Attempts INTEGER UNSIGNED NOT NULL DEFAULT 0",
+               "ALTER TABLE Message ADD COLUMN IF NOT EXISTS NextAttempt DATETIME",
+               "CREATE INDEX IF NOT EXISTS idx_Message_Status_NextAttempt ON Message (Status, NextAttempt)"]),
+    Migration(5, "Add Route table for recipient routing by account, network, device, and rule",
+              ["CREATE TABLE IF NOT EXISTS Route ("
+               "Id INTEGER UNSIGNED AUTO_INCREMENT PRIMARY KEY, "
+               "AccountId INTEGER UNSIGNED, "
+               "NetworkId INTEGER UNSIGNED, "
+               "DeviceId INTEGER UNSIGNED, "
+               "Rule NVARCHAR(300), "
+               "Recipients NVARCHAR(3000) NOT NULL)"]),
+    Migration(6, "Index Event and Message history filters for keyset pagination",
+              ["CREATE INDEX IF NOT EXISTS idx_Event_Rule ON Event (Rule, Id)",
+               "CREATE INDEX IF NOT EXISTS idx_Event_NetworkId ON Event (NetworkId, Id)",
+               "CREATE INDEX IF NOT EXISTS idx_Event_AccountId ON Event (AccountId, Id)",
+               "CREATE INDEX IF NOT EXISTS idx_Message_Created ON Message (Created, Id)"]),
+    Migration(7, "Drop monthly history DELETE event, history retention is applied by the server (retention.py)",
+              ["DROP EVENT IF EXISTS event_CleanHistory_Event"]),
+    Migration(8, "Index outbox claims left sending without a Twilio MessageId",
+              ["CREATE INDEX IF NOT EXISTS idx_Message_Status_MessageId_Updated ON Message (Status, MessageId, Updated)"]),
+]
+
+
+class SchemaMigrator:
+    _createVersionTableSQL = "CREATE TABLE IF NOT EXISTS SchemaVersion (" \
+                             "Version INTEGER UNSIGNED PRIMARY KEY, " \
+                             "Description NVARCHAR(300), " \
+                             "Applied TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP)"
+
+    _getVersionSQL = "SELECT COALESCE(MAX(Version), 0) FROM SchemaVersion"
+
+    _insertVersionSQL = "INSERT INTO SchemaVersion (Version, Description) VALUES (?,?)"
+
+    # only one server migrates at a time
+    _lockName = "iMonnitTwilioConnector.migrations"
+    _getLockSQL = "SELECT GET_LOCK(?, ?)"
+    _releaseLockSQL = "SELECT RELEASE_LOCK(?)"
+
+    def __init__(self, dbConn: DbConnector, migrations: List[Migration] = MIGRATIONS, lockTimeout: int = 60):
+        self._dbConn = dbConn
+        self.migrations = sorted(migrations, key=lambda m: m.version)
+        self.lockTimeout = lockTimeout
+
+    @property
+    def latestVersion(self) -> int:
+        return self.migrations[-1].version if self.migrations else 0
+
+    def _currentVersion(self, cursor) -> int:
+        cursor.execute(SchemaMigrator._createVersionTableSQL)
+        cursor.execute(SchemaMigrator._getVersionSQL)
+        return cursor.fetchone()[0]
+
+    def currentVersion(self) -> int | None:
+        """Returns schema version of database, None on error."""
+        try:
+            with self._dbConn.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    return self._currentVersion(cursor)
+                finally:
+                    cursor.close()
+        except Exception as e:
+            logger.error(f"Unable to read schema version: {e}")
+            return None
+
+    def migrate(self) -> bool:
+        """Applies all migrations newer than the database schema version, in order.
+        DDL is not transactional: each migration is recorded as soon as its statements succeed.
+        Returns True if database is up to date, False otherwise."""
+        try:
+            with self._dbConn.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(SchemaMigrator._getLockSQL, (SchemaMigrator._lockName, self.lockTimeout))
+                    if cursor.fetchone()[0] != 1:
+                        raise TimeoutError("Unable to get migration lock")
+
+                    try:
+                        version = self._currentVersion(cursor)
+                        for migration in self.migrations:
+                            if migration.version <= version:
+                                continue
+
+                            logger.info(f"Applying schema migration {migration.version}: {migration.description}")
+                            for statement in migration.statements:
+                                cursor.execute(statement)
+                            cursor.execute(SchemaMigrator._insertVersionSQL, (migration.version, migration.description))
+                            connection.commit()
+                            version = migration.version
+                    finally:
+                        cursor.execute(SchemaMigrator._releaseLockSQL, (SchemaMigrator._lockName,))
+                        cursor.fetchone()
+                finally:
+                    cursor.close()
+
+            logger.info(f"Database schema is at version {version}")
+
+        except Exception as e:
+            logger.error(f"Schema migration failed: {e}")
+            return False
+
+        return True
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(prog="python -m iMonnitTwilioConnector.migrations",
+                                     description="Migrate the database schema to the latest version.")
+    parser.add_argument("--status", action="store_true", help="print current and latest schema versions, then exit")
+    args = parser.parse_args()
+
+    migrator = SchemaMigrator(DbConnector(poolSize=1))
+    if args.status:
+        current = migrator.currentVersion()
+        print(f"Current schema version: {current}")
+        print(f"Latest schema version: {migrator.latestVersion}")
+        sys.exit(0 if current is not None else 2)
+
+    sys.exit(0 if migrator.migrate() else 3)
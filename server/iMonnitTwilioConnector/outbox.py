@@ -0,0 +1,255 @@
+# outbox.py
+# By: Ethan Jansen
+# Durable outbound SMS outbox.
+# Webhook stores events with one pending message per recipient, a pool of worker threads sends them with Twilio.
+# Transient send failures are stored as "retrying" and sent again by the workers once their next attempt is due.
+
+from datetime import datetime, timedelta
+import logging
+from queue import Queue, Empty
+import threading
+from time import sleep
+from typing import List
+from .dataTypes import Message
+from .db import DbConnector
+from .logPipeline import audit
+from .retry import RetryPolicy
+from .settings import ImonnitTwilioConnectorConfig
+from .twilioClient import TwilioSMSClient
+
+
+defaultLog = logging.getLogger(__name__)
+
+
+class SmsOutbox:
+    def __init__(self,
+                 smsClient: TwilioSMSClient,
+                 dbConn: DbConnector,
+                 retryPolicy: RetryPolicy | None = None,
+                 workers: int = ImonnitTwilioConnectorConfig.OutboxWorkers,
+                 pollInterval: float = ImonnitTwilioConnectorConfig.OutboxPollInterval,
+                 lease: int = ImonnitTwilioConnectorConfig.OutboxLease,
+                 batchSize: int = 1):
+        self._logger = defaultLog
+        self._client = smsClient
+        self._dbConn = dbConn
+        self.retryPolicy = retryPolicy or RetryPolicy()
+
+        self.workers = max(workers, 0)
+        self.pollInterval = pollInterval
+        self.lease = timedelta(seconds=lease)
+        self.batchSize = batchSize
+
+        # wake up tokens (None) and non-durable notices ((message body, recipients or None for recipientList))
+        self._queue = Queue()
+        self._threads = []
+        self._stopping = threading.Event()
+
+        # send results not yet written to db -- never left "sending" to be claimed (and sent) again after the lease
+        self._unsaved = []
+        self._unsavedLock = threading.Lock()
+
+    # outbox is used by the webhook only if there are workers to drain it
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 0
+
+    @property
+    def running(self) -> bool:
+        return any(thread.is_alive() for thread in self._threads)
+
+    def start(self) -> None:
+        """Starts workers. Without workers, one worker still sends retries of messages sent within the webhook."""
+        if not (self.enabled or self.retryPolicy.enabled) or self.running:
+            return
+
+        self._stopping.clear()
+        workers = self.workers or 1
+        self._threads = [threading.Thread(target=self._work, name=f"outbox-{i}", daemon=True) for i in range(workers)]
+        for thread in self._threads:
+            thread.start()
+        if self.enabled:
+            self._logger.info(f"Started SMS outbox with {workers} worker(s).")
+        else:
+            self._logger.info("Started SMS outbox retry worker.")
+
+    def stop(self, timeout: float | None = None) -> None:
+        self._stopping.set()
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+        # notices queued before stopping (such as final alert digests, see AlertCoalescer.stop) are still sent
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except Empty:
+                break
+            if item is not None:
+                self._sendNotice(item)
+
+        # last chance for kept send results -- log what must be reconciled by hand
+        if not self._saveUnsaved():
+            for message in self._unsaved:
+                self._logger.critical(f"Send result of Message {message.id} was never stored: Twilio sid "
+                                      f"{message.messageId}, status {message.status}. Update it before restarting, "
+                                      f"or it will be sent again.")
+
+    def submit(self, event, recipients: List[str] | None = None) -> bool:
+        """Adds one pending message per recipient (defaults to recipientList) to event, and stores event with messages in db.
+        Takes dataTypes.Event instance. Returns True if stored (workers will send), False otherwise."""
+        if recipients is None:
+            recipients = self._client.recipientList
+        # recipients are validated when configured
+        event.messages = [Message.model_construct(recipient=recipient, status="pending") for recipient in recipients]
+
+        if not self._dbConn.addEventWithMessages(event):
+            return False
+
+        self._wake(len(event.messages))
+        return True
+
+    def resubmit(self, eventId: int) -> bool:
+        """Sets failed messages of a stored event back to pending, workers will send them again.
+        Returns True on success, False otherwise."""
+        count = self._dbConn.requeueFailedMessages(eventId)
+        if count is None:
+            return False
+
+        self._wake(count)
+        return True
+
+    def _wake(self, count: int) -> None:
+        for _ in range(count):
+            self._queue.put(None)
+
+    def notify(self, body: str, recipients: List[str] | None = None) -> None:
+        """Sends body to recipients (defaults to recipientList) without storing it in db. Sent by a worker if running,
+        otherwise (or once stopping) immediately."""
+        if recipients is not None and not recipients:
+            return
+        if self.running and not self._stopping.is_set():
+            self._queue.put((body, recipients))
+        else:
+            self._sendNotice((body, recipients))
+
+    async def notifyAsync(self, body: str, recipients: List[str] | None = None) -> None:
+        """notify for asyncio callers (the asgi app), sends without blocking the event loop when not queued."""
+        if recipients is not None and not recipients:
+            return
+        if self.running and not self._stopping.is_set():
+            self._queue.put((body, recipients))
+            return
+        try:
+            await self._client.sendAsync(body, recipients)
+        except Exception as e:
+            self._logger.error(f"Unable to send notice: {e}")
+
+    def _sendNotice(self, item: tuple) -> None:
+        try:
+            self._client.send(*item)
+        except Exception as e:
+            self._logger.error(f"Unable to send notice: {e}")
+
+    def _work(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                item = self._queue.get(timeout=self.pollInterval)
+            except Empty:
+                item = None
+
+            try:
+                if item is not None:
+                    self._sendNotice(item)
+                self._drain()
+            except Exception as e:
+                self._logger.error(f"Unexpected error in outbox worker: {e}")
+
+    def _save(self, message: Message, attempts: int = 3) -> bool:
+        """Writes a send result, retrying briefly. Results that still fail are kept, see _saveUnsaved."""
+        for attempt in range(attempts):
+            if self._dbConn.updateMessageById(message):
+                return True
+            sleep(0.5 * 2 ** attempt)
+
+        self._logger.error(f"Unable to store send result of Message {message.id} (Twilio sid {message.messageId}, "
+                           f"status {message.status}), keeping it to store later")
+        with self._unsavedLock:
+            self._unsaved.append(message)
+        return False
+
+    def _saveUnsaved(self) -> bool:
+        """Writes kept send results. Returns True if none are left."""
+        with self._unsavedLock:
+            unsaved, self._unsaved = self._unsaved, []
+        failed = [message for message in unsaved if not self._dbConn.updateMessageById(message)]
+        if unsaved and not failed:
+            self._logger.info(f"Stored {len(unsaved)} kept send result(s)")
+        with self._unsavedLock:
+            self._unsaved.extend(failed)
+            return not self._unsaved
+
+    def _drain(self) -> None:
+        """Claims and sends pending messages and due retries until none are left.
+        Claims nothing while send results are waiting to be stored (the db is likely unavailable)."""
+        while not self._stopping.is_set():
+            if not self._saveUnsaved():
+                return
+            claimed = self._dbConn.claimPendingMessages(self.batchSize, datetime.now() - self.lease)
+            if not claimed:
+                return
+
+            for message, body in claimed:
+                sent = self._client.sendTo(message.recipient, body)
+                if sent is None:
+                    # invalid recipient or unexpected error; do not retry
+                    message.status = "failed"
+                else:
+                    message.messageId = sent.messageId
+                    message.status = sent.status
+                    message.errorCode = sent.errorCode
+                    message.errorMessage = sent.errorMessage
+                if self.retryPolicy.afterAttempt(message):
+                    self._logger.info(f"Retrying Message {message.id} to {message.recipient} at {message.nextAttempt}", extra=audit)
+                message.updated = datetime.now()
+
+                self._save(message)
+
+
+if __name__ == "__main__":
+    # testing - no db or Twilio required
+    class _TestClient:
+        recipientList = ("+11234567890",)
+
+        def __init__(self):
+            self.sent = []
+            self.gate = threading.Event()
+
+        def send(self, body, recipients=None):
+            if body == "blocking":
+                self.gate.wait(5)
+            self.sent.append((body, recipients))
+
+    class _TestDb:
+        @staticmethod
+        def claimPendingMessages(limit, leaseCutoff):
+            return []
+
+    # exit order: the coalescer's final digests are queued while the outbox is running, just before it stops
+    TestClient = _TestClient()
+    TestOutbox = SmsOutbox(TestClient, _TestDb(), RetryPolicy(limit=0), workers=1, pollInterval=60)
+    TestOutbox.start()
+    TestOutbox.notify("blocking")  # the only worker is busy sending
+    TestOutbox.notify("digest", ["+11234567891"])
+    stopping = threading.Thread(target=TestOutbox.stop)
+    stopping.start()
+    TestOutbox._stopping.wait(5)
+    TestClient.gate.set()  # worker finishes once stop has begun, and exits without reading the queue
+    stopping.join()
+    assert TestClient.sent == [("blocking", None), ("digest", ["+11234567891"])]
+
+    # once stopped, notices are sent immediately
+    TestOutbox.notify("after stop")
+    assert TestClient.sent[-1] == ("after stop", None)
@@ -0,0 +1,123 @@
+# rateLimit.py
+# By: Ethan Jansen
+# Client-side token buckets smoothing Twilio requests to each sender number's messages-per-second limit.
+# Requests beyond the limit wait their turn (in arrival order) instead of being sent and rejected with 429.
+
+import asyncio
+from math import ceil
+import threading
+from time import monotonic, sleep
+from typing import Callable, Dict
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float = 1, clock: Callable[[], float] = monotonic):
+        self.rate = rate  # tokens per second
+        self.burst = max(burst, 1)  # bucket size
+
+        self._clock = clock
+        self._tokens = self.burst  # negative while requests are waiting
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def reserve(self, maxWait: float | None = None) -> float | None:
+        """Takes a token now or reserves the next free one. Returns seconds to wait before sending.
+        Returns None (nothing reserved) if the wait would be longer than maxWait."""
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+
+            wait = 0.0 if self._tokens >= 1 else (1 - self._tokens) / self.rate
+            if maxWait is not None and wait > maxWait:
+                return None
+            self._tokens -= 1
+            return wait
+
+    @property
+    def queued(self) -> int:
+        """Requests currently waiting for a token."""
+        with self._lock:
+            tokens = self._tokens + (self._clock() - self._last) * self.rate
+        return ceil(-tokens) if tokens < 0 else 0
+
+
+class SenderRateLimiter:
+    def __init__(self, defaultRate: float = 0, rates: Dict[str, float] | None = None, burst: float = 1,
+                 maxWait: float | None = None):
+        self.defaultRate = defaultRate  # messages per second for senders not in rates. 0 is unlimited
+        self.rates = rates or {}
+        self.burst = burst
+        self.maxWait = maxWait  # seconds. Longer waits are not queued
+
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, sender: str) -> TokenBucket | None:
+        """Returns sender's bucket, None if sender is unlimited."""
+        bucket = self._buckets.get(sender)
+        if bucket is None:
+            rate = self.rates.get(sender, self.defaultRate)
+            if rate <= 0:
+                return None
+            with self._lock:
+                bucket = self._buckets.setdefault(sender, TokenBucket(rate, self.burst))
+        return bucket
+
+    def reserve(self, sender: str) -> float | None:
+        """Returns seconds to wait before sender may send, None if the wait would be longer than maxWait."""
+        bucket = self.bucket(sender)
+        if bucket is None:
+            return 0.0
+        return bucket.reserve(self.maxWait)
+
+    def acquire(self, sender: str) -> float | None:
+        """Blocks until sender may send. Returns seconds waited, None if the wait would be longer than maxWait."""
+        wait = self.reserve(sender)
+        if wait:
+            sleep(wait)
+        return wait
+
+    async def acquireAsync(self, sender: str) -> float | None:
+        """acquire for asyncio callers: waits without blocking the event loop."""
+        wait = self.reserve(sender)
+        if wait:
+            await asyncio.sleep(wait)
+        return wait
+
+
+def parseRates(value: str) -> Dict[str, float]:
+    """Parses "sender=rate,sender=rate" (messages per second)."""
+    rates = {}
+    for item in filter(None, value.split(",")):
+        sender, _, rate = item.partition("=")
+        rates[sender.strip()] = float(rate)
+    return rates
+
+
+if __name__ == "__main__":
+    # testing
+    now = [0.0]
+    TestBucket = TokenBucket(rate=2, burst=2, clock=lambda: now[0])
+
+    # burst, then one token every 1/rate seconds, in reservation order
+    assert TestBucket.reserve() == 0
+    assert TestBucket.reserve() == 0
+    assert TestBucket.reserve() == 0.5
+    assert TestBucket.reserve() == 1.0
+    assert TestBucket.queued == 2
+    assert TestBucket.reserve(maxWait=1) is None  # would wait 1.5 seconds, not reserved
+
+    # refilled, never above burst
+    now[0] = 10
+    assert TestBucket.reserve() == 0
+    assert TestBucket.reserve() == 0
+    assert TestBucket.reserve() == 0.5
+
+    # per sender rates, unlimited by default
+    TestLimiter = SenderRateLimiter(defaultRate=0, rates=parseRates("+15005550006=10, +15005550007=1"))
+    assert TestLimiter.bucket("+15005550001") is None
+    assert TestLimiter.bucket("+15005550006").rate == 10
+    assert TestLimiter.acquire("+15005550007") == 0
+    assert 0.9 < TestLimiter.acquire("+15005550007") <= 1
+    assert 0.9 < asyncio.run(TestLimiter.acquireAsync("+15005550007")) <= 1
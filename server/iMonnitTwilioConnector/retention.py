@@ -0,0 +1,298 @@
+# retention.py
+# By: Ethan Jansen
+# Event and Message history retention.
+# Partitioned tables (converted with: python -m iMonnitTwilioConnector.retention --partition) are range partitioned by
+# Created month. Expired months are dropped whole, and partitions for the coming months are created ahead of time.
+# Messages created after their event's month ends (at a month boundary, or resubmitted later) outlive the dropped Event
+# partition; those orphans are then deleted by EventId in small chunks.
+# Tables that are not partitioned fall back to deleting expired events (and their messages) in small chunks, pausing
+# between chunks so webhook inserts are never blocked for long.
+# Run by a background thread (one server at a time), or manually with: python -m iMonnitTwilioConnector.retention --help
+
+import atexit
+from datetime import datetime
+import logging
+import threading
+from time import sleep
+from typing import List, Tuple
+from .db import DbConnector
+from .settings import DbConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+def monthStart(dt: datetime, offset: int = 0) -> datetime:
+    """Returns the first day of dt's month, offset by offset months."""
+    months = dt.year * 12 + dt.month - 1 + offset
+    return datetime(months // 12, months % 12 + 1, 1)
+
+
+def partitionName(upperBound: datetime) -> str:
+    """Monthly partitions are named by the month they hold: rows with Created before upperBound."""
+    return "p" + monthStart(upperBound, -1).strftime("%Y%m")
+
+
+def partitionDefinition(upperBound: datetime) -> str:
+    return f"PARTITION {partitionName(upperBound)} VALUES LESS THAN (UNIX_TIMESTAMP('{upperBound:%Y-%m-%d %H:%M:%S}'))"
+
+
+class RetentionManager:
+    tables = ("Message", "Event")  # Message first, it refers to Event
+    _maxPartition = "pmax"
+
+    _getPartitionsSQL = "SELECT PARTITION_NAME, PARTITION_DESCRIPTION FROM information_schema.PARTITIONS " \
+                        "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME=? AND PARTITION_NAME IS NOT NULL " \
+                        "ORDER BY PARTITION_ORDINAL_POSITION"
+    _getOldestSQL = "SELECT MIN(Created) FROM {}"
+    _deleteChunkSQL = "DELETE FROM Event WHERE Created<? ORDER BY Id LIMIT ?"
+    # Event Ids increase with Created, so messages of dropped months refer to Ids below the oldest remaining event
+    _getOldestEventIdSQL = "SELECT COALESCE((SELECT MIN(Id) FROM Event), (SELECT MAX(EventId) + 1 FROM Message))"
+    _deleteOrphansChunkSQL = "DELETE FROM Message WHERE EventId<? ORDER BY EventId LIMIT ?"
+
+    # only one server applies retention at a time
+    _lockName = "iMonnitTwilioConnector.retention"
+    _getLockSQL = "SELECT GET_LOCK(?, 0)"
+    _releaseLockSQL = "SELECT RELEASE_LOCK(?)"
+
+    def __init__(self,
+                 dbConn: DbConnector,
+                 months: int = DbConfig.RetentionMonths,
+                 monthsAhead: int = DbConfig.RetentionMonthsAhead,
+                 interval: float = DbConfig.RetentionInterval,
+                 chunkSize: int = DbConfig.RetentionChunkSize,
+                 chunkPause: float = DbConfig.RetentionChunkPause):
+        self._dbConn = dbConn
+        self.months = max(months, 0)  # 0 keeps everything
+        self.monthsAhead = max(monthsAhead, 1)
+        self.interval = interval  # seconds between runs
+        self.chunkSize = max(chunkSize, 1)
+        self.chunkPause = chunkPause  # seconds between delete chunks
+
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.months > 0
+
+    def cutoff(self, now: datetime | None = None) -> datetime:
+        """Rows created before the returned month start are expired."""
+        return monthStart(now or datetime.now(), -self.months)
+
+    def start(self) -> None:
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+        logger.info(f"Keeping {self.months} month(s) of history, checking every {self.interval} seconds.")
+
+    def stop(self, timeout: float | None = 5) -> None:
+        self._stopping.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self.run()
+            self._stopping.wait(self.interval)
+
+    def _partitions(self, cursor, table: str) -> List[Tuple[str, str]]:
+        """Returns [(name, upper bound as unix time or "MAXVALUE")] of table, empty if not partitioned."""
+        cursor.execute(RetentionManager._getPartitionsSQL, (table,))
+        return cursor.fetchall()
+
+    @staticmethod
+    def _upperBound(name: str) -> datetime:
+        """Returns upper bound of a monthly partition from its name (independent of the db time zone)."""
+        return monthStart(datetime.strptime(name[1:], "%Y%m"), 1)
+
+    def run(self, now: datetime | None = None) -> bool:
+        """Applies retention once, unless another server is. Returns True on success (or skipped), False on error."""
+        now = now or datetime.now()
+        try:
+            with self._dbConn.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    cursor.execute(RetentionManager._getLockSQL, (RetentionManager._lockName,))
+                    if cursor.fetchone()[0] != 1:
+                        return True
+
+                    try:
+                        for table in RetentionManager.tables:
+                            if self._partitions(cursor, table):
+                                self._rotatePartitions(cursor, table, now)
+                        if self._partitions(cursor, "Event"):
+                            self._deleteOrphans(connection, cursor)
+                        else:
+                            cutoff = self.cutoff(now)
+                            deleted = self._deleteChunks(connection, cursor, RetentionManager._deleteChunkSQL, cutoff)
+                            if deleted:
+                                logger.info(f"Deleted {deleted} expired Event(s) created before {cutoff}")
+                    finally:
+                        cursor.execute(RetentionManager._releaseLockSQL, (RetentionManager._lockName,))
+                        cursor.fetchone()
+                finally:
+                    cursor.close()
+
+        except Exception as e:
+            logger.error(f"Unable to apply history retention: {e}")
+            return False
+
+        return True
+
+    def _rotatePartitions(self, cursor, table: str, now: datetime) -> None:
+        """Creates monthly partitions through monthsAhead, then drops partitions older than cutoff."""
+        partitions = self._partitions(cursor, table)
+        bounds = {RetentionManager._upperBound(name): name
+                  for name, _ in partitions if name != RetentionManager._maxPartition}
+
+        # split the catch-all partition (empty, unless months were not created in time)
+        lastBound = max(bounds) if bounds else monthStart(now)
+        ahead = monthStart(now, self.monthsAhead + 1)
+        newBounds = []
+        while lastBound < ahead:
+            lastBound = monthStart(lastBound, 1)
+            newBounds.append(lastBound)
+        if newBounds:
+            definitions = ", ".join(partitionDefinition(bound) for bound in newBounds)
+            cursor.execute(f"ALTER TABLE {table} REORGANIZE PARTITION {RetentionManager._maxPartition} INTO "
+                           f"({definitions}, PARTITION {RetentionManager._maxPartition} VALUES LESS THAN MAXVALUE)")
+            logger.info(f"Created {len(newBounds)} partition(s) of {table} through {partitionName(newBounds[-1])}")
+
+        # drop whole months, never the last partition before the catch-all
+        cutoff = self.cutoff(now)
+        expired = [name for bound, name in sorted(bounds.items()) if bound <= cutoff][:max(len(bounds) - 1, 0)]
+        if expired:
+            cursor.execute(f"ALTER TABLE {table} DROP PARTITION {', '.join(expired)}")
+            logger.info(f"Dropped expired partition(s) of {table}: {', '.join(expired)}")
+
+    def _deleteOrphans(self, connection, cursor) -> None:
+        """Deletes messages whose event was in a dropped partition (partitioned tables have no cascade)."""
+        cursor.execute(RetentionManager._getOldestEventIdSQL)
+        oldestEventId = cursor.fetchone()[0]
+        if oldestEventId is None:
+            return
+        deleted = self._deleteChunks(connection, cursor, RetentionManager._deleteOrphansChunkSQL, oldestEventId)
+        if deleted:
+            logger.info(f"Deleted {deleted} Message(s) of expired events")
+
+    def _deleteChunks(self, connection, cursor, sql: str, bound) -> int:
+        """Runs a chunked delete (sql takes bound and chunkSize) until done, one short transaction per chunk.
+        Returns the number of rows deleted."""
+        deleted = 0
+        while not self._stopping.is_set():
+            cursor.execute(sql, (bound, self.chunkSize))
+            count = cursor.rowcount
+            connection.commit()
+            deleted += count
+            if count < self.chunkSize:
+                break
+            sleep(self.chunkPause)
+        return deleted
+
+    def partition(self, now: datetime | None = None) -> bool:
+        """Converts Event and Message to monthly range partitions by Created. Rewrites both tables, run while idle.
+        Partitioned tables cannot have foreign keys, and unique keys must include Created: Message no longer cascades
+        from Event (months are dropped together, then orphaned messages are deleted by EventId), and Event.Fingerprint
+        is indexed, not unique. Duplicate events are still rejected by DbConnector.addEventWithMessages, which checks
+        the fingerprint with a locking read.
+        Returns True on success, False otherwise."""
+        now = now or datetime.now()
+        try:
+            with self._dbConn.connection() as connection:
+                cursor = connection.cursor()
+                try:
+                    if self._partitions(cursor, "Event"):
+                        logger.info("Event and Message are already partitioned")
+                        return True
+
+                    cursor.execute("ALTER TABLE Message DROP FOREIGN KEY IF EXISTS fk_Message_Event, "
+                                   "ADD INDEX IF NOT EXISTS idx_Message_EventId (EventId)")
+                    cursor.execute("ALTER TABLE Event DROP INDEX IF EXISTS uq_Event_Fingerprint, "
+                                   "ADD INDEX IF NOT EXISTS idx_Event_Fingerprint (Fingerprint)")
+                    for table in ("Event", "Message"):
+                        cursor.execute(RetentionManager._getOldestSQL.format(table))
+                        oldest = cursor.fetchone()[0] or now
+                        bound, bounds = monthStart(oldest, 1), []
+                        while bound <= monthStart(now, self.monthsAhead + 1):
+                            bounds.append(bound)
+                            bound = monthStart(bound, 1)
+
+                        logger.info(f"Partitioning {table} into {len(bounds)} month(s)...")
+                        cursor.execute(f"ALTER TABLE {table} DROP PRIMARY KEY, ADD PRIMARY KEY (Id, Created)")
+                        definitions = ", ".join(partitionDefinition(bound) for bound in bounds)
+                        cursor.execute(f"ALTER TABLE {table} PARTITION BY RANGE (UNIX_TIMESTAMP(Created)) "
+                                       f"({definitions}, PARTITION {RetentionManager._maxPartition} VALUES LESS THAN MAXVALUE)")
+                finally:
+                    cursor.close()
+
+        except Exception as e:
+            logger.error(f"Unable to partition history tables: {e}")
+            return False
+
+        logger.info("Event and Message are partitioned by month")
+        return True
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    # partition naming and bounds - no db required
+    assert monthStart(datetime(2025, 12, 15), 1) == datetime(2026, 1, 1)
+    assert monthStart(datetime(2025, 1, 15), -13) == datetime(2023, 12, 1)
+    assert partitionName(datetime(2026, 1, 1)) == "p202512"
+    assert RetentionManager._upperBound("p202512") == datetime(2026, 1, 1)
+    assert RetentionManager(None, months=36).cutoff(datetime(2025, 3, 28)) == datetime(2022, 3, 1)
+
+    # orphaned messages are deleted in chunks below the oldest remaining event - no db required
+    class _TestCursor:
+        def __init__(self, orphans):
+            self.orphans, self.executed, self.rowcount = orphans, [], 0
+
+        def execute(self, sql, params=()):
+            self.executed.append((sql, params))
+            if sql == RetentionManager._deleteOrphansChunkSQL:
+                self.rowcount = min(self.orphans, params[1])
+                self.orphans -= self.rowcount
+
+        def fetchone(self):
+            return (42,)
+
+    class _TestConnection:
+        def commit(self):
+            pass
+
+    testCursor = _TestCursor(orphans=5)
+    RetentionManager(None, chunkSize=2, chunkPause=0)._deleteOrphans(_TestConnection(), testCursor)
+    assert testCursor.orphans == 0
+    assert testCursor.executed[1:] == [(RetentionManager._deleteOrphansChunkSQL, (42, 2))] * 3
+
+    parser = argparse.ArgumentParser(prog="python -m iMonnitTwilioConnector.retention",
+                                     description="Apply Event and Message history retention.")
+    parser.add_argument("--partition", action="store_true",
+                        help="convert Event and Message to monthly partitions first (rewrites both tables)")
+    parser.add_argument("--status", action="store_true", help="print partitions of Event and Message, then exit")
+    args = parser.parse_args()
+
+    manager = RetentionManager(DbConnector(poolSize=1))
+    if args.status:
+        with manager._dbConn.connection() as connection:
+            cursor = connection.cursor()
+            for table in RetentionManager.tables:
+                partitions = manager._partitions(cursor, table)
+                print(f"{table}: " + (", ".join(name for name, _ in partitions) if partitions else "not partitioned"))
+            cursor.close()
+        sys.exit(0)
+
+    if args.partition and not manager.partition():
+        sys.exit(3)
+    if not manager.enabled:
+        print("Retention is disabled (MARIADB_RETENTION_MONTHS=0)")
+        sys.exit(0)
+    sys.exit(0 if manager.run() else 2)
@@ -0,0 +1,84 @@
+# retry.py
+# By: Ethan Jansen
+# Per-recipient Twilio send retries.
+# Transient send failures (429 or 5xx) are stored as status "retrying" with the time of their next attempt, and are
+# claimed again by the outbox once due. Delays grow exponentially with jitter, up to a limit of retries per message.
+
+from datetime import datetime, timedelta
+import random
+from typing import Callable
+from .dataTypes import Message
+from .metrics import messageRetries
+from .settings import TwilioConfig
+
+
+class RetryPolicy:
+    def __init__(self,
+                 limit: int = TwilioConfig.RetryLimit,
+                 delay: float = TwilioConfig.RetryDelay,
+                 maxDelay: float = TwilioConfig.RetryMaxDelay,
+                 jitter: Callable[[float, float], float] = random.uniform):
+        self.limit = max(limit, 0)  # retries after the first attempt
+        self.delay = delay  # seconds before the first retry
+        self.maxDelay = maxDelay
+        self._jitter = jitter  # uniform(low, high)
+
+    @property
+    def enabled(self) -> bool:
+        return self.limit > 0
+
+    @staticmethod
+    def retryable(message: Message) -> bool:
+        """Returns True if message was never created by Twilio because of a throttled (429) or server (5xx) error."""
+        return (message.status == "failed" and message.messageId is None and message.errorCode is not None
+                and (message.errorCode == 429 or 500 <= message.errorCode < 600))
+
+    def backoff(self, attempts: int) -> float:
+        """Returns seconds to wait after attempt number attempts: half the exponential delay, plus up to half again as jitter."""
+        delay = min(self.delay * 2 ** (attempts - 1), self.maxDelay)
+        return delay / 2 + self._jitter(0, delay / 2)
+
+    def afterAttempt(self, message: Message, now: datetime | None = None) -> bool:
+        """Counts a send attempt of message. Retryable failures within the limit are set to status "retrying" with nextAttempt.
+        Returns True if message will be retried, False otherwise."""
+        message.attempts += 1
+        message.nextAttempt = None
+        if not self.enabled or message.attempts > self.limit or not RetryPolicy.retryable(message):
+            return False
+
+        now = now or datetime.now()
+        message.status = "retrying"
+        message.nextAttempt = now + timedelta(seconds=self.backoff(message.attempts))
+        messageRetries.inc(labels=(message.errorCode,))
+        return True
+
+
+if __name__ == "__main__":
+    # testing - no db or Twilio required
+    now = datetime(2025, 3, 28, 14, 25)
+    TestPolicy = RetryPolicy(limit=3, delay=2, maxDelay=5, jitter=lambda low, high: high)
+
+    # throttled: retried with growing delays, capped at maxDelay, then left failed
+    throttled = Message(recipient="+11234567890", status="failed", errorCode=429)
+    expected = [2, 4, 5]
+    for delay in expected:
+        assert TestPolicy.afterAttempt(throttled, now)
+        assert throttled.status == "retrying"
+        assert throttled.nextAttempt == now + timedelta(seconds=delay)
+        throttled.status = "failed"
+    assert not TestPolicy.afterAttempt(throttled, now)
+    assert throttled.attempts == 4
+    assert throttled.status == "failed" and throttled.nextAttempt is None
+
+    # jitter: at least half of the exponential delay
+    assert RetryPolicy(delay=8, maxDelay=60, jitter=lambda low, high: low).backoff(2) == 8
+
+    # not retried: created messages, client errors, unexpected errors
+    assert not TestPolicy.afterAttempt(Message(recipient="+11234567890", messageId="SM0123456789abcdefghijklmnopqrstuv",
+                                               status="queued"), now)
+    assert not TestPolicy.afterAttempt(Message(recipient="+11234567890", status="failed", errorCode=400), now)
+    assert not TestPolicy.afterAttempt(Message(recipient="+11234567890", status="failed"), now)
+    assert TestPolicy.afterAttempt(Message(recipient="+11234567890", status="failed", errorCode=503), now)
+
+    # disabled
+    assert not RetryPolicy(limit=0).afterAttempt(Message(recipient="+11234567890", status="failed", errorCode=429), now)
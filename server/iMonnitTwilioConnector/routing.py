@@ -0,0 +1,181 @@
+# routing.py
+# By: Ethan Jansen
+# Recipient routing by iMonnit account, network, device, and rule.
+# Routes are loaded from a json file or the Route table at startup and compiled into one hash index. Each route matches
+# an account, network, device, and rule, or any of them (wildcard). The most specific matching route wins: a device
+# route beats a rule route, beats a network route, beats an account route. Events without a matching route go to the
+# default recipients (TWILIO_PHONE_RCPTS).
+# Resolving an event's recipients is at most one dict lookup per combination of fields used by any route (16 at most).
+
+import json
+import logging
+from typing import Dict, List, NamedTuple, Tuple
+from .dataTypes import Event, toE164Tuple
+from .settings import ImonnitTwilioConnectorConfig, TwilioConfig
+
+
+logger = logging.getLogger(__name__)
+
+
+class Route(NamedTuple):
+    accountID: int | None  # None matches any
+    networkID: int | None
+    deviceID: int | None
+    rule: str | None
+    recipients: Tuple[str, ...]
+
+
+class RecipientRouter:
+    wildcard = "*"
+
+    # route fields and their precedence bits -- a more specific route has a higher mask
+    _fields = (("accountID", 1), ("networkID", 2), ("rule", 4), ("deviceID", 8))
+
+    def __init__(self,
+                 defaultRecipients: List[str] = TwilioConfig.Recipients,
+                 source: str = ImonnitTwilioConnectorConfig.Routes):
+        self.defaultRecipients = toE164Tuple(defaultRecipients)
+        self.source = source  # json file path, "db", or "" for default recipients only
+
+        self._index = {}  # (mask, *field values): recipients
+        self._masks = ()  # masks used by any route, most specific first
+        self.routeCount = 0
+
+    @staticmethod
+    def _ruleKey(rule: str | None) -> str | None:
+        return rule.strip().casefold() if rule is not None else None
+
+    @classmethod
+    def _key(cls, mask: int, accountID, networkID, deviceID, rule) -> Tuple | None:
+        """Returns index key of field values for mask. None if a field in mask has no value."""
+        values = {"accountID": accountID, "networkID": networkID, "deviceID": deviceID, "rule": cls._ruleKey(rule)}
+        key = [mask]
+        for field, bit in cls._fields:
+            if mask & bit:
+                if values[field] is None:
+                    return None
+                key.append(values[field])
+        return tuple(key)
+
+    @classmethod
+    def _mask(cls, route: Route) -> int:
+        return sum(bit for field, bit in cls._fields if getattr(route, field) is not None)
+
+    def compile(self, routes: List[Route]) -> None:
+        """Replaces the routing index with routes. Raises ValueError on duplicate routes."""
+        index = {}
+        for route in routes:
+            key = RecipientRouter._key(RecipientRouter._mask(route), route.accountID, route.networkID, route.deviceID,
+                                       route.rule)
+            if key in index:
+                raise ValueError(f"Duplicate route: {route}")
+            index[key] = tuple(route.recipients)
+
+        self._index = index
+        self._masks = tuple(sorted({key[0] for key in index}, reverse=True))
+        self.routeCount = len(routes)
+
+    @classmethod
+    def parseRoute(cls, item: Dict) -> Route:
+        """Parses a json route: {"accountID", "networkID", "deviceID", "rule", "recipients"}, missing or "*" fields match any.
+        Recipients are normalized to E.164. Raises ValueError on invalid recipients."""
+        def field(name, convert):
+            value = item.get(name)
+            if value is None or value == cls.wildcard:
+                return None
+            return convert(value)
+
+        recipients = item.get("recipients")
+        if recipients is None:
+            raise ValueError(f"Route has no recipients: {item}")
+        if isinstance(recipients, str):
+            recipients = recipients.split(",")
+        return Route(accountID=field("accountID", int),
+                     networkID=field("networkID", int),
+                     deviceID=field("deviceID", int),
+                     rule=field("rule", str),
+                     recipients=toE164Tuple(filter(None, (recipient.strip() for recipient in recipients))))
+
+    def load(self, dbConn=None) -> bool:
+        """Loads and compiles routes from source. Returns True on success (or no source), False otherwise."""
+        if not self.source:
+            return True
+
+        try:
+            if self.source == "db":
+                rows = dbConn.getRoutes()
+                if rows is None:
+                    raise ValueError("Unable to read Route table")
+                items = [{"accountID": accountId, "networkID": networkId, "deviceID": deviceId, "rule": rule,
+                          "recipients": recipients} for accountId, networkId, deviceId, rule, recipients in rows]
+            else:
+                with open(self.source, "r") as f:
+                    items = json.load(f)
+
+            self.compile([RecipientRouter.parseRoute(item) for item in items])
+        except Exception as e:
+            logger.error(f"Unable to load recipient routes from {self.source}: {e}")
+            return False
+
+        logger.info(f"Loaded {self.routeCount} recipient route(s) from {self.source}")
+        return True
+
+    @property
+    def hasRecipients(self) -> bool:
+        """True if any event could have recipients."""
+        return bool(self.defaultRecipients) or any(self._index.values())
+
+    def recipientsFor(self, event: Event) -> Tuple[str, ...]:
+        """Returns recipients of the most specific route matching event, default recipients if none match."""
+        for mask in self._masks:
+            key = RecipientRouter._key(mask, event.accountID, event.networkID, event.deviceID, event.rule)
+            if key is not None:
+                recipients = self._index.get(key)
+                if recipients is not None:
+                    return recipients
+        return self.defaultRecipients
+
+
+if __name__ == "__main__":
+    # testing - no db or Twilio required
+    TestRouter = RecipientRouter(defaultRecipients=["+11234567890"], source="")
+    TestRouter.compile([RecipientRouter.parseRoute(item) for item in [
+        {"accountID": 1, "recipients": ["+11234567891"]},
+        {"accountID": 1, "networkID": 10, "recipients": "+11234567892,+11234567893"},
+        {"networkID": 10, "rule": "Battery Low", "recipients": ["+11234567894"]},
+        {"accountID": "*", "deviceID": 100, "recipients": ["+11234567895"]},
+        {"accountID": 2, "recipients": []},  # silenced
+    ]])
+    assert TestRouter.routeCount == 5
+
+    def event(**kwargs):
+        return Event(**({"rule": "Gateway offline"} | kwargs))
+
+    assert TestRouter.recipientsFor(event()) == ("+11234567890",)
+    assert TestRouter.recipientsFor(event(accountID="1")) == ("+11234567891",)
+    assert TestRouter.recipientsFor(event(accountID="1", networkID="10")) == ("+11234567892", "+11234567893")
+    assert TestRouter.recipientsFor(event(accountID="1", networkID="10", rule=" battery low")) == ("+11234567894",)
+    assert TestRouter.recipientsFor(event(accountID="1", networkID="10", deviceID="100", rule="Battery Low")) == ("+11234567895",)
+    assert TestRouter.recipientsFor(event(accountID="2", networkID="10")) == ()
+    assert TestRouter.hasRecipients
+
+    # duplicate routes rejected, router unchanged
+    exceptionThrown = False
+    try:
+        TestRouter.compile([Route(1, None, None, None, ()), Route(1, None, None, None, ("+11234567890",))])
+    except ValueError:
+        exceptionThrown = True
+    assert exceptionThrown
+    assert TestRouter.routeCount == 5
+
+    # recipients normalized, invalid recipients fail
+    assert RecipientRouter.parseRoute({"recipients": "+1 123 456 7891, +11234567891"}).recipients == ("+11234567891",)
+    exceptionThrown = False
+    try:
+        RecipientRouter.parseRoute({"rule": "rule", "recipients": ["+1aaabbbcccc"]})
+    except ValueError:
+        exceptionThrown = True
+    assert exceptionThrown
+
+    # missing file fails
+    assert not RecipientRouter(source="/nonexistent/routes.json").load()
@@ -0,0 +1,148 @@
+# senderPool.py
+# By: Ethan Jansen
+# Pool of Twilio senders: phone numbers, or a Messaging Service SID (Twilio picks the number).
+# Each recipient keeps a stable sender (rendezvous hashing), so conversations stay on one number and adding or removing
+# a sender only moves the recipients of that sender. Senders failing repeatedly are skipped for a cooldown.
+
+from hashlib import blake2b
+import logging
+import threading
+from time import monotonic
+from typing import Callable, Dict, List
+from .metrics import twilioSenderMessages
+
+
+logger = logging.getLogger(__name__)
+
+
+class SenderHealth:
+    def __init__(self):
+        self.sent = 0
+        self.failed = 0
+        self.consecutiveFailures = 0
+        self.unhealthyUntil = 0.0  # clock time
+
+
+class SenderPool:
+    # Twilio error codes blaming the sender, not the recipient: invalid, not SMS capable, or not owned From number
+    senderErrorCodes = frozenset((21212, 21606, 21659, 21660))
+
+    def __init__(self,
+                 senders: List[str],
+                 failureThreshold: int = 3,
+                 cooldown: float = 60,
+                 clock: Callable[[], float] = monotonic):
+        if not senders:
+            raise ValueError("Sender pool requires at least one sender")
+
+        self.senders = list(dict.fromkeys(senders))  # unique, in order
+        self.failureThreshold = max(failureThreshold, 1)  # consecutive failures before a sender is skipped
+        self.cooldown = cooldown  # seconds a failing sender is skipped
+        self._clock = clock
+
+        self._health = {sender: SenderHealth() for sender in self.senders}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.senders)
+
+    @staticmethod
+    def isMessagingService(sender: str) -> bool:
+        return sender.startswith("MG")
+
+    @staticmethod
+    def _weight(sender: str, recipient: str) -> bytes:
+        return blake2b(f"{sender}|{recipient}".encode(), digest_size=8).digest()
+
+    def ranked(self, recipient: str) -> List[str]:
+        """Returns all senders in recipient's stable order of preference."""
+        if len(self.senders) == 1:
+            return self.senders
+        return sorted(self.senders, key=lambda sender: SenderPool._weight(sender, recipient), reverse=True)
+
+    def senderFor(self, recipient: str) -> str:
+        """Returns recipient's preferred healthy sender. Returns recipient's preferred sender if none are healthy."""
+        ranked = self.ranked(recipient)
+        now = self._clock()
+        for sender in ranked:
+            if self._health[sender].unhealthyUntil <= now:
+                return sender
+        return ranked[0]
+
+    def record(self, sender: str, success: bool) -> None:
+        """Records the result of a send from sender. Failures are sender errors, throttling, or Twilio server errors."""
+        twilioSenderMessages.inc(labels=(sender, "success" if success else "failure"))
+        health = self._health.get(sender)
+        if health is None:
+            return
+
+        with self._lock:
+            if success:
+                health.sent += 1
+                health.consecutiveFailures = 0
+                return
+
+            health.failed += 1
+            health.consecutiveFailures += 1
+            if health.consecutiveFailures >= self.failureThreshold:
+                health.consecutiveFailures = 0
+                health.unhealthyUntil = self._clock() + self.cooldown
+                unhealthy = True
+            else:
+                unhealthy = False
+
+        if unhealthy:
+            logger.warning(f"Sender {sender} failed {self.failureThreshold} times in a row, skipping it for {self.cooldown} seconds")
+
+    @classmethod
+    def blamesSender(cls, status: int | None, code: int | None) -> bool:
+        """Returns True if a failed request (HTTP status, Twilio error code) counts against the sender's health."""
+        return code in cls.senderErrorCodes or status == 429 or (status is not None and status >= 500)
+
+    def stats(self) -> Dict[str, dict]:
+        """Returns {sender: {"sent", "failed", "healthy"}}."""
+        now = self._clock()
+        with self._lock:
+            return {sender: {"sent": health.sent,
+                             "failed": health.failed,
+                             "healthy": health.unhealthyUntil <= now}
+                    for sender, health in self._health.items()}
+
+
+if __name__ == "__main__":
+    # testing - no Twilio required
+    now = [0.0]
+    senders = ["+15005550001", "+15005550002", "+15005550003"]
+    recipients = [f"+1123456{i:04}" for i in range(300)]
+    TestPool = SenderPool(senders, failureThreshold=2, cooldown=60, clock=lambda: now[0])
+
+    # stable, and spread across all senders
+    assignments = {recipient: TestPool.senderFor(recipient) for recipient in recipients}
+    assert assignments == {recipient: TestPool.senderFor(recipient) for recipient in recipients}
+    counts = [list(assignments.values()).count(sender) for sender in senders]
+    assert all(count > 50 for count in counts)
+
+    # removing a sender only moves its own recipients
+    SmallerPool = SenderPool(senders[:2])
+    assert all(SmallerPool.senderFor(recipient) == sender for recipient, sender in assignments.items() if sender != senders[2])
+
+    # failing sender skipped during cooldown, then used again
+    TestPool.record(senders[0], False)
+    assert TestPool.stats()[senders[0]]["healthy"]
+    TestPool.record(senders[0], False)
+    assert not TestPool.stats()[senders[0]]["healthy"]
+    moved = [recipient for recipient, sender in assignments.items() if sender == senders[0]]
+    assert all(TestPool.senderFor(recipient) != senders[0] for recipient in moved)
+    now[0] = 61
+    assert all(TestPool.senderFor(recipient) == senders[0] for recipient in moved)
+
+    # all unhealthy: preferred sender anyway
+    OnePool = SenderPool([senders[0]], failureThreshold=1, clock=lambda: now[0])
+    OnePool.record(senders[0], False)
+    assert OnePool.senderFor(recipients[0]) == senders[0]
+
+    # failures blamed on the sender
+    assert SenderPool.blamesSender(400, 21606)
+    assert SenderPool.blamesSender(503, None)
+    assert not SenderPool.blamesSender(400, 21211)  # invalid To number
+    assert SenderPool.isMessagingService("MG0123456789abcdef0123456789abcdef")
@@ -2,18 +2,30 @@
 # By: Ethan Jansen
 # OS Environment Variable Settings
 
-from flask.logging import default_handler
+from .dataTypes import toE164Tuple
 import logging
+from .logPipeline import JsonFormatter, LogPipeline
 from os import environ, urandom
 import sys
 
 
-# Logging Config
+class LogConfig:
+    Format = environ.get("IMONNIT_TWILIO_CONNECTOR_LOG_FORMAT", "text")  # text or json (one object per line)
+    Burst = int(environ.get("IMONNIT_TWILIO_CONNECTOR_LOG_BURST", "10"))  # records per call site per interval, 0 is unlimited
+    Interval = float(environ.get("IMONNIT_TWILIO_CONNECTOR_LOG_INTERVAL", "60"))  # seconds
+
+
+# Logging Config -- records are queued by the thread logging them, written out by the log pipeline's listener thread
+# (flask does not add its default_handler once the app logger has this handler)
 logging.getLogger().addHandler(logging.NullHandler())
 appLog = logging.getLogger(__package__)
-default_handler.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s in %(name)s: %(message)s"))
-appLog.addHandler(default_handler)
+logOutput = logging.StreamHandler(sys.stderr)
+logOutput.setFormatter(JsonFormatter() if LogConfig.Format == "json" else
+                       logging.Formatter("[%(asctime)s] %(levelname)s in %(name)s: %(message)s"))
+logPipeline = LogPipeline(logOutput, LogConfig.Burst, LogConfig.Interval)
+appLog.addHandler(logPipeline.queueHandler)
 appLog.setLevel(logging.INFO)
+logPipeline.start()
 SettingsLog = logging.getLogger(__name__)
 
 
@@ -37,6 +49,24 @@ class ImonnitTwilioConnectorConfig:
 
     # Optional Settings
     ServerSecret = environ.get("IMONNIT_TWILIO_CONNECTOR_SECRET", urandom(24))
+    OutboxWorkers = int(environ.get("IMONNIT_TWILIO_CONNECTOR_OUTBOX_WORKERS", "4"))  # 0 sends SMS within the webhook
+    OutboxPollInterval = float(environ.get("IMONNIT_TWILIO_CONNECTOR_OUTBOX_POLL", "5"))  # seconds
+    OutboxLease = int(environ.get("IMONNIT_TWILIO_CONNECTOR_OUTBOX_LEASE", "300"))  # seconds
+    CallbackBatchSize = int(environ.get("IMONNIT_TWILIO_CONNECTOR_CALLBACK_BATCH", "50"))  # 0 writes each callback within the webhook
+    CallbackFlushInterval = float(environ.get("IMONNIT_TWILIO_CONNECTOR_CALLBACK_FLUSH", "1"))  # seconds
+    CallbackGrace = float(environ.get("IMONNIT_TWILIO_CONNECTOR_CALLBACK_GRACE", "30"))  # seconds an unmatched callback is retried
+    DedupCacheSize = int(environ.get("IMONNIT_TWILIO_CONNECTOR_DEDUP_CACHE", "1024"))  # events, 0 checks db only
+    DedupTTL = float(environ.get("IMONNIT_TWILIO_CONNECTOR_DEDUP_TTL", "86400"))  # seconds
+    CoalesceWindow = float(environ.get("IMONNIT_TWILIO_CONNECTOR_COALESCE_WINDOW", "0"))  # seconds, 0 sends every alert
+    CoalesceKey = environ.get("IMONNIT_TWILIO_CONNECTOR_COALESCE_KEY", "device")  # device, network, or rule
+    Routes = environ.get("IMONNIT_TWILIO_CONNECTOR_ROUTES", "")  # recipient routes json file, "db" for Route table, or unset
+    ApiConcurrency = int(environ.get("IMONNIT_TWILIO_CONNECTOR_API_CONCURRENCY", "2"))  # history reads using db connections at once
+    ApiTimeout = float(environ.get("IMONNIT_TWILIO_CONNECTOR_API_TIMEOUT", "5"))  # seconds a history read waits for its turn
+    ExportConcurrency = int(environ.get("IMONNIT_TWILIO_CONNECTOR_EXPORT_CONCURRENCY", "1"))  # history exports at once
+    ExportBatchSize = int(environ.get("IMONNIT_TWILIO_CONNECTOR_EXPORT_BATCH", "1000"))  # rows read from db at a time
+    HealthDbInterval = float(environ.get("IMONNIT_TWILIO_CONNECTOR_HEALTH_DB_INTERVAL", "5"))  # seconds between db checks
+    HealthTwilioInterval = float(environ.get("IMONNIT_TWILIO_CONNECTOR_HEALTH_TWILIO_INTERVAL", "60"))  # seconds between Twilio checks
+    AsgiThreads = int(environ.get("IMONNIT_TWILIO_CONNECTOR_ASGI_THREADS", "8"))  # asgi server: threads for history api reads
 
 
 class TwilioConfig:
@@ -45,14 +75,38 @@ class TwilioConfig:
         AccountSid = environ["TWILIO_ACCOUNT_SID"]
         ApiSid = environ["TWILIO_API_SID"]
         ApiSecret = environ["TWILIO_API_SECRET"]
-        PhoneSource = environ["TWILIO_PHONE_SRC"]
     except Exception as e:
         errorHandler(e)
 
+    # Senders: pool of phone numbers, or a Messaging Service (one is required)
+    PhoneSources = list(filter(None, environ.get("TWILIO_PHONE_SRC", "").split(",")))
+    MessagingServiceSid = environ.get("TWILIO_MESSAGING_SERVICE_SID")
+    if not PhoneSources and not MessagingServiceSid:
+        errorHandler(KeyError("TWILIO_PHONE_SRC"))
+    Senders = [MessagingServiceSid] if MessagingServiceSid else PhoneSources
+
     # Optional Settings
-    Recipients = list(filter(None, environ.get("TWILIO_PHONE_RCPTS", "").split(",")))
+    try:
+        Recipients = toE164Tuple(filter(None, (x.strip() for x in environ.get("TWILIO_PHONE_RCPTS", "").split(","))))
+    except ValueError as e:
+        SettingsLog.fatal(f"Invalid TWILIO_PHONE_RCPTS: {e}")
+        sys.exit(1)
+    AuthToken = environ.get("TWILIO_AUTH_TOKEN")  # verifies status callback signatures instead of Basic Authorization
     UseCallback = "TWILIO_CALLBACK" in environ and environ["TWILIO_CALLBACK"] != "false"
     ErrorCodeFile = environ.get("TWILIO_ERROR_DICTIONARY_FILE", "/server/twilio-error-codes.json")
+    SendConcurrency = int(environ.get("TWILIO_SEND_CONCURRENCY", "4"))  # max simultaneous messages.create requests
+    SendRate = float(environ.get("TWILIO_SEND_RATE", "0"))  # messages per second per sender number, 0 is unlimited
+    SendRates = environ.get("TWILIO_SEND_RATES", "")  # per sender overrides: "+1aaabbbcccc=10,+1dddeeeffff=3"
+    SendBurst = float(environ.get("TWILIO_SEND_BURST", "1"))  # messages sent at once before limiting
+    SenderCooldown = float(environ.get("TWILIO_SENDER_COOLDOWN", "60"))  # seconds a repeatedly failing sender is skipped
+    SendMaxWait = float(environ.get("TWILIO_SEND_MAX_WAIT", "300"))  # seconds, longer waits fail instead of queueing
+    RetryLimit = int(environ.get("TWILIO_RETRY_LIMIT", "3"))  # retries of a throttled (429) or 5xx send, 0 disables
+    RetryDelay = float(environ.get("TWILIO_RETRY_DELAY", "5"))  # seconds before the first retry, doubled for each retry
+    RetryMaxDelay = float(environ.get("TWILIO_RETRY_MAX_DELAY", "300"))  # seconds
+    ApiBaseUrl = environ.get("TWILIO_API_BASE_URL")  # replaces https://*.twilio.com in API requests (local mock or emulator)
+    Emulator = "TWILIO_EMULATOR" in environ and environ["TWILIO_EMULATOR"] != "false"  # in-process emulator, never contacts Twilio
+    EmulatorCallbackUrl = environ.get("TWILIO_EMULATOR_CALLBACK_URL",
+                                      f"http://127.0.0.1:{environ.get('IMONNIT_TWILIO_CONNECTOR_PORT', '5080')}")
     Debug = "TWILIO_DEBUG" in environ and environ["TWILIO_DEBUG"] != "false"  # INFO if set, WARN if unset
 
 
@@ -68,3 +122,11 @@ class DbConfig:
     # Optional Settings
     Host = environ.get("MYSQL_HOSTNAME", "imonnitTwilioConnector-db")
     Port = int(environ.get("MYSQL_TCP_PORT", "3306"))
+    PoolSize = int(environ.get("MARIADB_POOL_SIZE", "8"))  # 1-64 connections
+    PoolTimeout = float(environ.get("MARIADB_POOL_TIMEOUT", "10"))  # seconds to wait for a free connection
+    AutoMigrate = environ.get("MARIADB_AUTO_MIGRATE", "true") != "false"
+    RetentionMonths = int(environ.get("MARIADB_RETENTION_MONTHS", "36"))  # months of history kept, 0 keeps everything
+    RetentionMonthsAhead = int(environ.get("MARIADB_RETENTION_MONTHS_AHEAD", "3"))  # partitioned tables: months created ahead
+    RetentionInterval = float(environ.get("MARIADB_RETENTION_INTERVAL", "86400"))  # seconds between retention runs
+    RetentionChunkSize = int(environ.get("MARIADB_RETENTION_CHUNK", "1000"))  # unpartitioned tables: events deleted per transaction
+    RetentionChunkPause = float(environ.get("MARIADB_RETENTION_CHUNK_PAUSE", "0.5"))  # seconds between delete chunks
@@ -2,26 +2,62 @@
 # By: Ethan Jansen
 # Twilio Client
 
-from json import load as jsonLoad
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from json import dump as jsonDump, load as jsonLoad
 import logging
+import os
+import re
+from requests.adapters import HTTPAdapter
 from twilio.base.exceptions import TwilioRestException
+from twilio.http.async_http_client import AsyncTwilioHttpClient
 from twilio.http.http_client import TwilioHttpClient
 from twilio.rest import Client as TwilioClient
+import threading
+from time import perf_counter
 from typing import List, Tuple
+from .auth import twilioSignature
 from .settings import TwilioConfig, ImonnitTwilioConnectorConfig
-from .dataTypes import Message, ValidationError
+from .dataTypes import Message, toE164
+from .logPipeline import audit
+from .metrics import errorCodeLookups, twilioCreateSeconds, twilioQueueSeconds
+from .rateLimit import SenderRateLimiter, parseRates
+from .senderPool import SenderPool
 
 # logging setup
 defaultLog = logging.getLogger(__name__)
 
 
+# Sends Twilio API requests to baseUrl instead of https://*.twilio.com
+class BaseUrlHttpClient(TwilioHttpClient):
+    _twilioUrl = re.compile(r"^https://[a-z0-9.-]*twilio\.com")
+
+    def __init__(self, baseUrl: str, **kwargs):
+        super().__init__(**kwargs)
+        self.baseUrl = baseUrl.rstrip("/")
+
+    def request(self, method, url, *args, **kwargs):
+        return super().request(method, BaseUrlHttpClient._twilioUrl.sub(self.baseUrl, url, count=1), *args, **kwargs)
+
+
+class BaseUrlAsyncHttpClient(AsyncTwilioHttpClient):
+    def __init__(self, baseUrl: str, **kwargs):
+        super().__init__(**kwargs)
+        self.baseUrl = baseUrl.rstrip("/")
+
+    async def request(self, method, url, *args, **kwargs):
+        return await super().request(method, BaseUrlHttpClient._twilioUrl.sub(self.baseUrl, url, count=1), *args, **kwargs)
+
+
 class TwilioSMSClient:
     class ClientReturn:
         def __init__(self, nothingSent: bool, messages: Message):
             self.nothingSent = nothingSent
             self.messages = messages
 
-    def __init__(self, logger: str = None, debug: str = TwilioConfig.Debug, useCallback: str = TwilioConfig.UseCallback):
+    def __init__(self, logger: str = None, debug: str = TwilioConfig.Debug, useCallback: str = TwilioConfig.UseCallback,
+                 concurrency: int = TwilioConfig.SendConcurrency, apiBaseUrl: str | None = TwilioConfig.ApiBaseUrl,
+                 rateLimiter: SenderRateLimiter | None = None, senders: List[str] | None = None):
         # logging
         self._logger = logger
         if not self._logger:
@@ -29,86 +65,233 @@ class TwilioSMSClient:
         self._httpLog = logging.getLogger(self._logger.name+".httpclient")
         self._httpLog.setLevel(20 if debug else 30)
 
-        # client config
+        # client config -- the async client (asgi app) is created on first use, in the event loop
+        self.apiBaseUrl = apiBaseUrl
+        self._asyncTwilio = None
+        self._asyncSemaphore = None
+        if apiBaseUrl:
+            httpClient = BaseUrlHttpClient(apiBaseUrl, logger=self._httpLog)
+            self._logger.warning(f"Sending Twilio API requests to {apiBaseUrl}")
+        else:
+            httpClient = TwilioHttpClient(logger=self._httpLog)
         self._client = TwilioClient(username=TwilioConfig.ApiSid,
                                     password=TwilioConfig.ApiSecret,
                                     account_sid=TwilioConfig.AccountSid,
-                                    http_client=TwilioHttpClient(logger=self._httpLog))
-
-        # to/from
-        self.from_ = TwilioConfig.PhoneSource
+                                    http_client=httpClient)
+
+        # concurrent sends: bounded thread pool, keep enough pooled https connections for every thread
+        self.concurrency = max(concurrency, 1)
+        self._executor = None
+        if self.concurrency > 1:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="twilio-send")
+            httpClient.session.mount("https://", HTTPAdapter(pool_maxsize=max(self.concurrency, 10)))
+
+        # smooth requests to each sender's messages per second limit, excess waits instead of failing with 429
+        self.rateLimiter = rateLimiter
+        if self.rateLimiter is None:
+            self.rateLimiter = SenderRateLimiter(defaultRate=TwilioConfig.SendRate,
+                                                 rates=parseRates(TwilioConfig.SendRates),
+                                                 burst=TwilioConfig.SendBurst,
+                                                 maxWait=TwilioConfig.SendMaxWait)
+
+        # to/from -- every recipient keeps one sender of the pool, each sender has its own rate limit
+        self.senderPool = SenderPool(senders or TwilioConfig.Senders, cooldown=TwilioConfig.SenderCooldown)
         self.recipientList = TwilioConfig.Recipients
 
-        # callback url
+        # callback url -- signed callbacks need no credentials (and no 401 challenge before Twilio sends them)
         self.callbackUrl = None
         if useCallback:
-            self.callbackUrl = (f"https://{ImonnitTwilioConnectorConfig.WebhookUser}:"
-                                f"{ImonnitTwilioConnectorConfig.WebhookPassword}@"
-                                f"{ImonnitTwilioConnectorConfig.Hostname}/webhook/twilio")
-            self._logger.info("Using Twilio status callbacks.")
+            if twilioSignature.enabled:
+                self.callbackUrl = twilioSignature.url
+                self._logger.info("Using Twilio status callbacks, authenticated by signature.")
+            else:
+                self.callbackUrl = (f"https://{ImonnitTwilioConnectorConfig.WebhookUser}:"
+                                    f"{ImonnitTwilioConnectorConfig.WebhookPassword}@"
+                                    f"{ImonnitTwilioConnectorConfig.Hostname}/webhook/twilio")
+                self._logger.info("Using Twilio status callbacks.")
 
     # Get recipient list length
     @property
     def recipientListLength(self) -> int:
         return len(self.recipientList)
 
+    # Single recipient SMS sender
+    # Arg: E.164 recipient phone number (validated when configured, see dataTypes.toE164), string message body.
+    # Sent from recipient's sender, waits for its rate limit first.
+    # Returns: Message with Twilio status. Status is "failed" with errorCode/errorMessage if Twilio raised an exception
+    # (or the rate limit wait would be longer than TWILIO_SEND_MAX_WAIT).
+    # Returns: None if an unexpected error occured (nothing to record)
+    def sendTo(self, recipient: str, body: str) -> Message | None:
+        try:
+            # wait for sender's rate limit
+            sender = self.senderPool.senderFor(recipient)
+            waited = self.rateLimiter.acquire(sender)
+            if waited is None:
+                return self._rateLimited(sender, recipient)
+            twilioQueueSeconds.observe(waited, (sender,))
+
+            start = perf_counter()
+            try:
+                msg = self._client.messages.create(**self._createArgs(sender, recipient, body))
+            except Exception as e:
+                self._createFailed(sender, e, start)
+                raise
+            return self._created(sender, recipient, msg, start)
+
+        except TwilioRestException as e:
+            return self._restFailed(recipient, e)
+
+        except Exception as e:
+            self._logger.error(f"Unexpected error when sending message to {recipient}: {e}")
+
+        return None
+
+    # sendTo for asyncio callers (the asgi app): waits for the rate limit and Twilio without blocking the event loop
+    async def sendToAsync(self, recipient: str, body: str) -> Message | None:
+        try:
+            sender = self.senderPool.senderFor(recipient)
+            waited = await self.rateLimiter.acquireAsync(sender)
+            if waited is None:
+                return self._rateLimited(sender, recipient)
+            twilioQueueSeconds.observe(waited, (sender,))
+
+            async with self._asyncSends():
+                start = perf_counter()
+                try:
+                    msg = await self._asyncClient().messages.create_async(**self._createArgs(sender, recipient, body))
+                except Exception as e:
+                    self._createFailed(sender, e, start)
+                    raise
+            return self._created(sender, recipient, msg, start)
+
+        except TwilioRestException as e:
+            return self._restFailed(recipient, e)
+
+        except Exception as e:
+            self._logger.error(f"Unexpected error when sending message to {recipient}: {e}")
+
+        return None
+
+    # Messages are built with model_construct: recipient is already valid, other fields come from Twilio
+    def _rateLimited(self, sender: str, recipient: str) -> Message:
+        self._logger.error(f"Sender {sender} rate limit queue is full, not sending message to {recipient}")
+        return Message.model_construct(recipient=recipient,
+                                       status="failed",
+                                       errorCode=429,
+                                       errorMessage="Sender rate limit queue is full")
+
+    def _createArgs(self, sender: str, recipient: str, body: str) -> dict:
+        # Twilio picks the number of a Messaging Service
+        if SenderPool.isMessagingService(sender):
+            source = {"messaging_service_sid": sender}
+        else:
+            source = {"from_": sender}
+        return source | {"to": recipient, "body": body, "status_callback": self.callbackUrl}
+
+    def _createFailed(self, sender: str, e: Exception, start: float) -> None:
+        twilioCreateSeconds.observe(perf_counter() - start, ("error",))
+        if isinstance(e, TwilioRestException) and SenderPool.blamesSender(e.status, e.code):
+            self.senderPool.record(sender, False)
+
+    def _created(self, sender: str, recipient: str, msg, start: float) -> Message:
+        twilioCreateSeconds.observe(perf_counter() - start, (msg.status,))
+        self.senderPool.record(sender, True)
+        """
+        sid - unique twilio message id
+        status - status of message (queued, sending, sent, failed, delivered, undelivered, receiving, received)
+        error_code - Error code if message status is failed or undeliverd, otherwise None
+        error_message - Description of error_code, None if no error
+        """
+        if msg.status == "canceled" or msg.status == "failed":
+            self._logger.warning(f"Created message {msg.sid} to {recipient}, but with status = {msg.status}", extra=audit)
+        else:
+            self._logger.info(f"Successfully created message {msg.sid} to {recipient}. Status = {msg.status}", extra=audit)
+
+        return Message.model_construct(messageId=msg.sid,
+                                       recipient=recipient,
+                                       status=msg.status,
+                                       errorCode=msg.error_code,
+                                       errorMessage=msg.error_message)
+
+    def _restFailed(self, recipient: str, e: TwilioRestException) -> Message:
+        self._logger.error(f"\"{e.msg}\" Status = {e.status}")
+        return Message.model_construct(recipient=recipient,
+                                       status="failed",
+                                       errorCode=e.status,
+                                       errorMessage=e.msg)
+
+    # Twilio client over aiohttp, created in the running event loop on first use
+    def _asyncClient(self) -> TwilioClient:
+        if self._asyncTwilio is None:
+            if self.apiBaseUrl:
+                httpClient = BaseUrlAsyncHttpClient(self.apiBaseUrl, logger=self._httpLog)
+            else:
+                httpClient = AsyncTwilioHttpClient(logger=self._httpLog)
+            self._asyncTwilio = TwilioClient(username=TwilioConfig.ApiSid,
+                                             password=TwilioConfig.ApiSecret,
+                                             account_sid=TwilioConfig.AccountSid,
+                                             http_client=httpClient)
+        return self._asyncTwilio
+
+    # at most concurrency Twilio requests at once, as the thread pool of send
+    def _asyncSends(self) -> asyncio.Semaphore:
+        if self._asyncSemaphore is None:
+            self._asyncSemaphore = asyncio.Semaphore(self.concurrency)
+        return self._asyncSemaphore
+
+    # Closes the aiohttp session of the async client (asgi app shutdown)
+    async def closeAsync(self) -> None:
+        if self._asyncTwilio is not None:
+            await self._asyncTwilio.http_client.close()
+            self._asyncTwilio = None
+            self._asyncSemaphore = None
+
+    # Health check: fetches the Twilio account (no message is sent). Raises on error, including suspended accounts.
+    def ping(self) -> None:
+        account = self._client.api.v2010.accounts(TwilioConfig.AccountSid).fetch()
+        if account.status != "active":
+            raise ValueError(f"Twilio account is {account.status}")
+
     # Default SMS sender
-    # Arg: string message body.
+    # Arg: string message body. Optional recipients list, defaults to recipientList.
     # Returns: Tuple[nothingSent: bool, List[sentStatus: Message]]. nothingSent is True if all messages failed to send, False if any message succeeded
     # Returns: list of (recipient, TwilioRestException.msg, TwilioRestException.status) for all exceptions occured. Empty list on complete success
-    def send(self, body: str) -> Tuple[bool, List[Message]]:
-        messages = []
-        failedCount = 0
-        nothingSent = False
-
+    def send(self, body: str, recipients: List[str] | None = None) -> Tuple[bool, List[Message]]:
+        if recipients is None:
+            recipients = self.recipientList
         if not body:
             self._logger.error("Message body cannot be empty!")
-            return TwilioSMSClient.ClientReturn(nothingSent=True,
-                                                messages=messages)
+            return TwilioSMSClient.ClientReturn(nothingSent=True, messages=[])
         self._logger.info("Sending SMS with Twilio")
 
-        # Send Loop
-        for recipient in self.recipientList:
-            try:
-                # test for valid recipient
-                Message.model_validate({"recipient": recipient})
-
-                # send message
-                msg = self._client.messages.create(from_=self.from_,
-                                                   to=recipient,
-                                                   body=body,
-                                                   status_callback=self.callbackUrl)
-                """
-                sid - unique twilio message id
-                status - status of message (queued, sending, sent, failed, delivered, undelivered, receiving, received)
-                error_code - Error code if message status is failed or undeliverd, otherwise None
-                error_message - Description of error_code, None if no error
-                """
-                messages.append(Message(messageId=msg.sid,
-                                        recipient=recipient,
-                                        status=msg.status,
-                                        errorCode=msg.error_code,
-                                        errorMessage=msg.error_message))
-
-                if msg.status == "canceled" or msg.status == "failed":
-                    self._logger.warning("Created message {msg.sid} to {recipient}, but with status = {msg.status}")
-                else:
-                    self._logger.info(f"Successfully created message {msg.sid} to {recipient}. Status = {msg.status}")
-
-            except TwilioRestException as e:
-                self._logger.error(f"\"{e.msg}\" Status = {e.status}")
-                messages.append(Message(recipient=recipient,
-                                        status="failed",
-                                        errorCode=e.status,
-                                        errorMessage=e.msg))
-                failedCount += 1
+        # Send Loop -- concurrent if configured, results stay in recipient order
+        if self._executor and len(recipients) > 1:
+            results = self._executor.map(lambda recipient: self.sendTo(recipient, body), recipients)
+        else:
+            results = (self.sendTo(recipient, body) for recipient in recipients)
+        return self._sent(list(results), recipients)
 
-            except ValidationError as e:
-                self._logger.error(f"Unable to validate Message: {e}")
-                failedCount += 1
+    # send for asyncio callers (the asgi app), recipients are sent concurrently (up to concurrency at once)
+    async def sendAsync(self, body: str, recipients: List[str] | None = None) -> Tuple[bool, List[Message]]:
+        if recipients is None:
+            recipients = self.recipientList
+        if not body:
+            self._logger.error("Message body cannot be empty!")
+            return TwilioSMSClient.ClientReturn(nothingSent=True, messages=[])
+        self._logger.info("Sending SMS with Twilio")
 
-            except Exception as e:
-                self._logger.error(f"Unexpected error when sending message to {recipient}: {e}")
+        results = await asyncio.gather(*(self.sendToAsync(recipient, body) for recipient in recipients))
+        return self._sent(results, recipients)
+
+    def _sent(self, results: List[Message | None], recipients: List[str]) -> "TwilioSMSClient.ClientReturn":
+        messages = []
+        failedCount = 0
+        nothingSent = False
+        for msg in results:
+            if msg is not None:
+                messages.append(msg)
+            # messages without a Twilio sid were never created
+            if msg is None or msg.messageId is None:
                 failedCount += 1
 
         if not failedCount:
@@ -116,7 +299,7 @@ class TwilioSMSClient:
         else:
             self._logger.warning(f"Failed to send {failedCount} message(s).")
 
-        if failedCount >= self.recipientListLength:
+        if failedCount >= len(recipients):
             self._logger.warning("Unable to send anything with Twilio. Likely throttled, no valid recipients, or invalid from number.")
             nothingSent = True
 
@@ -124,22 +307,63 @@ class TwilioSMSClient:
                                             messages=messages)
 
 
+# Twilio error code dictionary. Loaded once into an int keyed index, reloaded when the file's mtime changes.
+# Accepts Twilio's published list of {"code": ..., "message": ...} objects or a compact {"code": "message"} object.
 class TwilioErrorCodes:
     filePath = TwilioConfig.ErrorCodeFile
+    missCount = 0  # lookups with no matching error code
+
+    _index = {}
+    _indexKey = None  # (filePath, mtime) of loaded index
+    _lock = threading.Lock()
+
+    @staticmethod
+    def _parse(data: list | dict) -> dict[int, str]:
+        if isinstance(data, dict):
+            return {int(code): message for code, message in data.items()}
+        return {int(item["code"]): item["message"] for item in data}
+
+    @classmethod
+    def load(cls) -> dict[int, str]:
+        """Returns {code: message} of filePath, reloaded when the file changes. Raises if missing or invalid."""
+        path = cls.filePath
+        key = (path, os.stat(path).st_mtime_ns)
+        if key != cls._indexKey:
+            with cls._lock:
+                if key != cls._indexKey:
+                    with open(path, "r") as f:
+                        cls._index = cls._parse(jsonLoad(f))
+                    cls._indexKey = key
+                    defaultLog.info(f"Loaded {len(cls._index)} Twilio error codes from {path}")
+        return cls._index
 
     @classmethod
     def getError(cls, e: int | str) -> str | None:
         try:
-            with open(cls.filePath, "r") as f:
-                return next(item["message"] for item in jsonLoad(f) if item["code"] == int(e))
+            message = cls.load().get(int(e))
         except FileNotFoundError:
             defaultLog.warning(f"Twilio error code dictionary not found at {cls.filePath}")
             return None
-        except StopIteration:
-            return None
         except Exception as e:
             defaultLog.error(f"Unexpected error when retrieving error message: {e}")
-            return None
+            message = None
+
+        if message is None:
+            with cls._lock:
+                cls.missCount += 1
+            errorCodeLookups.inc(labels=("miss",))
+        else:
+            errorCodeLookups.inc(labels=("hit",))
+        return message
+
+    @classmethod
+    def compile(cls, source: str, dest: str) -> int:
+        """Writes source error code dictionary to dest as compact {"code": "message"} json. Returns number of codes."""
+        with open(source, "r") as f:
+            index = cls._parse(jsonLoad(f))
+        with open(dest, "w") as f:
+            jsonDump({str(code): message for code, message in index.items()}, f, separators=(",", ":"))
+        return len(index)
 
 
 if __name__ == "__main__":
@@ -147,8 +371,8 @@ if __name__ == "__main__":
 
     # TwilioSMSClient
     TestClient = TwilioSMSClient(debug=True, useCallback=False)
-    recipients = TestClient.recipientList.copy()
-    source = TestClient.from_
+    recipients = TestClient.recipientList
+    senderPool = TestClient.senderPool
 
     assert TestClient.recipientListLength == len(recipients)
 
@@ -161,25 +385,39 @@ if __name__ == "__main__":
     assert returnVal.nothingSent
 
     # one message failed to send, rest sent successfully
-    TestClient.recipientList.append("+1aaabbbcccc")
+    TestClient.recipientList = recipients + ("+1aaabbbcccc",)
     returnVal = TestClient.send("Testing...")
-    TestClient.recipientList.pop()
+    TestClient.recipientList = recipients
     assert not returnVal.nothingSent
     assert returnVal.messages[-1].recipient == "+1aaabbbcccc"  # message should be added to end of list
 
-    # one message failed to send (because of Validation error), rest sent successfully
-    TestClient.recipientList.append("aaa")
-    returnVal = TestClient.send("Testing...")
-    TestClient.recipientList.pop()
-    assert not returnVal.nothingSent
-    assert returnVal.messages[-1].recipient != "aaa"  # message should not be added due to ValidationError
+    # configured recipients are already normalized E.164 (invalid recipients fail settings)
+    assert all(toE164(recipient) == recipient for recipient in recipients)
 
     # invalid from address; all messages failed to send
-    TestClient.from_ = "+1aaabbbcccc"
+    TestClient.senderPool = SenderPool(["+1aaabbbcccc"])
     returnVal = TestClient.send("Testing...")
-    TestClient.from_ = source
+    TestClient.senderPool = senderPool
     assert returnVal.nothingSent
 
+    # every recipient keeps its sender of a pool, invalid senders are skipped after repeated failures
+    PoolClient = TwilioSMSClient(debug=True, useCallback=False, senders=["+1aaabbbcccc"] + senderPool.senders)
+    PoolClient.senderPool.failureThreshold = 1
+    PoolClient.recipientList = recipients
+    PoolClient.send("Testing...")
+    returnVal = PoolClient.send("Testing...")
+    assert not returnVal.nothingSent
+    assert all(PoolClient.senderPool.senderFor(recipient) != "+1aaabbbcccc" for recipient in recipients)
+
+    # sequential and concurrent sends return messages in recipient order
+    SequentialClient = TwilioSMSClient(debug=True, useCallback=False, concurrency=1)
+    ConcurrentClient = TwilioSMSClient(debug=True, useCallback=False, concurrency=4)
+    for client in (SequentialClient, ConcurrentClient):
+        client.recipientList = recipients + ("+1aaabbbcccc",)
+        returnVal = client.send("Testing...")
+        assert not returnVal.nothingSent
+        assert [x.recipient for x in returnVal.messages] == list(client.recipientList)
+
     # TwilioErrorCodes - assumes valid json filePath
     assert TwilioErrorCodes.getError(None) is None
     assert TwilioErrorCodes.getError(20006) == "Access Denied"
@@ -187,6 +425,19 @@ if __name__ == "__main__":
     assert TwilioErrorCodes.getError("aaa") is None  # to int conversion fails
     assert TwilioErrorCodes.getError(999999) is None  # invalid error code
 
+    assert TwilioErrorCodes.missCount == 3
+
+    # compact dictionary, reloaded when file changes
+    compactPath = "/tmp/twilio-error-codes-compact.json"
+    assert TwilioErrorCodes.compile(TwilioErrorCodes.filePath, compactPath) > 0
+    TwilioErrorCodes.filePath = compactPath
+    assert TwilioErrorCodes.getError("20006") == "Access Denied"
+    with open(compactPath, "w") as f:
+        jsonDump({"20006": "Reloaded"}, f)
+    os.utime(compactPath, ns=(0, 0))  # mtime changes even if written within clock resolution
+    assert TwilioErrorCodes.getError(20006) == "Reloaded"
+    os.remove(compactPath)
+
     # invalid json filePath
     TwilioErrorCodes.filePath = "/dev/null"
     assert TwilioErrorCodes.getError(20006) is None
@@ -0,0 +1,295 @@
+# twilioEmulator.py
+# By: Ethan Jansen
+# Local Twilio API emulator for offline testing and capacity planning.
+# Implements the Messages create (and Account fetch, for health checks) endpoints, then POSTs status callbacks
+# (queued -> sent -> delivered/undelivered) to the message's StatusCallback after configurable delays,
+# signed with X-Twilio-Signature if an auth token is set.
+# Undelivered error codes are drawn from the Twilio error code file.
+# Run in-process with TWILIO_EMULATOR=true, or standalone with: python -m iMonnitTwilioConnector.twilioEmulator --help
+# and point servers at it with TWILIO_API_BASE_URL.
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from email.utils import format_datetime
+import heapq
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+import json
+import logging
+import random
+import re
+import threading
+from time import monotonic, perf_counter, sleep
+from urllib.parse import parse_qsl, urlsplit, urlunsplit
+import requests
+from .auth import TwilioSignatureValidator
+from .settings import TwilioConfig
+from .twilioClient import TwilioErrorCodes
+
+
+logger = logging.getLogger(__name__)
+
+
+class _EmulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+    _messagesPath = re.compile(r"^/2010-04-01/Accounts/(?P<account>AC\w{32})/Messages\.json$")
+    _accountPath = re.compile(r"^/2010-04-01/Accounts/(?P<account>AC\w{32})\.json$")
+
+    def log_message(self, format, *args):
+        pass  # quiet under load
+
+    def _reply(self, status: int, payload: dict) -> None:
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        account = _EmulatorHandler._accountPath.match(self.path)
+        if self.path == "/stats":
+            self._reply(200, self.server.emulator.stats())
+        elif account is not None:
+            self._reply(200, {"sid": account["account"], "status": "active", "type": "Full"})
+        else:
+            self._reply(404, {"code": 20404, "message": "The requested resource was not found", "status": 404})
+
+    def do_POST(self):
+        data = dict(parse_qsl(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode()))
+        match = _EmulatorHandler._messagesPath.match(self.path)
+        if match is None:
+            self._reply(404, {"code": 20404, "message": "The requested resource was not found", "status": 404})
+            return
+
+        status, payload = self.server.emulator.createMessage(match["account"], data)
+        self._reply(status, payload)
+
+
+class TwilioEmulator:
+    # common SMS delivery failures, if the error code file is missing
+    defaultErrorCodes = {30003: "Unreachable destination handset",
+                         30005: "Unknown destination handset",
+                         30006: "Landline or unreachable carrier",
+                         30007: "Message filtered",
+                         30008: "Unknown error"}
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 0,
+                 latency: float = 0.15,
+                 jitter: float = 0.05,
+                 errorRate: float = 0,
+                 sentDelay: float = 1,
+                 deliverDelay: float = 3,
+                 undeliveredRate: float = 0.05,
+                 callbackBaseUrl: str | None = None,
+                 callbackThreads: int = 8,
+                 authToken: str | None = TwilioConfig.AuthToken):
+        self.latency = latency  # seconds, mean messages.create response time
+        self.jitter = jitter  # seconds, standard deviation
+        self.errorRate = errorRate  # fraction of creates answered with 429
+        self.sentDelay = sentDelay  # seconds after create
+        self.deliverDelay = deliverDelay  # seconds after sent
+        self.undeliveredRate = undeliveredRate  # fraction of messages undelivered
+        self.callbackBaseUrl = callbackBaseUrl  # replaces scheme and host of StatusCallback (keeps credentials)
+        self._signer = TwilioSignatureValidator(authToken, "")  # signs the original StatusCallback, as Twilio does
+
+        self._server = ThreadingHTTPServer((host, port), _EmulatorHandler)
+        self._server.daemon_threads = True
+        self._server.emulator = self
+        self._thread = None
+
+        self._sids = count(1)
+        self._errorCodes = self._loadErrorCodes()
+
+        # callbacks: (due, sequence, url, form) heap, POSTed by a small pool
+        self._callbacks = []
+        self._sequence = count()  # heap tie breaker
+        self._callbacksReady = threading.Condition()
+        self._dispatcher = None
+        self._stopping = threading.Event()
+        self._callbackPool = ThreadPoolExecutor(max_workers=callbackThreads, thread_name_prefix="emulator-callback")
+        self._session = requests.Session()
+
+        self._counts = {"created": 0, "rejected": 0, "callbacks": 0, "callbackErrors": 0}
+        self._callbackLatencies = deque(maxlen=100000)  # most recent callback POST times
+        self._statsLock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _loadErrorCodes(self) -> dict[int, str]:
+        try:
+            index = TwilioErrorCodes.load()
+            codes = {code: message for code, message in index.items() if 30001 <= code <= 30010}
+            if codes:
+                return codes
+        except Exception:
+            pass
+        return dict(TwilioEmulator.defaultErrorCodes)
+
+    def start(self) -> None:
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._server.serve_forever, name="twilio-emulator", daemon=True)
+        self._thread.start()
+        self._dispatcher = threading.Thread(target=self._dispatch, name="twilio-emulator-dispatch", daemon=True)
+        self._dispatcher.start()
+        logger.warning(f"Twilio emulator listening on {self.url}")
+
+    def stop(self) -> None:
+        self._stopping.set()
+        with self._callbacksReady:
+            self._callbacksReady.notify()
+        self._server.shutdown()
+        self._server.server_close()
+        self._callbackPool.shutdown(wait=False, cancel_futures=True)
+
+    def _count(self, key: str) -> None:
+        with self._statsLock:
+            self._counts[key] += 1
+
+    def createMessage(self, account: str, data: dict) -> tuple[int, dict]:
+        """Handles a Messages create request. Returns (http status, json payload)."""
+        sleep(max(random.gauss(self.latency, self.jitter), 0))
+
+        if random.random() < self.errorRate:
+            self._count("rejected")
+            return (429, {"code": 20429, "message": "Too Many Requests", "status": 429,
+                          "more_info": "https://www.twilio.com/docs/errors/20429"})
+
+        sid = f"SM{next(self._sids):032x}"
+        now = datetime.now(timezone.utc)
+        self._count("created")
+        if data.get("StatusCallback"):
+            self._scheduleCallbacks(sid, account, data)
+
+        return (201, {"sid": sid,
+                      "account_sid": account,
+                      "api_version": "2010-04-01",
+                      "body": data.get("Body"),
+                      "date_created": format_datetime(now, usegmt=True),
+                      "date_sent": None,
+                      "date_updated": format_datetime(now, usegmt=True),
+                      "direction": "outbound-api",
+                      "error_code": None,
+                      "error_message": None,
+                      "from": data.get("From"),
+                      "messaging_service_sid": data.get("MessagingServiceSid"),
+                      "num_media": "0",
+                      "num_segments": "1",
+                      "price": None,
+                      "price_unit": "USD",
+                      "status": "queued",
+                      "subresource_uris": {},
+                      "to": data.get("To"),
+                      "uri": f"/2010-04-01/Accounts/{account}/Messages/{sid}.json"})
+
+    def _callbackUrl(self, url: str) -> str:
+        if not self.callbackBaseUrl:
+            return url
+        original = urlsplit(url)
+        base = urlsplit(self.callbackBaseUrl)
+        userinfo = original.netloc.rpartition("@")[0]
+        netloc = f"{userinfo}@{base.netloc}" if userinfo else base.netloc
+        return urlunsplit((base.scheme, netloc, original.path, original.query, ""))
+
+    def _scheduleCallbacks(self, sid: str, account: str, data: dict) -> None:
+        url = data["StatusCallback"]
+        form = {"MessageSid": sid,
+                "SmsSid": sid,
+                "AccountSid": account,
+                "From": data.get("From", ""),
+                "To": data.get("To", ""),
+                "ApiVersion": "2010-04-01"}
+
+        now = monotonic()
+        sentAt = now + self.sentDelay
+        doneAt = sentAt + self.deliverDelay
+        final = form | {"MessageStatus": "delivered", "SmsStatus": "delivered",
+                        "RawDlrDoneDate": datetime.now(timezone.utc).strftime("%y%m%d%H%M")}
+        if random.random() < self.undeliveredRate:
+            final = form | {"MessageStatus": "undelivered", "SmsStatus": "undelivered",
+                            "ErrorCode": str(random.choice(list(self._errorCodes)))}
+
+        with self._callbacksReady:
+            heapq.heappush(self._callbacks, (now, next(self._sequence), url, form | {"MessageStatus": "queued", "SmsStatus": "queued"}))
+            heapq.heappush(self._callbacks, (sentAt, next(self._sequence), url, form | {"MessageStatus": "sent", "SmsStatus": "sent"}))
+            heapq.heappush(self._callbacks, (doneAt, next(self._sequence), url, final))
+            self._callbacksReady.notify()
+
+    def _dispatch(self) -> None:
+        while not self._stopping.is_set():
+            with self._callbacksReady:
+                while not self._callbacks and not self._stopping.is_set():
+                    self._callbacksReady.wait()
+                if self._stopping.is_set():
+                    return
+                due = self._callbacks[0][0]
+                wait = due - monotonic()
+                if wait > 0:
+                    self._callbacksReady.wait(wait)
+                    continue
+                _, _, url, form = heapq.heappop(self._callbacks)
+            self._callbackPool.submit(self._post, url, form)
+
+    def _post(self, url: str, form: dict) -> None:
+        headers = {"X-Twilio-Signature": self._signer.sign(form.items(), url)} if self._signer.enabled else {}
+        start = perf_counter()
+        try:
+            ok = self._session.post(self._callbackUrl(url), data=form, headers=headers, timeout=30).status_code < 300
+        except requests.RequestException:
+            ok = False
+        with self._statsLock:
+            self._counts["callbacks" if ok else "callbackErrors"] += 1
+            self._callbackLatencies.append(perf_counter() - start)
+
+    def stats(self) -> dict:
+        """Returns counts, callbacks still scheduled, and callback POST latency percentiles (ms)."""
+        with self._statsLock:
+            stats = dict(self._counts)
+            latencies = sorted(self._callbackLatencies)
+        with self._callbacksReady:
+            stats["callbacksPending"] = len(self._callbacks)
+        for p in (50, 95, 99):
+            stats[f"callbackP{p}"] = latencies[min(int(len(latencies) * p / 100), len(latencies) - 1)] * 1000 if latencies else 0
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m iMonnitTwilioConnector.twilioEmulator",
+                                     description="Local Twilio Messages API emulator with status callbacks.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=5090)
+    parser.add_argument("--latency", type=float, default=150, help="mean messages.create latency (ms)")
+    parser.add_argument("--jitter", type=float, default=50, help="messages.create latency standard deviation (ms)")
+    parser.add_argument("--error-rate", type=float, default=0, help="fraction of creates answered with 429 (0-1)")
+    parser.add_argument("--sent-delay", type=float, default=1, help="seconds from create to sent callback")
+    parser.add_argument("--deliver-delay", type=float, default=3, help="seconds from sent to delivered/undelivered callback")
+    parser.add_argument("--undelivered-rate", type=float, default=0.05, help="fraction of messages undelivered (0-1)")
+    parser.add_argument("--callback-base-url", help="send callbacks here instead of StatusCallback's host, e.g. http://server:5081")
+    parser.add_argument("--auth-token", default=TwilioConfig.AuthToken, help="sign callbacks with this auth token (defaults to TWILIO_AUTH_TOKEN)")
+    args = parser.parse_args()
+
+    emulator = TwilioEmulator(host=args.host,
+                              port=args.port,
+                              latency=args.latency / 1000,
+                              jitter=args.jitter / 1000,
+                              errorRate=args.error_rate,
+                              sentDelay=args.sent_delay,
+                              deliverDelay=args.deliver_delay,
+                              undeliveredRate=args.undelivered_rate,
+                              callbackBaseUrl=args.callback_base_url,
+                              authToken=args.auth_token)
+    emulator.start()
+    try:
+        while True:
+            sleep(60)
+            logger.warning(f"Twilio emulator stats: {emulator.stats()}")
+    except KeyboardInterrupt:
+        emulator.stop()
@@ -1,14 +1,19 @@
 # webhook.py
 # By: Ethan Jansen
 # Webhooks for flask server.
-# imonnit: Websocket server for iMonnit--sends text with Twilio. Requires Basic Authorization.
+# imonnit: Websocket server for iMonnit--sends text with Twilio (through the outbox if enabled). Requires Basic Authorization.
+# twilio: Twilio status callbacks. Requires a valid X-Twilio-Signature (if TWILIO_AUTH_TOKEN is set) or Basic Authorization.
 
 from datetime import datetime
 from flask import Blueprint, request
 import logging
-from . import dbConn, smsClient
-from .auth import login_required
+from typing import Generator, Tuple
+from . import callbackBuffer, coalescer, dbConn, deduplicator, retryPolicy, router, smsClient, smsOutbox
+from .auth import login_required, twilio_auth_required
 from .dataTypes import Event, Message, ValidationError
+from .health import prober
+from .logPipeline import audit
+from .metrics import validationErrors, validationSeconds
 from .twilioClient import TwilioErrorCodes
 
 
@@ -22,6 +27,69 @@ logger = logging.getLogger(__name__)
 @webhookBp.post("/imonnit")
 @login_required
 def imonnit():
+    # iMonnit uses json
+    return handleImonnit(request.json)
+
+
+@webhookBp.post("/twilio")
+@twilio_auth_required
+def twilio():
+    # Twilio uses x-www-form-urlencoded
+    return handleTwilio(request.form.to_dict())
+
+
+# Handlers -- shared by flask routes and the asgi app. Return (body, status[, headers]).
+# Until startup is complete (schema migrated, routes loaded, workers started) both answer 503, so senders retry later.
+notReadyResponse = ("Service Unavailable: starting up", 503, {"Retry-After": "5"})
+
+# Each handler's logic is written once, as a generator that yields its blocking calls as (name, *args) and is sent
+# their results. handleImonnit and handleTwilio make the calls in the request thread (flask). handleImonnitAsync and
+# handleTwilioAsync await them (asgi): Twilio sends with the async Twilio client, db calls on the db connector's threads
+# (see DbConnector.runAsync), so webhooks waiting on Twilio or the db hold no thread.
+_calls = {"lookup": deduplicator.lookup,
+          "store": dbConn.addEventWithMessages,
+          "addMessages": dbConn.addMessages,
+          "updateMessage": dbConn.updateMessage,
+          "submit": smsOutbox.submit,
+          "resubmit": smsOutbox.resubmit,
+          "send": smsClient.send,
+          "notify": smsOutbox.notify}
+_asyncCalls = {"send": smsClient.sendAsync,
+               "notify": smsOutbox.notifyAsync}
+
+
+def _run(flow: Generator) -> Tuple:
+    result, error = None, None
+    while True:
+        try:
+            call = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as done:
+            return done.value
+        result, error = None, None
+        try:
+            result = _calls[call[0]](*call[1:])
+        except Exception as e:
+            error = e
+
+
+async def _runAsync(flow: Generator) -> Tuple:
+    result, error = None, None
+    while True:
+        try:
+            call = flow.send(result) if error is None else flow.throw(error)
+        except StopIteration as done:
+            return done.value
+        result, error = None, None
+        try:
+            if call[0] in _asyncCalls:
+                result = await _asyncCalls[call[0]](*call[1:])
+            else:
+                result = await dbConn.runAsync(_calls[call[0]], *call[1:])
+        except Exception as e:
+            error = e
+
+
+def handleImonnit(data: dict) -> Tuple:
     """
     Expected iMonnit Rule Webhook Contents:
     {
@@ -45,37 +113,105 @@ def imonnit():
         companyName: Company name of the account the rule belongs to
     }
     """
+    return _run(_imonnit(data))
+
 
+async def handleImonnitAsync(data: dict) -> Tuple:
+    return await _runAsync(_imonnit(data))
+
+
+def _imonnit(data: dict) -> Generator:
     # Log
     logger.info("iMonnit webhook POST received")
+    if not prober.started:
+        return notReadyResponse
 
-    # iMonnit uses json
-    data = request.json
-    sendTwilio = smsClient.recipientListLength > 0
+    sendTwilio = router.hasRecipients
 
     try:
         # parse/validate event data
-        event = Event(**data)
-        logger.info(f"Rule: {event.rule}")
+        try:
+            with validationSeconds.time(("Event",)):
+                event = Event(**data)
+        except ValidationError:
+            validationErrors.inc(labels=("Event",))
+            raise
+        logger.info(f"Rule: {event.rule}", extra=audit)
+
+        # recipients routed by account, network, device, and rule
+        recipients = router.recipientsFor(event)
+        sendTwilio = len(recipients) > 0
+
+        # recognize iMonnit retries of an event that was already received
+        previous = yield ("lookup", event)
+        if previous is not None:
+            logger.info(f"Received retry of Event {previous.eventId if previous.eventId else '(not in db)'}", extra=audit)
+
+        # repeat alerts within the coalesce window are stored without messages, and summarized by a digest later
+        # admitted events that could not be stored are cancelled, so iMonnit's retry is admitted (sent or suppressed)
+        # the same way. Once Twilio was called the attempt is known to the deduplicator, retries skip the coalescer.
+        coalesced = sendTwilio and previous is None
+
+        def failed(response: Tuple) -> Tuple:
+            if coalesced:
+                coalescer.cancel(event)
+            return response
+
+        if coalesced and not coalescer.admit(event, recipients):
+            if not (yield ("store", event)):
+                return failed(("Unable to add event details to db", 500))  # InternalServerError
+            deduplicator.record(event, event.id)
+            return ("", 200)  # OK
+
+        # store event with pending messages, outbox workers send them with Twilio
+        if smsOutbox.enabled:
+            if previous is not None and previous.eventId is not None:
+                # already stored, only failed messages are sent again
+                if not (yield ("resubmit", previous.eventId)):
+                    return ("Unable to update event details in db", 500)  # InternalServerError
+                return ("", 200)  # OK
+
+            if not (yield ("submit", event, recipients)):
+                return failed(("Unable to add event details to db", 500))  # InternalServerError
+            deduplicator.record(event, event.id)
+
+            if not sendTwilio:
+                logger.info("No SMS recipients")
+            return ("", 200)  # OK
+
+        # send Twilio messages -- retries are only sent to recipients without a successful message
+        if previous is not None:
+            recipients = previous.unsentRecipients(recipients)
 
-        # send Twilio messages
         twilioReturn = None
-        if sendTwilio:
-            twilioReturn = smsClient.send(event.messageBody)
+        if sendTwilio and recipients:
+            twilioReturn = yield ("send", event.messageBody, recipients)
             event.messages = twilioReturn.messages
 
+            # throttled or 5xx failures are stored as "retrying", the outbox retry worker sends them again
+            retrying = [message for message in event.messages if retryPolicy.afterAttempt(message)]
+            deduplicator.record(event, previous=previous)
+
             # check if twilio was able to send messages.
-            # Note: if nothing could be sent when it should have,
+            # Note: if nothing could be sent (or retried) when it should have,
             # nothing will be added to db and return status will inform client to retry later (hopefully)
-            if twilioReturn.nothingSent:
+            if twilioReturn.nothingSent and not retrying:
                 # all messages (if present) should have errors if nothingSent
                 errorString = "Sending Twilio messages resulted in errors: "
                 errorString += ", ".join([str(x.errorCode) for x in twilioReturn.messages])
                 return (errorString, 500)  # InternalServerError
 
         # add to db
-        if not dbConn.addEventWithMessages(event):
-            return ("Unable to add event details to db", 500)  # InternalServerError
+        if previous is not None and previous.eventId is not None:
+            if event.messages and not (yield ("addMessages", previous.eventId, event.messages)):
+                return ("Unable to add event details to db", 500)  # InternalServerError
+        else:
+            if previous is not None:
+                # messages sent by earlier attempts that were not stored
+                event.messages = previous.messages + event.messages
+            if not (yield ("store", event)):
+                return ("Unable to add event details to db", 500)  # InternalServerError
+            deduplicator.record(event, event.id)
 
         # do nothing further if no sms recipients
         if not sendTwilio:
@@ -86,7 +222,7 @@ def imonnit():
     except ValidationError as e:
         if sendTwilio:
             # These are not saved to db, nor checked for twilio errors
-            smsClient.send("Error: Received bad data from iMonnit Webhook!")
+            yield ("notify", "Error: Received bad data from iMonnit Webhook!")
         logger.error(f"Received bad data from iMonnit Webhook: {e.errors()}")
         return ("Unexpected Data", 400)  # BadRequest
 
@@ -94,9 +230,7 @@ def imonnit():
     return ("", 200)  # OK
 
 
-@webhookBp.post("/twilio")
-@login_required
-def twilio():
+def handleTwilio(data: dict) -> Tuple:
     """
     Expected Twilio SMS Status callback data:
     {
@@ -116,12 +250,18 @@ def twilio():
         Message.updated: DT webhook was received
     }
     """
+    return _run(_twilio(data))
+
+
+async def handleTwilioAsync(data: dict) -> Tuple:
+    return await _runAsync(_twilio(data))
 
+
+def _twilio(data: dict) -> Generator:
     # Log
     logger.info("Twilio webhook POST received")
-
-    # Twilio uses x-www-form-urlencoded
-    data = request.form.to_dict()
+    if not prober.started:
+        return notReadyResponse
 
     try:
         # get addtional info if necessary
@@ -134,18 +274,28 @@ def twilio():
             errorMessage = TwilioErrorCodes.getError(data["ErrorCode"])
 
         # receive message details
-        msg = Message(messageId=data.get("MessageSid"),
-                      recipient=data.get("To"),
-                      status=data.get("MessageStatus"),
-                      sentDT=sentDT,
-                      deliveredDT=data.get("RawDlrDoneDate"),
-                      errorCode=data.get("ErrorCode"),
-                      errorMessage=errorMessage,
-                      updated=datetime.now())
-        logger.info(f"Message: {msg.messageId}")
+        try:
+            with validationSeconds.time(("Message",)):
+                msg = Message(messageId=data.get("MessageSid"),
+                              recipient=data.get("To"),
+                              status=data.get("MessageStatus"),
+                              sentDT=sentDT,
+                              deliveredDT=data.get("RawDlrDoneDate"),
+                              errorCode=data.get("ErrorCode"),
+                              errorMessage=errorMessage,
+                              updated=datetime.now())
+        except ValidationError:
+            validationErrors.inc(labels=("Message",))
+            raise
+        logger.info(f"Message: {msg.messageId}", extra=audit)
+
+        # acknowledge now, update db with next batch
+        if callbackBuffer.enabled:
+            callbackBuffer.add(msg)
+            return ("", 200)  # OK
 
         # update db
-        if not dbConn.updateMessage(msg):
+        if not (yield ("updateMessage", msg)):
             return ("Unable to update db with message callback", 500)  # InternalServerError
     except ValidationError as e:
         # This is not logged to db
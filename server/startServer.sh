@@ -1,6 +1,22 @@
 #!/bin/sh
 
-if [ "$IMONNIT_TWILIO_CONNECTOR_USE_HTTPS" = "true" ]; then
+# compact the Twilio error code dictionary downloaded at build time (once, the package needs runtime settings)
+ERROR_CODES_SOURCE=/server/twilio-error-codes.source.json
+if [ -f "$ERROR_CODES_SOURCE" ]; then
+  python -c "from iMonnitTwilioConnector.twilioClient import TwilioErrorCodes as c; print(c.compile('$ERROR_CODES_SOURCE', c.filePath), 'Twilio error codes')" \
+    && rm "$ERROR_CODES_SOURCE"
+fi
+
+# IMONNIT_TWILIO_CONNECTOR_SERVER: waitress (default, flask with threads) or asgi (uvicorn, asyncio)
+if [ "$IMONNIT_TWILIO_CONNECTOR_SERVER" = "asgi" ]; then
+  echo "Using ASGI server"
+  if [ "$IMONNIT_TWILIO_CONNECTOR_USE_HTTPS" = "true" ]; then
+    echo "Using HTTPS"
+    uvicorn --host 0.0.0.0 --port "$IMONNIT_TWILIO_CONNECTOR_PORT" --proxy-headers --forwarded-allow-ips="*" iMonnitTwilioConnector.asgi:app
+  else
+    uvicorn --host 0.0.0.0 --port "$IMONNIT_TWILIO_CONNECTOR_PORT" iMonnitTwilioConnector.asgi:app
+  fi
+elif [ "$IMONNIT_TWILIO_CONNECTOR_USE_HTTPS" = "true" ]; then
   echo "Using HTTPS"
   waitress-serve --listen 0.0.0.0:"$IMONNIT_TWILIO_CONNECTOR_PORT" --no-ipv6 --url-scheme=https --call iMonnitTwilioConnector:create_app 
 else
@@ -0,0 +1,60 @@
+# dtParsing.py
+# By: Ethan Jansen
+# Micro-benchmark of dataTypes._customDTValidator against the original (uncached, every format in order) validator.
+# Run from server directory with app environment variables set: python tests/benchmark/dtParsing.py
+
+from datetime import datetime
+from timeit import repeat
+from iMonnitTwilioConnector.dataTypes import _customDTValidator, Event, Message
+
+
+# original validator, for comparison
+class LegacyDTValidator:
+    def __init__(self, formatStrings):
+        self.formatStrings = formatStrings
+
+    def validate(self, dt):
+        if isinstance(dt, datetime):
+            return dt
+        elif isinstance(dt, str):
+            for formatString in self.formatStrings:
+                try:
+                    return datetime.strptime(dt, formatString).astimezone().replace(tzinfo=None)
+                except ValueError:
+                    pass
+            raise ValueError("Unable to parse dt string")
+        raise TypeError("dt is not string or datetime")
+
+
+eventFormats = ["%m/%d/%Y %I:%M %p", "%Y-%m-%d %H:%M"]
+sentFormats = ["%a, %d %b %Y %H:%M:%S %z"]
+
+# iMonnit sends the second event format, so every legacy parse misses the first format once
+cases = {"Event (repeated time)": (eventFormats, ["2025-03-28 14:25"] * 100),
+         "Event (unique times)": (eventFormats, [f"2025-03-28 {h:02}:{m:02}" for h in range(24) for m in range(0, 60, 15)]),
+         "Message sentDT (unique times)": (sentFormats, [f"Fri, 28 Mar 2025 {h:02}:{m:02}:00 -0800" for h in range(24) for m in range(0, 60, 15)])}
+
+
+def bench(validator, strings, number=50):
+    def run():
+        for s in strings:
+            validator.validate(s)
+    return min(repeat(run, number=number, repeat=5)) / (number * len(strings))
+
+
+if __name__ == "__main__":
+    for name, (formats, strings) in cases.items():
+        legacy = bench(LegacyDTValidator(formats), strings)
+        fast = bench(_customDTValidator(formats), strings)
+        uncached = _customDTValidator(formats)
+        uncached.validate = uncached._parse  # last format first and cached offsets, no memoized strings
+        cold = bench(uncached, strings)
+        print(f"{name:32} legacy {legacy * 1e6:7.2f} us  fast {fast * 1e6:7.2f} us  ({legacy / fast:5.1f}x)  "
+              f"not memoized {cold * 1e6:7.2f} us")
+
+    # end to end model validation
+    data = {"rule": "rule", "date": "2025-03-28", "time": "14:25", "readingDate": "2025-03-28", "readingTime": "14:25"}
+    eventTime = min(repeat(lambda: Event(**data), number=2000, repeat=5)) / 2000
+    messageTime = min(repeat(lambda: Message(recipient="+11234567890", sentDT="Fri, 28 Mar 2025 06:25:00 -0800",
+                                             deliveredDT="2503281426"), number=2000, repeat=5)) / 2000
+    print(f"Event validation {eventTime * 1e6:.2f} us, Message validation {messageTime * 1e6:.2f} us")
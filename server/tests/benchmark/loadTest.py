@@ -0,0 +1,208 @@
+# loadTest.py
+# By: Ethan Jansen
+# Load test. Replays iMonnit webhook payloads and Twilio status callbacks at a fixed rate, then reports throughput and
+# p50/p95/p99 latency per route. Latency is measured from each request's scheduled send time, so a server that falls
+# behind is not hidden by the load generator slowing down.
+# Run with: python tests/benchmark/loadTest.py [--serve] [--rate 20] [--callback-rate 40] [--duration 30]
+# Use with the Twilio API emulator (TWILIO_EMULATOR or TWILIO_API_BASE_URL) and a throwaway database, see tests/README.md
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from copy import deepcopy
+from datetime import datetime, timedelta
+import json
+from itertools import count
+import os
+import sys
+import threading
+from time import perf_counter, sleep
+import requests
+
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+routeImonnit = "/webhook/imonnit"
+routeTwilio = "/webhook/twilio"
+
+
+class LoadTest:
+    def __init__(self, url: str, auth: tuple, payload: dict, concurrency: int):
+        self.url = url.rstrip("/")
+        self.auth = auth
+        self.payload = payload
+
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="load")
+        self._local = threading.local()
+        self._events = count()
+        self._start = datetime(2020, 1, 1)
+
+        self.results = {}  # route: [(latency seconds, status code or None)]
+        self._resultsLock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.auth = self.auth
+        return session
+
+    def _eventPayload(self) -> dict:
+        # unique device and trigger time, so no event is taken for a retry of another
+        n = next(self._events)
+        triggered = self._start + timedelta(minutes=n)
+        payload = deepcopy(self.payload)
+        payload.update({"deviceID": str(100000 + n),
+                        "date": triggered.strftime("%Y-%m-%d"),
+                        "time": triggered.strftime("%H:%M")})
+        return payload
+
+    def _callbackForm(self) -> dict:
+        n = next(self._events)
+        return {"MessageSid": f"SM{n:032x}",
+                "To": "+18777804236",
+                "MessageStatus": ("sent", "delivered", "undelivered")[n % 3],
+                "ErrorCode": "30003" if n % 3 == 2 else "",
+                "RawDlrDoneDate": "2503281426" if n % 3 == 1 else ""}
+
+    def _send(self, route: str, scheduled: float) -> None:
+        status = None
+        try:
+            if route == routeImonnit:
+                response = self._session().post(self.url + route, json=self._eventPayload(), timeout=30)
+            else:
+                response = self._session().post(self.url + route, data=self._callbackForm(), timeout=30)
+            status = response.status_code
+        except requests.RequestException:
+            pass
+        latency = perf_counter() - scheduled
+
+        with self._resultsLock:
+            self.results.setdefault(route, []).append((latency, status))
+
+    def _schedule(self, route: str, rate: float, duration: float, start: float) -> None:
+        if rate <= 0:
+            return
+        for i in range(int(rate * duration)):
+            scheduled = start + i / rate
+            delay = scheduled - perf_counter()
+            if delay > 0:
+                sleep(delay)
+            self._executor.submit(self._send, route, scheduled)
+
+    def run(self, rate: float, callbackRate: float, duration: float) -> float:
+        """Sends requests for duration seconds, waits for all responses. Returns elapsed seconds."""
+        start = perf_counter()
+        schedulers = [threading.Thread(target=self._schedule, args=(routeImonnit, rate, duration, start)),
+                      threading.Thread(target=self._schedule, args=(routeTwilio, callbackRate, duration, start))]
+        for scheduler in schedulers:
+            scheduler.start()
+        for scheduler in schedulers:
+            scheduler.join()
+        self._executor.shutdown(wait=True)
+        return perf_counter() - start
+
+
+def percentile(sortedValues: list, p: float) -> float:
+    """Nearest-rank percentile of sorted values."""
+    if not sortedValues:
+        return 0.0
+    rank = max(int(-(-p * len(sortedValues) // 100)), 1)  # ceil
+    return sortedValues[rank - 1]
+
+
+def report(results: dict, elapsed: float) -> dict:
+    summary = {}
+    for route, samples in sorted(results.items()):
+        latencies = sorted(latency for latency, _ in samples)
+        errors = sum(1 for _, status in samples if status is None or status >= 300)
+        summary[route] = {"requests": len(samples),
+                          "errors": errors,
+                          "throughput": len(samples) / elapsed,
+                          "p50": percentile(latencies, 50) * 1000,
+                          "p95": percentile(latencies, 95) * 1000,
+                          "p99": percentile(latencies, 99) * 1000,
+                          "max": latencies[-1] * 1000}
+
+    print(f"{'route':18} {'requests':>8} {'errors':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for route, s in summary.items():
+        print(f"{route:18} {s['requests']:8} {s['errors']:7} {s['throughput']:8.1f} "
+              f"{s['p50']:8.1f} {s['p95']:8.1f} {s['p99']:8.1f} {s['max']:8.1f}")
+    return summary
+
+
+def serve(port: int) -> None:
+    """Starts create_app() with waitress in a background thread."""
+    from waitress import create_server
+    from iMonnitTwilioConnector import create_app
+
+    server = create_server(create_app(), host="127.0.0.1", port=port, threads=16)
+    threading.Thread(target=server.run, name="waitress", daemon=True).start()
+
+
+def emulatorStats(url: str, timeout: float = 60) -> dict:
+    """Waits for the emulator's scheduled status callbacks (send and callback loop), returns its stats."""
+    deadline = perf_counter() + timeout
+    while True:
+        stats = requests.get(url.rstrip("/") + "/stats", timeout=5).json()
+        if not stats["callbacksPending"] or perf_counter() > deadline:
+            return stats
+        sleep(1)
+
+
+def waitForServer(url: str, timeout: float = 60) -> bool:
+    """Waits for server to be ready (startup complete, dependencies reachable)."""
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            if requests.get(url + "/readyz", timeout=5).status_code == 200:
+                return True
+        except requests.RequestException:
+            pass
+        sleep(1)
+    return False
+
+
+def main():
+    port = int(os.environ.get("IMONNIT_TWILIO_CONNECTOR_PORT", "5081"))
+    parser = argparse.ArgumentParser(description="Replay iMonnit events and Twilio callbacks, report latency per route.")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{port}")
+    parser.add_argument("--serve", action="store_true", help="start create_app() in this process (waitress)")
+    parser.add_argument("--rate", type=float, default=20, help="iMonnit events per second")
+    parser.add_argument("--callback-rate", type=float, default=40, help="Twilio status callbacks per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds")
+    parser.add_argument("--concurrency", type=int, default=64, help="max requests in flight")
+    parser.add_argument("--payload", default=os.path.join(scriptPath, "..", "external", "iMonnitDataExample.json"))
+    parser.add_argument("--emulator", help="Twilio emulator url: wait for its status callbacks, then report its stats")
+    parser.add_argument("--json", help="also write summary to this file")
+    parser.add_argument("--max-p99", type=float, help="exit with status 1 if any route's p99 latency exceeds this (ms)")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(port)
+    if not waitForServer(args.url):
+        print(f"No server at {args.url}")
+        sys.exit(2)
+
+    with open(args.payload, "r") as f:
+        payload = json.load(f)
+    auth = (os.environ.get("IMONNIT_TWILIO_CONNECTOR_WH_USER", ""), os.environ.get("IMONNIT_TWILIO_CONNECTOR_WH_PASS", ""))
+
+    test = LoadTest(args.url, auth, payload, args.concurrency)
+    print(f"Sending {args.rate} events/s and {args.callback_rate} callbacks/s to {args.url} for {args.duration} s")
+    summary = report(test.results, test.run(args.rate, args.callback_rate, args.duration))
+
+    if args.emulator:
+        summary["emulator"] = emulatorStats(args.emulator)
+        print("Twilio emulator: " + ", ".join(f"{key} {value:.1f}" if isinstance(value, float) else f"{key} {value}"
+                                              for key, value in summary["emulator"].items()))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(summary, f, indent=2)
+
+    if args.max_p99 is not None and any(s["p99"] > args.max_p99 for route, s in summary.items() if route != "emulator"):
+        print(f"p99 latency above {args.max_p99} ms")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -234,14 +234,24 @@ echo "[TEST] Testing invalid data with recipients..."
 curlPostWithAuth '{"blah":"blah"}' "$routePathImonnit" "Unexpected Data" 400
 killApp
 
-# Test 7. "Good" recipients but bad from number
+# Test 7. "Good" recipients but bad from number (sending within webhook)
 setupEnv
 export TWILIO_PHONE_SRC="+1aaabbbcccc"
+export IMONNIT_TWILIO_CONNECTOR_OUTBOX_WORKERS=0
 backgroundApp
 echo "[TEST] Testing bad Twilio from number..."
 curlPostWithAuth '{"rule":"Test", "name":"bad from number"}' "$routePathImonnit" "Sending Twilio messages resulted in errors: 400, 400" 500
 killApp
 
+# Test 7.5. "Good" recipients but bad from number (sending with outbox)
+setupEnv
+export TWILIO_PHONE_SRC="+1aaabbbcccc"
+backgroundApp
+echo "[TEST] Testing bad Twilio from number with outbox..."
+# should add to db: Event with 2 Messages, Status "pending" until sent by outbox workers, then "failed" with ErrorCode 400
+curlPostWithAuth '{"rule":"Test", "name":"bad from number outbox"}' "$routePathImonnit" "" 200
+killApp
+
 # Test 8. Everything good
 setupEnv
 export TWILIO_PHONE_RCPTS="+18777804236"
@@ -263,7 +273,7 @@ killApp
 
 # Test 9. Twilio status callback - no credentials
 # Test 10. Twilio status callback - no To number (invalid data)
-# Test 11. Twilio status callback - no matching MessageSid
+# Test 11. Twilio status callback - no matching MessageSid (buffered)
 # Unable to test successful update, MessageId in db are unknown
 setupEnv
 backgroundApp
@@ -271,6 +281,14 @@ echo "[TEST] Testing Twilio status callback - no POST credentials"
 curlPost "" "$routePathTwilio" "Unauthorized" 401
 echo "[TEST] Testing Twilio status callback - invalid data"
 curlPostWithAuth "blah=blah" "$routePathTwilio" "Unexpected Data" 400
+echo "[TEST] Testing Twilio status callback - no matching MessageSID, buffered (acknowledged, dropped after retries)"
+curlPostWithAuth "To=%2b18777804236&MessageSid=SMXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX" "$routePathTwilio" "" 200
+killApp
+
+# Test 12. Twilio status callback - no matching MessageSid (unbuffered)
+setupEnv
+export IMONNIT_TWILIO_CONNECTOR_CALLBACK_BATCH=0
+backgroundApp
 echo "[TEST] Testing Twilio status callback - no matching MessageSID, cannot add to db"
 curlPostWithAuth "To=%2b18777804236&MessageSid=SMXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX" "$routePathTwilio" "Unable to update db with message callback" 500
 killApp